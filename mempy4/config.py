@@ -10,6 +10,17 @@ MEMVIZ_DATA_PATH = BASE_DATA_PATH / 'memviz'
 
 # DOCMODELS_PATH = BASE_DATA_PATH / 'docmodels'
 DOCMODELS_PATH = TEMP_DATA_PATH / 'docmodels'
+# DocModels packed in shard files (see utils/shards.py), listed the same way as DOCMODEL_PATHS_LIST
+# Only .dms files (shards.SHARD_SUFFIX) are listed, leaving out shards being written (.dms.tmp)
+DOCMODEL_SHARDS_PATH = TEMP_DATA_PATH / 'docmodel_shards'
+try:
+    DOCMODEL_SHARD_PATHS_LIST = sorted(DOCMODEL_SHARDS_PATH / p for p in listdir(DOCMODEL_SHARDS_PATH)
+                                       if p.endswith('.dms'))
+except FileNotFoundError:
+    DOCMODEL_SHARD_PATHS_LIST = None
+
+# Tree, raw text and tags of DocModels saved with split payloads, loaded on first access (see DocModel.to_pickle)
+DOCMODEL_PAYLOADS_PATH = TEMP_DATA_PATH / 'docmodel_payloads'
 
 try:
     DOCMODEL_PATHS_LIST = [DOCMODELS_PATH / p for p in listdir(DOCMODELS_PATH)]
@@ -17,6 +28,24 @@ except FileNotFoundError:
     DOCMODEL_PATHS_LIST = None
     print('FileNotFoundError on DOCMODELS_PATH, operations requiring to load docmodels will not work')
 
+# SQLite index of DocModel metadata, used to select docs without unpickling them (see utils/dmindex.py)
+DOCMODEL_INDEX_PATH = TEMP_DATA_PATH / 'docmodel_index.sqlite'
+
+# Corpus-wide word/pos/lemma registry used to decode the integer tags stored in DocModels (see utils/tagvocab.py)
+TAG_VOCAB_PATH = TEMP_DATA_PATH / 'tag_vocab.p'
+
+# Source XML of docs ingested in streaming mode, referenced by DocModel.xml_ref (see utils/xmlarchive.py)
+XML_ARCHIVE_PATH = TEMP_DATA_PATH / 'xml_archive'
+
+# Cache of TreeTagger results keyed by paragraph text, reused when re-tagging (see preprocess/tagcache.py)
+TAGGING_CACHE_PATH = TEMP_DATA_PATH / 'tagging_cache.sqlite'
+
+# Lemma lists of the corpus materialized per projection, reused across passes (see utils/lemmastreams.py)
+LEMMA_STREAMS_PATH = TEMP_DATA_PATH / 'lemma_streams'
+
+# Columnar version of the corpus, built from the pickled DocModels (see utils/corpusstore.py)
+CORPUS_STORE_PATH = TEMP_DATA_PATH / 'corpus_store'
+
 TAGCOUNTERS_PATH = ANALYSIS_PATH / 'tagcounters'
 LEXCOUNTS_PATH = ANALYSIS_PATH / 'lexcats'
 COOCS_PATH = ANALYSIS_PATH / 'coocs'
@@ -30,6 +59,9 @@ DOCTYPE_CATS_CSV_PATH = CSV_PATH / 'doctype_cats.csv'
 SECONDARY_SUBJECTS_CSV_PATH = CSV_PATH / 'secondary_subjects.csv'
 
 
+# Worker processes used to load DocModels in the exec scripts (see utils/parallel.py), None to run sequentially
+N_WORKERS = None
+
 RND_SEED = 2112
 
 TOPIC_MAPPING = {'topic_0': 'Population-region',
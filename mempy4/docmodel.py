@@ -9,18 +9,120 @@ DocModel functions must be adjusted depending on the xml format(s)
 
 import pickle
 import os
+from pathlib import Path
+import numpy as np
 import treetaggerwrapper
 #import itertools
 #from spacy.lang.en import English
 
 # from mempy3.config import DOCMODELS_PATH
 from mempy4.config import *
+from mempy4.utils.tagvocab import get_tag_vocab, persist_tag_vocab
+from mempy4.utils.tokenview import TokenView
+from mempy4.preprocess.tagging import batch_treetag_paragraphs
+from mempy4.utils.xmlarchive import read_xml_tree
+
+# Attributes saved apart from the header when pickling with split=True, grouped by payload file
+PAYLOADS = {
+    'tree': ('tree',),
+    'raw': ('raw_text_paragraphs', 'raw_abs_paragraphs'),
+    'tt': ('tt_text_paragraphs', 'tt_abs_paragraphs', 'tt_text_sentences', 'tt_abs_sentences'),
+}
+PAYLOAD_ATTRS = {attr: payload for payload, attrs in PAYLOADS.items() for attr in attrs}
+
+# Metadata fields read from the text of <bibl> children: {attribute: bibl child tag}
+BIBL_FIELDS = {'year': 'pubdate', 'source': 'source', 'issn': 'issn', 'url': 'url', 'volume': 'volume',
+               'issue': 'issue', 'page': 'fpage'}
+
+
+def extract_metadata_from_root(root):
+    """Extracts all metadata fields from the root element of a doc, walking each subtree once
+
+    Same values as the individual DocModel.extract_x methods, including 'error' placeholders. Returns a dict of fields
+    (named as the DocModel attributes) and a list of error messages, instead of printing them.
+    """
+
+    fields = {}
+    errors = []
+
+    try:
+        fields['id'] = root[0].text
+    except Exception:
+        fields['id'] = 'error'
+        errors.append('Error extracting id')
+
+    # Direct children of <fm> and <bibl>, first occurrence of each tag (same as find())
+    try:
+        fm = root[2]
+        fm_children = {}
+        for child in fm:
+            fm_children.setdefault(child.tag, child)
+    except Exception:
+        fm, fm_children = None, {}
+    try:
+        bibl_children = {}
+        for child in fm[1]:
+            bibl_children.setdefault(child.tag, child)
+    except Exception:
+        bibl_children = None
+
+    try:
+        fields['doctype'] = fm[0].text.lower().strip()
+    except Exception:
+        fields['doctype'] = 'error'
+        errors.append('Error extracting doctype')
+
+    try:
+        fields['title'] = ''.join(fm_children['bibl'].find('title')[0].itertext())
+    except Exception:
+        fields['title'] = 'error'
+        errors.append('Error extracting title')
+
+    for attr, tag in BIBL_FIELDS.items():
+        try:
+            fields[attr] = bibl_children[tag].text.lower().strip()
+        except Exception:
+            fields[attr] = 'error'
+            errors.append(f'Error extracting {tag}')
+
+    try:
+        fields['doi'] = None
+        for pubid in bibl_children['xrefbib'].iter('pubid'):
+            if pubid.attrib['idtype'] == 'doi':
+                fields['doi'] = pubid.text.lower().strip()
+    except Exception:
+        fields['doi'] = 'error'
+        errors.append('Error extracting doi')
+
+    try:
+        fields['authors'] = [(au.find('snm').text, au.find('fnm').text)
+                             for au in bibl_children['aug'].iter('au')
+                             if (au.find('snm') is not None) and (au.find('fnm') is not None)]
+    except Exception:
+        fields['authors'] = []
+        errors.append('Error extracting authors')
+
+    try:
+        fields['collab'] = fm_children['cpyrt'].find('collab').text.strip().split(';')[0]
+    except Exception:
+        fields['collab'] = 'error'
+        errors.append('Error extracting collab')
+
+    try:
+        fields['keywords'] = [kwd.text.lower() for kwd in fm_children['kwdg'].iter('kwd')]
+    except Exception:
+        # Most docs have no keywords, not logged
+        fields['keywords'] = []
+
+    return fields, errors
 
 
 class DocModel:
     def __init__(self, origin_file, tree, save_path, save_on_init=True, extract_metadata_on_init=True):
         # file data
         self.tree = tree
+        # (archive filename, offset, length) of the source XML of streamed docs, see utils/xmlarchive.py
+        self.xml_ref = None
         self.origin_file = origin_file
         self.filename = origin_file[:-4] + '.p'
         self.file_path = save_path / self.filename
@@ -52,9 +154,12 @@ class DocModel:
         self.raw_text_paragraphs = None
         self.raw_abs_paragraphs = None
 
-        # tt
+        # tt, stored as one uint32 array of (word, pos, lemma) ids per paragraph, see utils/tagvocab.py
         self.tt_text_paragraphs = None
         self.tt_abs_paragraphs = None
+        # (start, end) token indexes of each sentence, computed when tags are set, see set_section_tags
+        self.tt_text_sentences = None
+        self.tt_abs_sentences = None
 
         # others
         self.log = {}
@@ -109,21 +214,40 @@ class DocModel:
     def get_text_tags(self, flatten=False):
         """Get text tags as 2d list [[para1 Tags], [para2 Tags], ...]"""
 
-        return self.tt_text_paragraphs if not flatten else sum(self.tt_text_paragraphs, [])
+        return self._decode_tag_paragraphs(self.tt_text_paragraphs, flatten)
 
     def get_abs_tags(self, flatten=False):
         """Get abstract tags as 2d list [[para1 Tags], [para2 Tags], ...]"""
 
-        return self.tt_abs_paragraphs if not flatten else sum(self.tt_abs_paragraphs, [])
+        return self._decode_tag_paragraphs(self.tt_abs_paragraphs, flatten)
+
+    def get_text_tokens(self):
+        """Get text tags as a TokenView, with flat, paragraph and sentence access (see utils/tokenview.py)"""
+
+        return TokenView.from_paragraphs(self.tt_text_paragraphs, sent_bounds=getattr(self, 'tt_text_sentences', None))
+
+    def get_abs_tokens(self):
+        """Get abstract tags as a TokenView, with flat, paragraph and sentence access (see utils/tokenview.py)"""
+
+        return TokenView.from_paragraphs(self.tt_abs_paragraphs, sent_bounds=getattr(self, 'tt_abs_sentences', None))
+
+    def get_text_tag_ids(self, flatten=False):
+        """Get text tags as a list of (n_tags, 3) id arrays, one per paragraph, or a single array if flatten"""
+
+        return self._encoded_tag_paragraphs(self.tt_text_paragraphs, flatten)
+
+    def get_abs_tag_ids(self, flatten=False):
+        """Get abstract tags as a list of (n_tags, 3) id arrays, one per paragraph, or a single array if flatten"""
+
+        return self._encoded_tag_paragraphs(self.tt_abs_paragraphs, flatten)
 
     def get_text_sentences_tags(self, *args, **kwargs):
-        s = []
-        for tag in self.get_text_tags(flatten=True):
-            if tag.pos != 'SENT':
-                s.append(tag)
-            else:
-                yield s
-                s = []
+        for sentence in self.get_text_tokens().sentences():
+            yield sentence.tags()
+
+    def get_abs_sentences_tags(self, *args, **kwargs):
+        for sentence in self.get_abs_tokens().sentences():
+            yield sentence.tags()
 
     ### Extractors ###
 
@@ -209,20 +333,17 @@ class DocModel:
             # print(f'Error updating keywords on {self.id}')
 
     def extract_all_metadata(self):
-        self.extract_id()
-        self.extract_year()
-        self.extract_title()
-        self.extract_source()
-        self.extract_doctype()
-        self.extract_issn()
-        self.extract_url()
-        self.extract_volume()
-        self.extract_issue()
-        self.extract_page()
-        self.extract_doi()
-        self.extract_authors()
-        self.extract_collab()
-        self.extract_keywords()
+        """Extracts all metadata fields in a single pass over the tree. Errors are logged in self.log['metadata']."""
+
+        try:
+            root = self.tree.getroot()
+        except Exception:
+            root = None
+        fields, errors = extract_metadata_from_root(root)
+        if fields['id'] != self.id and fields['id'] != 'error':
+            errors.append(f'id mismatch on doc from {self.origin_file}, using xml id')
+        self.__dict__.update(fields)
+        self.log['metadata'] = errors
 
     def extract_citation(self, max_authors=3):
         try:
@@ -271,11 +392,11 @@ class DocModel:
     def extract_text(self, trash_sections):
         self.raw_text_paragraphs = self.extract_content_paragraphs('bdy', trash_sections)
 
-    def treetag_abstract(self, tagger):
-        self.tt_abs_paragraphs = self.treetag_paragraphs(self.raw_abs_paragraphs, tagger)
+    def treetag_abstract(self, tagger, cache=None, max_chars=0):
+        self.set_section_tags('abs', self.treetag_paragraphs(self.raw_abs_paragraphs, tagger, cache, max_chars))
 
-    def treetag_text(self, tagger):
-        self.tt_text_paragraphs = self.treetag_paragraphs(self.raw_text_paragraphs, tagger)
+    def treetag_text(self, tagger, cache=None, max_chars=0):
+        self.set_section_tags('text', self.treetag_paragraphs(self.raw_text_paragraphs, tagger, cache, max_chars))
 
     ### work and process methods ###
 
@@ -309,14 +430,55 @@ class DocModel:
     # Process chaque paragraphe avec TreeTagger pour les transformer en listes de tags
     # Prend une liste [str, str, str,str]
     # Retourne une liste [ [tag, tag, tag], [tag, tag, tag] ]
-    def treetag_paragraphs(self, paragraphs, tagger):
+    # Chaque paragraphe est tagge seul par defaut. Si max_chars > 0, les paragraphes sont envoyes en lot a TreeTagger
+    # (jusqu'a max_chars caracteres par lot, ex. tagging.MAX_BATCH_CHARS), les tags en debut de paragraphe peuvent alors
+    # changer, voir preprocess/tagging.py
+    # Si un TaggingCache est passe, les paragraphes deja tagges n'y sont pas renvoyes, voir preprocess/tagcache.py
+    def treetag_paragraphs(self, paragraphs, tagger, cache=None, max_chars=0):
+        vocab = get_tag_vocab()
         try:
-            tt_tags = [treetaggerwrapper.make_tags(tagger.tag_text(para.lower()), exclude_nottags=True) for para in paragraphs]
+            tt_tags = [vocab.encode_tags(tags)
+                       for tags in batch_treetag_paragraphs(paragraphs, tagger, max_chars, cache=cache)]
         except:
             print(f'Treetagging error on id: {self.id}')
             tt_tags = []
         return tt_tags
 
+    def encode_tags(self):
+        """Converts tags from older DocModels (lists of Tag namedtuples) to id arrays. Save the tag vocab afterwards."""
+
+        self.set_section_tags('text', self._encoded_tag_paragraphs(self.tt_text_paragraphs))
+        self.set_section_tags('abs', self._encoded_tag_paragraphs(self.tt_abs_paragraphs))
+
+    def set_section_tags(self, section, tt_paragraphs):
+        """Sets the tags of a section ('text' or 'abs') and computes its sentence bounds. Always set tags this way."""
+
+        setattr(self, f'tt_{section}_paragraphs', tt_paragraphs)
+        bounds = TokenView.from_paragraphs(tt_paragraphs).sentence_bounds()
+        setattr(self, f'tt_{section}_sentences', bounds.astype(np.uint32))
+
+    @staticmethod
+    def _decode_tag_paragraphs(paragraphs, flatten=False):
+        """Decodes id arrays to lists of Tags. Paragraphs from older DocModels are already Tags and are returned as is."""
+
+        if paragraphs and isinstance(paragraphs[0], np.ndarray):
+            tokens = TokenView.from_paragraphs(paragraphs)
+            if flatten:
+                return tokens.tags()
+            return [para.tags() for para in tokens.paragraphs()]
+        return paragraphs if not flatten else [tag for para in paragraphs for tag in para]
+
+    @staticmethod
+    def _encoded_tag_paragraphs(paragraphs, flatten=False):
+        """Returns paragraphs as id arrays, encoding them first if they are from an older DocModel"""
+
+        if paragraphs and not isinstance(paragraphs[0], np.ndarray):
+            vocab = get_tag_vocab()
+            paragraphs = [vocab.encode_tags(para) for para in paragraphs]
+        if flatten:
+            return np.concatenate(paragraphs) if paragraphs else np.empty((0, 3), dtype=np.uint32)
+        return paragraphs
+
     def _bibl_metadata_extractor(self, tag: str):
         try:
             return self.tree.getroot()[2][1].find(tag).text.lower().strip()
@@ -324,10 +486,86 @@ class DocModel:
             print(f'Error extracting {tag} on doc {self.id}')
             return 'error'
 
-    def to_pickle(self, destination=None):
+    ### Persistence ###
+
+    # Header/payload split: with split=True, the pickle at file_path only holds the metadata (the header), while the
+    # tree, raw text and tags are saved in DOCMODEL_PAYLOADS_PATH. Payloads missing from a loaded header are read when
+    # first accessed, through __getattr__, so metadata-only passes never read them.
+    def to_pickle(self, destination=None, split=None):
+        """Pickles the DocModel. If split is None, keeps the format the DocModel was loaded from.
+
+        Split DocModels can only be saved at their file_path: payloads are named after the doc's filename, saving the
+        header elsewhere would overwrite the payloads of the original doc. Tag values registered since the tag vocab
+        was last saved are logged first, so the tags can be decoded in later runs (see tagvocab.persist_tag_vocab).
+        """
+
         save_to = destination if destination else self.file_path
+        split = getattr(self, 'split_payloads', False) if split is None else split
+        assert not (split and destination and Path(destination) != Path(self.file_path)), \
+            'Error, split DocModels can only be saved at their file_path, save with split=False to copy them'
+        persist_tag_vocab()
+
+        if split:
+            for payload, attrs in PAYLOADS.items():
+                # Payloads that were never loaded are unchanged on disk. Partly set payloads (e.g. text tags set by
+                # treetag_text on a header only DocModel) are completed from disk, so the other attrs are not lost.
+                loaded = [attr in self.__dict__ for attr in attrs]
+                if any(loaded) and not self._is_archived(payload):
+                    if not all(loaded):
+                        self._load_payload(payload, keep_loaded=True)
+                    pickle.dump({attr: self.__dict__.get(attr) for attr in attrs},
+                                open(self._payload_path(payload), 'wb'))
+        else:
+            self.load_payloads()
+        self.split_payloads = split
         pickle.dump(self, open(save_to, 'wb'))
 
+    def load_payloads(self):
+        """Loads all payloads not already loaded"""
+
+        if self.__dict__.get('split_payloads'):
+            for payload, attrs in PAYLOADS.items():
+                if not all(attr in self.__dict__ for attr in attrs) and not self._is_archived(payload):
+                    self._load_payload(payload)
+
+    def _is_archived(self, payload):
+        # The tree of streamed docs is read back from the xml archive instead, and never pickled
+        return payload == 'tree' and bool(self.__dict__.get('xml_ref'))
+
+    def _payload_path(self, payload):
+        return DOCMODEL_PAYLOADS_PATH / f'{self.filename[:-2]}_{payload}.p'
+
+    def _load_payload(self, payload, keep_loaded=False):
+        """Loads the attrs of a payload from disk. If keep_loaded, attrs already set are not overwritten."""
+
+        try:
+            values = pickle.load(open(self._payload_path(payload), 'rb'))
+        except FileNotFoundError:
+            print(f'Error loading {payload} payload on doc {self.__dict__.get("id")}')
+            values = {}
+        for attr in PAYLOADS[payload]:
+            if not (keep_loaded and attr in self.__dict__):
+                self.__dict__[attr] = values.get(attr)
+
+    def __getattr__(self, name):
+        # Only called when name is not found the usual way, i.e. for payloads not loaded yet
+        if name == 'tree' and self.__dict__.get('xml_ref'):
+            self.__dict__['tree'] = read_xml_tree(self.__dict__['xml_ref'])
+            return self.__dict__['tree']
+        if name in PAYLOAD_ATTRS and self.__dict__.get('split_payloads'):
+            self._load_payload(PAYLOAD_ATTRS[name])
+            return self.__dict__[name]
+        raise AttributeError(f"'DocModel' object has no attribute '{name}'")
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if state.get('split_payloads'):
+            for attr in PAYLOAD_ATTRS:
+                state.pop(attr, None)
+        if state.get('xml_ref'):
+            state.pop('tree', None)
+        return state
+
     def __str__(self):
         return f'DocModel {self.id} - {self.title}'
 
@@ -356,8 +594,17 @@ class DocModel:
         return pickle.load(open(path, 'rb'))
 
     @classmethod
-    def docmodel_generator(cls, path, vocal=True, conditions=None):
-        for i, filename in enumerate(os.listdir(path)):
+    def docmodel_generator(cls, path, vocal=True, conditions=None, query=None):
+        """Yields DocModels from a directory. A query (see DocModelIndex.query) selects files before opening them."""
+
+        filenames = os.listdir(path)
+        if query is not None:
+            from mempy4.utils.dmindex import DocModelIndex
+            with DocModelIndex() as index:
+                selected = set(index.query(**query))
+            filenames = [filename for filename in filenames if filename in selected]
+
+        for i, filename in enumerate(filenames):
             with open(path / filename, 'rb') as f:
                 try:
                     dm = pickle.load(f)
@@ -1,20 +1,25 @@
-from mempy4.utils.generators import generate_ids_lemmas
+from mempy4.utils.generators import generate_ids_lemmas, generate_docmodels_from_sources, select_doc_sources
 from mempy4.utils.timer import Timer
-from mempy4.config import COOCS_PATH, DOCMODEL_PATHS_LIST, LEXICON_CSV_PATH, KMEANS_PATH, RND_SEED, DOCMODELS_PATH, MEMVIZ_DATA_PATH
+from mempy4.utils.metrics import PassMetrics
+from mempy4.utils.fanout import AnalyzerSpec, GroupedCounter, run_map_reduce
+from mempy4.utils.lemmastreams import get_corpus_version
+from mempy4.config import COOCS_PATH, DOCMODEL_PATHS_LIST, LEXICON_CSV_PATH, KMEANS_PATH, RND_SEED, MEMVIZ_DATA_PATH, N_WORKERS
 from mempy4.utils.csvmappings import make_list_mapping_from_csv_path
-from mempy4.nlpparams import TT_NVA_TAGS
-from mempy4.docmodel import DocModel
+from mempy4.utils.filters import tag_pos_in_nva
+from mempy4.utils.parallel import parallel_map
 
-from mempyapi.coocs import CoocsCounter
+from mempyapi.coocs import CoocsCounter, shuffle_ref_ids
 
 from pathlib import Path
 from typing import Optional, Callable, Iterable
 import pandas as pd
-import random
 import pickle
 
 
 WINDOW = 5
+# Set to keep only a seeded sample of refs for each pair while counting (e.g. 20, the number of published samples)
+# instead of all refs. Much lighter on large corpus, but fix_samples_from_cc can then only shuffle the sampled ids.
+REFS_SAMPLE_SIZE = None
 
 
 def run_coocs_on_ids(doc_ids: Iterable[str], group_name: str, window: int, filter_function: Optional[Callable] = None):
@@ -27,23 +32,31 @@ def run_coocs_on_ids(doc_ids: Iterable[str], group_name: str, window: int, filte
 
 
 def update_and_save_cc(cc: CoocsCounter, generator: Iterable, working_dir, group_name):
-    """Iterates through the generator and updates the CoocCounter. Saves the cc and df"""
+    """Iterates through the generator and updates the CoocCounter. Saves the cc and the sparse results (CoocsMatrix)"""
 
     for doc_id, lemmas in generator:
         cc.update(doc_id, lemmas)
 
     print(f'\n\nDone with {group_name}')
+    save_cc(cc, working_dir, group_name)
+
+
+def save_cc(cc: CoocsCounter, working_dir, group_name):
+    """Saves the cc and the sparse results (CoocsMatrix)"""
 
     cc.to_pickle(working_dir / f'coocs_counter_{group_name}.p')
-    cc.as_df().to_pickle(working_dir / f'coocs_df_{group_name}.p')
+    cc.as_matrix().save_npz(working_dir / f'coocs_matrix_{group_name}.npz')
 
 
 def run_coocs_main():
     """Builds, updates and saves a CoocsCounter object for the full corpus and each cluster.
 
     Works on full texts, paragraph by paragraph, only NVA tags (generators.generate_ids_lemmas, flatten=False).
+    Docs are split across N_WORKERS processes, each updating its own counter, then merged (see fanout.run_map_reduce).
     Loads vocab from the lexicon csv (values only, not keys) and calculates cooc values for these words.
-    Calls run_coocs_on_ids on each iteration (once on the whole corpus and once per cluster)
+    All clusters are counted in a single pass, each doc updating the counter of its cluster (fanout.GroupedCounter).
+    The full corpus counter is the merge of the cluster counters.
+    If REFS_SAMPLE_SIZE is set, counters only keep a sample of refs for each pair, seeded with RND_SEED.
 
     Needs to be able to read clusters from sdads
     """
@@ -71,74 +84,133 @@ def run_coocs_main():
     print(f'Loaded clusters, running on whole corpus and {len(n_clusters)} clusters')
 
     print(cluster_series.loc['1471-2121-11-53'])
-    execs = [
-        {'name': f'cluster_{i}',
-         'doc_ids': list(cluster_series[cluster_series == f'cluster_{i}'].index)}
-        for i in range(len(n_clusters))
-    ]
-    execs.append({'name': 'full_corpus', 'doc_ids': list(cluster_series.index)})
-
     timer = Timer()
 
-    for exec in execs:
-        generator = generate_ids_lemmas(DOCMODEL_PATHS_LIST, 'get_text_tags', flatten=False,
-                                        dms_filter_fct=lambda x: x.get_id() in exec['doc_ids'],
-                                        tags_filter_fct=lambda x: x.pos in TT_NVA_TAGS)
-
-        cc = CoocsCounter(vocab, WINDOW)
-        update_and_save_cc(cc, generator, working_dir, exec['name'])
+    metrics = PassMetrics('coocs_clusters')
+    template = CoocsCounter(vocab, WINDOW, REFS_SAMPLE_SIZE, RND_SEED)
+    spec = AnalyzerSpec('clusters', GroupedCounter(template, cluster_series.to_dict()),
+                        'get_text_tags', flatten=False, tags_filter_fct=tag_pos_in_nva)
+    grouped = run_map_reduce(spec, DOCMODEL_PATHS_LIST, doc_ids=list(cluster_series.index), workers=N_WORKERS,
+                             use_streams=True, save=False, metrics=metrics,
+                             corpus_version=get_corpus_version(DOCMODEL_PATHS_LIST))
+    for i in range(len(n_clusters)):
+        save_cc(grouped.counters.get(f'cluster_{i}', template), working_dir, f'cluster_{i}')
+    save_cc(grouped.total(), working_dir, 'full_corpus')
+    metrics.save_json(working_dir / 'pass_metrics.json')
 
     timer.step('All done!')
 
 
-def make_ref_from_para_id(pair, para_id):
-    doc_id, para_num = para_id.split('_')
-    para_num = int(para_num)
-    dm = DocModel.read_pickle(DOCMODELS_PATH / f'{doc_id}.p')
+def make_ref_from_para_id(pair, para_id, path_list=None):
+    return make_refs_from_para_ids({pair: [para_id]}, path_list=path_list)[pair][0]
+
+
+def get_ref_fields(dm, para_nums) -> dict:
+    """Returns the fields of a DocModel used by make_ref
+
+    Only the text of the requested paragraphs is kept, so that little is sent back from the workers.
+    """
 
+    raw_text = dm.get_raw_text()
     return {
-        'id': doc_id,
-        'words': pair,
-        'para_num': para_num,
-        'tot_paras': len(dm.get_raw_text()),
+        'tot_paras': len(raw_text),
         'title': dm.title,
         'source': dm.source,
         'year': dm.year,
         'citation': dm.citation,
-        'para_text': dm.get_raw_text()[para_num],
+        'para_texts': {para_num: raw_text[para_num] for para_num in para_nums},
         'abs_text': dm.get_raw_abs()
     }
 
 
-def fix_samples_from_cc(base_path, file_name: str = 'coocs_counter_full_corpus.p'):
+def read_ref_fields(item) -> list:
+    """Loads the DocModels of a ((path, shard ids), {doc id: paragraph numbers}) item and returns [(doc id, fields used
+    by make_ref)]
 
-    # Fix seed to help reproducibility. Will only work if the same values are passed in the same order, e.g. if
-    # the lexicon doesnt change between runs. If the lexicon changes, used fix_random_after_lex_change to keep previous
-    # order on unchanged values
-    random.seed(RND_SEED)
-    cc = CoocsCounter.read_pickle(base_path / file_name)
+    Sources are DocModel paths or shards, as returned by generators.select_doc_sources.
+    """
 
-    # Uncomment this (and the part in the loop below) to run only on a subset of coocs containing specific words
-    # words = ['mechanism', 'understand', 'explain', 'model', 'theory', 'predict', 'understanding', 'explanation', 'prediction']
+    (path, shard_ids), para_nums = item
+    dms = generate_docmodels_from_sources([(path, shard_ids)])
+    if shard_ids is None:
+        # DocModel files are named after their doc id, see select_doc_sources
+        return [(Path(path).stem, get_ref_fields(dm, para_nums[Path(path).stem])) for dm in dms]
+    return [(dm.get_id(), get_ref_fields(dm, para_nums[dm.get_id()])) for dm in dms]
 
-    shuffled_ids = {}
-    sample_dict = {}
 
-    i = 0
-    for pair, counter in cc.refs.items():
+def make_ref(pair, doc_id, para_num, doc_fields):
+    return {
+        'id': doc_id,
+        'words': pair,
+        'para_num': para_num,
+        'tot_paras': doc_fields['tot_paras'],
+        'title': doc_fields['title'],
+        'source': doc_fields['source'],
+        'year': doc_fields['year'],
+        'citation': doc_fields['citation'],
+        'para_text': doc_fields['para_texts'][para_num],
+        'abs_text': doc_fields['abs_text']
+    }
+
+
+def make_refs_from_para_ids(para_ids_dict: dict, workers: Optional[int] = None, path_list=None) -> dict:
+    """Returns {pair: [make_ref_from_para_id(pair, para_id) for para_id in para_ids]} for a dict {pair: para_ids}
 
-        # Use this to only run on pairs containing certain words. Comment out to run on all coocs.
-        # if not any(word in pair for word in words):
-        #    continue
+    Requests are grouped by doc so each DocModel is loaded once, however many pairs and paragraphs it is sampled for,
+    in a pool of worker processes if workers is set. Docs are found in path_list (DocModel or shard paths, defaults to
+    DOCMODEL_PATHS_LIST) through the metadata index, see generators.select_doc_sources. Docs of a shard are read
+    together.
+    """
 
-        para_ids = list(counter.keys())
-        random.shuffle(para_ids)
-        shuffled_ids[pair] = para_ids
+    para_nums = {}
+    for para_ids in para_ids_dict.values():
+        for para_id in para_ids:
+            doc_id, para_num = para_id.split('_')
+            para_nums.setdefault(doc_id, set()).add(int(para_num))
+    print(f'Loading {len(para_nums)} docs for {sum(len(ids) for ids in para_ids_dict.values())} refs')
+
+    sources = select_doc_sources(DOCMODEL_PATHS_LIST if path_list is None else path_list, doc_ids=para_nums)
+    items = ((source, {doc_id: sorted(para_nums[doc_id]) for doc_id in source[1] or [Path(source[0]).stem]})
+             for source in sources)
+    results = map(read_ref_fields, items) if workers is None else \
+        parallel_map(read_ref_fields, items, workers, ordered=False, prefetch=64 * workers)
+    doc_fields = {}
+    for source_fields in results:
+        for doc_id, fields in source_fields:
+            doc_fields[doc_id] = fields
+            if len(doc_fields) % 5000 == 0:
+                print(f'Loaded {len(doc_fields)} docs')
+    missing = para_nums.keys() - doc_fields.keys()
+    assert not missing, f'Error, {len(missing)} docs not found in the path list: {sorted(missing)[:10]}'
+
+    refs_dict = {}
+    for pair, para_ids in para_ids_dict.items():
+        refs_dict[pair] = []
+        for para_id in para_ids:
+            doc_id, para_num = para_id.split('_')
+            refs_dict[pair].append(make_ref(pair, doc_id, int(para_num), doc_fields[doc_id]))
+    return refs_dict
+
+
+def fix_samples_from_cc(base_path, file_name: str = 'coocs_counter_full_corpus.p', workers: Optional[int] = N_WORKERS,
+                        path_list=None):
+
+    # Fix seed to help reproducibility. Pairs and ids are sorted before the seeded shuffle (see shuffle_ref_ids), so the
+    # same refs give the same samples whatever the number of workers or clusters they were counted with. Samples differ
+    # from those of runs made before this sort. If the lexicon changes, use fix_random_after_lex_change to keep previous
+    # order on unchanged values
+    cc = CoocsCounter.read_pickle(base_path / file_name)
 
-        sample_dict[pair] = [make_ref_from_para_id(pair, para_id) for para_id in para_ids[:20]]
-        i += 1
-        if i % 1000 == 0:
-            print(f'Done with {i} pairs')
+    # Pass this filter to shuffle_ref_ids to only run on a subset of coocs containing specific words
+    # words = ['mechanism', 'understand', 'explain', 'model', 'theory', 'predict', 'understanding', 'explanation', 'prediction']
+    # pair_filter_fct = lambda pair: any(word in pair for word in words)
+
+    # Sampled refs are already in a random order seeded with the counter's random_state
+    shuffled_ids = shuffle_ref_ids(cc.refs, RND_SEED)
+    sampled_ids = {pair: para_ids[:20] for pair, para_ids in shuffled_ids.items()}
+    print(f'Done shuffling the refs of {len(shuffled_ids)} pairs')
+
+    sample_dict = make_refs_from_para_ids(sampled_ids, workers, path_list)
 
     # A dict mapping each cooc tuple to a shuffled list of ids {('mechanism', 'understand'): [id0, id1, ...], ...}
     pickle.dump(shuffled_ids, open(base_path / 'coocs_shuffled_ids_dict.p', 'wb'))
@@ -149,7 +221,8 @@ def fix_samples_from_cc(base_path, file_name: str = 'coocs_counter_full_corpus.p
     return
 
 
-def fix_random_after_lex_change(old_dir_name: str, new_dir_name: str):
+def fix_random_after_lex_change(old_dir_name: str, new_dir_name: str, workers: Optional[int] = N_WORKERS,
+                                path_list=None):
     """Loads 21/11/14 cooc ref ids and a newer version, and reorders the shuffled ids based on the old configuration"""
 
     # NEw ids
@@ -161,15 +234,19 @@ def fix_random_after_lex_change(old_dir_name: str, new_dir_name: str):
     # Samples to update
     r1 = pickle.load(open(COOCS_PATH / new_dir_name / 'coocs_detailed_sample_dict.p', 'rb'))
 
+    updated_keys = []
     for key in d2.keys():
         if key in d1.keys():
             if len(d2[key]) != len(d1[key]):
                 print(f'missmatch on {key}')
             else:
                 d1[key] = d2[key]
-                r1[key] = [make_ref_from_para_id(key, para_id) for para_id in d1[key][:20]]
-                if [v.split('_')[0] for v in d1[key][:20]] != [v['id'] for v in r1[key]]:
-                    print(f'ops on {key} | {d1[key][:20]} | {[v["id"] for v in r1[key]]}')
+                updated_keys.append(key)
+
+    r1.update(make_refs_from_para_ids({key: d1[key][:20] for key in updated_keys}, workers, path_list))
+    for key in updated_keys:
+        if [v.split('_')[0] for v in d1[key][:20]] != [v['id'] for v in r1[key]]:
+            print(f'ops on {key} | {d1[key][:20]} | {[v["id"] for v in r1[key]]}')
 
     pickle.dump(d1, open(COOCS_PATH / new_dir_name / 'coocs_shuffled_ids_dict.p', 'wb'))
     pickle.dump(r1, open(COOCS_PATH / new_dir_name / 'coocs_detailed_sample_dict.p', 'wb'))
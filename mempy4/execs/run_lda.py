@@ -14,7 +14,9 @@ from mempyapi.docterm import DocTermCounter
 from mempyapi.ldatopics import LdaModel
 from mempyapi.tagcounts import TagCounter
 from mempy4.utils.generators import generate_ids_tags
-from mempy4.config import DOCMODEL_PATHS_LIST, LDA_PATH, RND_SEED, TAGCOUNTERS_PATH, BASE_DATA_PATH
+from mempy4.utils.fanout import AnalyzerSpec, run_analyzers
+from mempy4.utils.metrics import PassMetrics
+from mempy4.config import DOCMODEL_PATHS_LIST, LDA_PATH, RND_SEED, TAGCOUNTERS_PATH, BASE_DATA_PATH, N_WORKERS
 from mempy4.utils.filters import tag_pos_in_nva, word_has_no_special_char_base, word_is_min_3_chars
 
 
@@ -31,7 +33,7 @@ def make_abs_docterm():
     max_word_freq = 0.3
 
     dt = DocTermCounter('lemma')
-    for doc_id, tag_list in generate_ids_tags(DOCMODEL_PATHS_LIST, 'get_abs_tags', flatten=True):
+    for doc_id, tag_list in generate_ids_tags(DOCMODEL_PATHS_LIST, 'get_abs_tags', flatten=True, workers=N_WORKERS):
         dt.update(doc_id, tag_list, filter_fct=tag_pos_in_nva)
 
     print(f'Done compiling docterm. Total updates: {dt.total_updates}')
@@ -54,6 +56,52 @@ def make_abs_docterm():
     print('Done!')
 
 
+def make_abs_docterm_single_pass():
+    """Same as make_abs_docterm, but builds the docterm and the tag counter it is filtered on in a single corpus pass
+
+    Both analyzers are fed the same lists (fanout.run_analyzers). The tag counter is saved at
+    [TAGCOUNTERS_PATH / 'abs_lemmas_nva_tagcounter_single_pass.p'] and the docterm at
+    [LDA_PATH / 'docterm_abs_nva_{x}_single_pass.p'], leaving the files used by the existing topic model untouched.
+
+    Coocs are not counted in this pass: they are fed lemma lists per paragraph rather than abstract tags, and are
+    counted across workers then merged (see run_coocs.run_coocs_main and fanout.run_map_reduce).
+    """
+
+    min_word_doc_occs = 50
+    max_word_freq = 0.3
+
+    specs = [
+        AnalyzerSpec('abs_docterm', DocTermCounter('lemma'), 'get_abs_tags', flatten=True,
+                     tags_filter_fct=tag_pos_in_nva),
+        AnalyzerSpec('abs_tagcounter', TagCounter('lemma'), 'get_abs_tags', flatten=True,
+                     tags_filter_fct=tag_pos_in_nva,
+                     save_path=TAGCOUNTERS_PATH / 'abs_lemmas_nva_tagcounter_single_pass.p'),
+    ]
+    metrics = PassMetrics('abs_docterm')
+    counters = run_analyzers(specs, DOCMODEL_PATHS_LIST, workers=N_WORKERS, metrics=metrics)
+    metrics.save_json(LDA_PATH / 'pass_metrics.json')
+    metrics.print_summary()
+    dt, tc = counters['abs_docterm'], counters['abs_tagcounter']
+
+    print(f'Done compiling docterm. Total updates: {dt.total_updates}')
+    print(f'Unique words: {len(dt.unique_words)}')
+    print(f'Filtering out words found in less than {min_word_doc_occs} docs...')
+
+    tc.filter_values(word_has_no_special_char_base)
+    tc.filter_values(word_is_min_3_chars)
+    tc_df = tc.as_df()
+    tc_df = tc_df[(tc_df['article_counts'] >= min_word_doc_occs)
+                  & (tc_df['article_counts'] <= max_word_freq * dt.total_updates)]
+
+    dt.filter_values(lambda x: x in tc_df.index)
+    print(f'Done filtering, kept {len(dt.unique_words)} words')
+    print('Saving docterm model and df...')
+
+    dt.to_pickle(LDA_PATH / f'docterm_abs_nva_{min_word_doc_occs}_single_pass.p')
+    print(dt.as_df(log_norm=True))
+    print('Done!')
+
+
 def make_lda_model():
 
     # with DocTermCounter.read_pickle(LDA_PATH / f'docterm_abs_nva_50.p') as dt:
@@ -5,19 +5,22 @@
     on (full texts, paragraphs, abstracts, etc) and to map each run to a DocModel function to get that data.
 3. Run this script. Enter the exec name when prompted, typically the date as YYMMDD. A 'lex_counts_YYMMDD' dir will be
     created to store the data.
-4. A LexCounter (mempyapi.lexcats) will be created and updated for each EXEC entry. Both the LexCounter and a df
-    representation with merged categories will be saved in the created dir. The df will have the doc ids as index and
-    category names as columns.
+4. A LexCounter (mempyapi.lexcats) will be created and updated for each EXEC entry, all from a single pass over the
+    corpus (see utils/fanout.py). Lemmas are read from lemma streams (see utils/lemmastreams.py), so DocModels are
+    only read on the first run or when the corpus changed. Both the LexCounter and a df representation with merged
+    categories will be saved in the created dir. The df will have the doc ids as index and category names as columns.
 
 tlrd:
 To update the lexical counts with a new lexicon, update the lexicon csv and run this. Tadaa!
 """
 
 from mempy4.utils.generators import generate_ids_lemmas
-from mempy4.utils.timer import Timer
+from mempy4.utils.fanout import AnalyzerSpec, run_analyzers
+from mempy4.utils.lemmastreams import get_corpus_version
+from mempy4.utils.metrics import PassMetrics
 from mempyapi.lexcats import LexCounter
 from mempy4.utils.csvmappings import make_list_mapping_from_csv_path
-from mempy4.config import LEXCOUNTS_PATH, DOCMODEL_PATHS_LIST, LEXICON_CSV_PATH
+from mempy4.config import LEXCOUNTS_PATH, DOCMODEL_PATHS_LIST, LEXICON_CSV_PATH, N_WORKERS
 
 from pathlib import Path
 
@@ -42,7 +45,7 @@ def calc_and_save_lexcats(dm_paths, base_path, lexicon, name, dm_fct, flatten):
 
     lc_save_path = base_path / f'lex_counter_{name}.p'
 
-    generator = generate_ids_lemmas(path_list=dm_paths, function_name=dm_fct, flatten=flatten)
+    generator = generate_ids_lemmas(path_list=dm_paths, function_name=dm_fct, flatten=flatten, workers=N_WORKERS)
     lex_counter = make_and_update_lexcounter(lexicon, generator)
 
     lex_counter.to_pickle(lc_save_path)
@@ -71,10 +74,17 @@ def run_lexcats_main():
     # TODO copy lexicon csv in working dir to keep a history
 
     print('\n\nStarting to process lexcats...')
-    timer = Timer()
-    for params in EXECS:
-        calc_and_save_lexcats(DOCMODEL_PATHS_LIST, working_dir, lexicon, *params)
-        timer.step(f'Done with {params[0]}. ')
+    specs = [
+        AnalyzerSpec(name, LexCounter(lexicon), dm_fct, flatten,
+                     save_path=working_dir / f'lex_counter_{name}.p',
+                     df_path=working_dir / f'lex_cat_counts_{name}_df.p')
+        for name, dm_fct, flatten in EXECS
+    ]
+    metrics = PassMetrics('lexcats')
+    run_analyzers(specs, DOCMODEL_PATHS_LIST, workers=N_WORKERS, use_streams=True, metrics=metrics,
+                  corpus_version=get_corpus_version(DOCMODEL_PATHS_LIST))
+    metrics.save_json(working_dir / 'pass_metrics.json')
+    metrics.print_summary()
 
     print(f'All done!')
 
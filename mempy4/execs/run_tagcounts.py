@@ -2,8 +2,10 @@
 
 from mempyapi.tagcounts import TagCounter
 from mempy4.utils.generators import generate_ids_tags
-from mempy4.config import DOCMODEL_PATHS_LIST, TAGCOUNTERS_PATH
-from mempy4.nlpparams import TT_NVA_TAGS
+from mempy4.utils.fanout import AnalyzerSpec, run_analyzers
+from mempy4.utils.metrics import PassMetrics
+from mempy4.utils.filters import tag_pos_in_nva
+from mempy4.config import DOCMODEL_PATHS_LIST, TAGCOUNTERS_PATH, N_WORKERS
 
 
 def build_tagcount(dm_fct_name, tag_attr='lemma', secondary_attr=None, filter_fct=None, save_name=None):
@@ -11,7 +13,7 @@ def build_tagcount(dm_fct_name, tag_attr='lemma', secondary_attr=None, filter_fc
     print('Building tagcounter...')
     tc = TagCounter(tag_attr, secondary_attr)
 
-    for _, tags in generate_ids_tags(DOCMODEL_PATHS_LIST, dm_fct_name, flatten=True):
+    for _, tags in generate_ids_tags(DOCMODEL_PATHS_LIST, dm_fct_name, flatten=True, workers=N_WORKERS):
         tc.update(tags, filter_fct=filter_fct)
 
     print(f'Done building tagcounter, total updates: {tc.total_updates}')
@@ -21,30 +23,46 @@ def build_tagcount(dm_fct_name, tag_attr='lemma', secondary_attr=None, filter_fc
     return tc
 
 
+def build_tagcounts(specs):
+    """Builds many tagcounters in a single corpus pass
+
+    specs: list of dicts with the build_tagcount kwargs (dm_fct_name, tag_attr, secondary_attr, filter_fct, save_name)
+    """
+
+    analyzer_specs = [
+        AnalyzerSpec(spec['save_name'], TagCounter(spec.get('tag_attr', 'lemma'), spec.get('secondary_attr')),
+                     spec['dm_fct_name'], flatten=True, tags_filter_fct=spec.get('filter_fct'),
+                     save_path=TAGCOUNTERS_PATH / 'vocab_counts' / spec['save_name'])
+        for spec in specs
+    ]
+    metrics = PassMetrics('tagcounts')
+    counters = run_analyzers(analyzer_specs, DOCMODEL_PATHS_LIST, workers=N_WORKERS, metrics=metrics)
+    metrics.save_json(TAGCOUNTERS_PATH / 'vocab_counts' / 'pass_metrics.json')
+    metrics.print_summary()
+    return counters
+
+
 if __name__ == '__main__':
 
-    # Text lemmas with pos, no filter
-    build_tagcount(
-        dm_fct_name='get_text_tags',
-        tag_attr='lemma',
-        secondary_attr='pos',
-        filter_fct=None,
-        save_name='text_lemmas_pos_all_tagcounter.p')
-
-    # Text words with pos, no filter
-    build_tagcount(
-        dm_fct_name='get_text_tags',
-        tag_attr='word',
-        secondary_attr='pos',
-        filter_fct=None,
-        save_name='text_words_pos_all_tagcounter.p')
-
-    # Text lemmas, NVA pos only
-    build_tagcount(
-        dm_fct_name='get_text_tags',
-        tag_attr='lemma',
-        secondary_attr=None,
-        filter_fct=lambda x: x.pos in TT_NVA_TAGS,
-        save_name='text_lemmas_nva_tagcounter.p')
+    build_tagcounts([
+        # Text lemmas with pos, no filter
+        {'dm_fct_name': 'get_text_tags',
+         'tag_attr': 'lemma',
+         'secondary_attr': 'pos',
+         'filter_fct': None,
+         'save_name': 'text_lemmas_pos_all_tagcounter.p'},
 
+        # Text words with pos, no filter
+        {'dm_fct_name': 'get_text_tags',
+         'tag_attr': 'word',
+         'secondary_attr': 'pos',
+         'filter_fct': None,
+         'save_name': 'text_words_pos_all_tagcounter.p'},
 
+        # Text lemmas, NVA pos only
+        {'dm_fct_name': 'get_text_tags',
+         'tag_attr': 'lemma',
+         'secondary_attr': None,
+         'filter_fct': tag_pos_in_nva,
+         'save_name': 'text_lemmas_nva_tagcounter.p'},
+    ])
@@ -1,7 +1,8 @@
 
 
-from mempy4.config import COOCS_PATH
-from mempy4.utils.generators import generate_all_ids_sentences_tags
+from mempy4.config import COOCS_PATH, DOCMODEL_PATHS_LIST
+from mempy4.utils.generators import generate_ids_tags
+from mempy4.utils.metrics import PassMetrics, measure
 from mempy4.utils.filters import tag_pos_is_verb
 from mempyapi.extensions.coocstags import CoocsCounterTags
 
@@ -12,8 +13,12 @@ def make_varb_coocs():
 
     cc = CoocsCounterTags(vocab, window, tag_pos_is_verb)
 
-    for s_id, s in generate_all_ids_sentences_tags():
-        cc.update(s_id, s)
+    metrics = PassMetrics('verbs_coocs')
+    for s_id, s in generate_ids_tags(DOCMODEL_PATHS_LIST, 'get_text_sentences_tags', flatten=False, metrics=metrics):
+        with measure(metrics, 'consumer'):
+            cc.update(s_id, s)
+    metrics.save_json(COOCS_PATH / 'verbs_coocs_pass_metrics.json')
+    metrics.print_summary()
 
     cc.to_pickle(COOCS_PATH / 'verbs_coocs.p')
     df = cc.as_df()
@@ -4,6 +4,9 @@
 TRASH_SECTIONS = ['st', 'tbl', 'display-formula', 'fig', 'file', 'suppl',
                   'table', 'abbr', 'abbrgrp', 'sub', 'ext-link', 'sup', 'tblr']
 
+# Params passed to treetaggerwrapper.TreeTagger when tagger processes are started by the tagging pool
+TREETAGGER_PARAMS = {'TAGLANG': 'en'}
+
 # Treetagger tags unlisted in doc but found in results
 TT_TAGLIST_UNLISTED = [',', '(', ')', "''", '``', '#']
 
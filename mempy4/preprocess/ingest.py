@@ -0,0 +1,266 @@
+"""Parallel ingestion of source XML files into pickled DocModels
+
+Takes a directory of XML files or an archive (zip, tar, tar.gz), and for each doc: parses the XML, extracts metadata,
+abstract and body paragraphs (clearing TRASH_SECTIONS), citation and csv mappings, then pickles the DocModel. Docs are
+spread across a pool of worker processes, only the source bytes are sent to the workers. Each DocModel is written to a
+temp file then renamed, so an interrupted run never leaves partial pickles. The metadata index is updated as docs come
+back. Tagging is a separate stage (see DocModel.treetag_text).
+
+Trees are parsed with xml.etree.ElementTree, as lxml trees can't be pickled with the DocModels.
+
+With streaming=True, each doc is read in a single iterparse pass instead: body and back matter elements are cleared as
+soon as they are parsed, so memory stays flat whatever the size of the doc, and the DocModel doesn't keep the tree. The
+source XML is appended to an archive instead (see utils/xmlarchive.py), and dm.tree is parsed back from it if needed.
+
+Usage:
+>>> failures = ingest_xml_sources(Path('D:/m4temp/xml_sources.zip'), workers=16)
+>>> failures = ingest_xml_sources(Path('D:/m4temp/xml_sources.zip'), workers=16, streaming=True)
+"""
+
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+import io
+import os
+import tarfile
+import xml.etree.ElementTree as ET
+import zipfile
+
+from mempy4.config import DOCMODELS_PATH, DOCTYPE_CATS_CSV_PATH, SECONDARY_SUBJECTS_CSV_PATH
+from mempy4.docmodel import DocModel
+from mempy4.nlpparams import TRASH_SECTIONS
+from mempy4.utils.csvmappings import make_value_mapping_from_csv_path, make_list_mapping_from_csv_path
+from mempy4.utils.dmindex import DocModelIndex
+from mempy4.utils.parallel import parallel_map
+from mempy4.utils.timer import Timer
+from mempy4.utils.xmlarchive import XmlArchiveWriter
+
+# Fields sent back from the workers to update the metadata index
+INDEX_FIELDS = ('id', 'filename', 'year', 'source', 'doctype', 'doctype_cat', 'secondary_subjects')
+# Children of the root element cleared while streaming, everything else is kept for metadata and abstract extraction
+STREAMED_SECTIONS = ('bdy', 'bm')
+
+
+def iter_xml_sources(source: Path):
+    """Yields (filename, xml bytes) for each XML file in a directory or archive (zip, tar, tar.gz)"""
+
+    source = Path(source)
+    if source.is_dir():
+        for filename in sorted(os.listdir(source)):
+            if filename.endswith('.xml'):
+                with open(source / filename, 'rb') as f:
+                    yield filename, f.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for name in archive.namelist():
+                if name.endswith('.xml'):
+                    yield Path(name).name, archive.read(name)
+    else:
+        with tarfile.open(source) as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith('.xml'):
+                    yield Path(member.name).name, archive.extractfile(member).read()
+
+
+def make_docmodel_from_xml(filename: str, data: bytes, save_path: Path, trash_sections=TRASH_SECTIONS,
+                           doctype_cats: Optional[dict] = None, secondary_subjects: Optional[dict] = None) -> DocModel:
+    """Parses an XML doc and returns its DocModel, with metadata, text and abstract extracted (not saved)"""
+
+    tree = ET.ElementTree(ET.fromstring(data))
+    dm = DocModel(filename, tree, save_path, save_on_init=False, extract_metadata_on_init=True)
+    dm.extract_abstract(trash_sections)
+    dm.extract_text(trash_sections)
+    dm.extract_citation()
+    if doctype_cats is not None:
+        dm.extract_doctype_cat(doctype_cats)
+    if secondary_subjects is not None:
+        dm.extract_secondary_subjects(secondary_subjects)
+    return dm
+
+
+def stream_parse_xml(data: bytes, trash_sections=TRASH_SECTIONS, min_para_len: int = 5):
+    """Parses a doc in a single iterparse pass, returns (root element, body paragraphs)
+
+    Elements of STREAMED_SECTIONS are cleared as soon as they are parsed, the returned root only holds the other parts
+    of the doc (ui, ji, fm). Body paragraphs are extracted on the fly, same as
+    DocModel.extract_content_paragraphs('bdy') on the full tree: text in trash sections is skipped (but not their tail)
+    and paragraphs of min_para_len chars or less are dropped. Paragraphs are None if the doc has no body.
+    """
+
+    trash_sections = set(trash_sections)
+    root = None
+    body = None  # First bdy element, the only one extracted (same as tree.find('bdy'))
+    paragraphs = None
+    stack = []  # Open elements, from the root
+    open_paras = []  # (element, index in paragraphs) of the p elements being parsed, outer first
+    n_open_trash = 0
+
+    for event, element in ET.iterparse(io.BytesIO(data), events=('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            elif body is None and len(stack) == 1 and element.tag == 'bdy':
+                body = element
+                paragraphs = []
+            elif body is not None and len(stack) > 1 and stack[1] is body:
+                if element.tag in trash_sections:
+                    n_open_trash += 1
+                elif element.tag == 'p' and not n_open_trash:
+                    # Slot taken on start, so nested paragraphs keep document order, as with iter('p')
+                    open_paras.append((element, len(paragraphs)))
+                    paragraphs.append(None)
+            stack.append(element)
+            continue
+
+        stack.pop()
+        if not stack:
+            continue
+        section = stack[1] if len(stack) > 1 else element
+        if section.tag not in STREAMED_SECTIONS:
+            continue
+
+        if section is body and element is not body:
+            if element.tag in trash_sections:
+                n_open_trash -= 1
+                tail = element.tail
+                element.clear()
+                element.tail = tail
+            elif open_paras and open_paras[-1][0] is element:
+                paragraphs[open_paras.pop()[1]] = ''.join(element.itertext())
+
+        if element is section:
+            element.clear()
+        elif not open_paras:
+            # Done with this element, its text is not needed by any paragraph
+            stack[-1].remove(element)
+
+    if paragraphs is not None:
+        paragraphs = [para for para in paragraphs if len(para) > min_para_len]
+    return root, paragraphs
+
+
+def make_docmodel_streaming(filename: str, data: bytes, save_path: Path, trash_sections=TRASH_SECTIONS,
+                            doctype_cats: Optional[dict] = None, secondary_subjects: Optional[dict] = None,
+                            xml_ref: Optional[tuple] = None) -> DocModel:
+    """Same as make_docmodel_from_xml, from a single streaming pass over the XML (see stream_parse_xml)
+
+    The DocModel doesn't keep its tree: pass the xml_ref of the doc in the xml archive to have dm.tree read back from
+    it when accessed, else dm.tree is None.
+    """
+
+    root, text_paragraphs = stream_parse_xml(data, trash_sections)
+    dm = DocModel(filename, ET.ElementTree(root), save_path, save_on_init=False, extract_metadata_on_init=True)
+    dm.extract_abstract(trash_sections)
+    if text_paragraphs is None:
+        print(f'Error processing bdy on {dm.filename}')
+        text_paragraphs = ['error']
+    dm.raw_text_paragraphs = text_paragraphs or ['no text']
+    dm.extract_citation()
+    if doctype_cats is not None:
+        dm.extract_doctype_cat(doctype_cats)
+    if secondary_subjects is not None:
+        dm.extract_secondary_subjects(secondary_subjects)
+
+    # The tree only holds the non streamed sections, it is not kept
+    dm.xml_ref = xml_ref
+    if xml_ref:
+        del dm.tree
+    else:
+        dm.tree = None
+    return dm
+
+
+def save_docmodel_atomic(dm: DocModel, destination: Optional[Path] = None):
+    """Pickles the DocModel to a temp file, then renames it, so destination is never left half written"""
+
+    destination = Path(destination or dm.file_path)
+    tmp_path = destination.with_name(destination.name + '.tmp')
+    dm.to_pickle(tmp_path)
+    os.replace(tmp_path, destination)
+
+
+def _archive_sources(sources, archive: XmlArchiveWriter):
+    """Appends each source to the xml archive, yields (filename, xml bytes, xml ref)"""
+
+    for filename, data in sources:
+        yield filename, data, archive.add(data)
+
+
+def _ingest_one(source, save_path, trash_sections, doctype_cats, secondary_subjects, streaming):
+    """Worker side of ingest_xml_sources. Returns (filename, index fields, None) or (filename, None, error)"""
+
+    filename, data, *xml_ref = source
+    try:
+        if streaming:
+            dm = make_docmodel_streaming(filename, data, save_path, trash_sections, doctype_cats, secondary_subjects,
+                                         xml_ref[0])
+        else:
+            dm = make_docmodel_from_xml(filename, data, save_path, trash_sections, doctype_cats, secondary_subjects)
+        save_docmodel_atomic(dm)
+        return filename, {field: getattr(dm, field) for field in INDEX_FIELDS}, None
+    except Exception as e:
+        return filename, None, f'{type(e).__name__}: {e}'
+
+
+def ingest_xml_sources(source: Path, save_path: Path = DOCMODELS_PATH, workers: Optional[int] = None,
+                       trash_sections=TRASH_SECTIONS, use_mappings: bool = True, report_every: int = 1000,
+                       streaming: bool = False, archive_name: str = 'xml_sources') -> list:
+    """Makes and saves a DocModel for each XML file of a directory or archive, across a pool of worker processes
+
+    Parameters
+    ----------
+    source: Path
+        Directory or archive (zip, tar, tar.gz) holding the XML files.
+    save_path: Path
+        Directory where DocModels are pickled, defaults to DOCMODELS_PATH.
+    workers: int, optional
+        Number of worker processes, defaults to the number of cores.
+    trash_sections: list[str]
+        XML tags cleared before extracting paragraphs, see nlpparams.TRASH_SECTIONS.
+    use_mappings: bool, default: True
+        Whether to also set doctype_cat and secondary_subjects from the csv mappings.
+    report_every: int
+        Prints progress every report_every docs.
+    streaming: bool, default: False
+        Whether to extract docs in a single streaming pass, without keeping their trees (see stream_parse_xml).
+    archive_name: str
+        Name of the xml archive the source XML is appended to in streaming mode, in XML_ARCHIVE_PATH.
+
+    Returns
+    -------
+    list[tuple[str, str]]
+        (filename, error message) for each doc that could not be ingested.
+    """
+
+    Path(save_path).mkdir(parents=True, exist_ok=True)
+    doctype_cats = make_value_mapping_from_csv_path(DOCTYPE_CATS_CSV_PATH) if use_mappings else None
+    secondary_subjects = make_list_mapping_from_csv_path(SECONDARY_SUBJECTS_CSV_PATH) if use_mappings else None
+    ingest_fct = partial(_ingest_one, save_path=save_path, trash_sections=trash_sections,
+                         doctype_cats=doctype_cats, secondary_subjects=secondary_subjects, streaming=streaming)
+    archive = XmlArchiveWriter(archive_name) if streaming else None
+    sources = _archive_sources(iter_xml_sources(source), archive) if streaming else iter_xml_sources(source)
+
+    timer = Timer()
+    failures = []
+    n_done = 0
+    try:
+        with DocModelIndex() as index:
+            for filename, fields, error in parallel_map(ingest_fct, sources, workers, ordered=False):
+                n_done += 1
+                if error is None:
+                    index.update(SimpleNamespace(**fields))
+                else:
+                    failures.append((filename, error))
+                if n_done % report_every == 0:
+                    rate = n_done / max(timer.get_run_time().total_seconds(), 1e-9)
+                    print(f'Ingested {n_done} docs ({rate:.1f} docs/s), {len(failures)} failures')
+                    index.commit()
+    finally:
+        if archive is not None:
+            archive.close()
+
+    timer.step(f'Done ingesting {n_done} docs, {len(failures)} failures.')
+    for filename, error in failures:
+        print(f'Failed: {filename} - {error}')
+    return failures
@@ -0,0 +1,174 @@
+"""Persistent cache of TreeTagger results, keyed by paragraph text
+
+Most paragraphs are unchanged when the text extraction (e.g. TRASH_SECTIONS) is tweaked and the corpus is re-extracted,
+so their tags can be reused instead of running TreeTagger again. Entries are keyed by a hash of the tagger params, the
+tagging mode and the lowercased paragraph, and stored in a SQLite database. Paragraphs tagged in batches (see
+preprocess/tagging.py) get TreeTagger context from the previous paragraph, so their tags are cached apart from the tags
+of paragraphs tagged one by one. When the cache grows over max_bytes, the least recently used
+entries are evicted. Hits and misses are counted to check how much tagging was saved.
+
+>>> with TaggingCache(tagger_params=TREETAGGER_PARAMS) as cache:
+...     dm.treetag_text(tagger, cache=cache)
+...     print(cache.stats())
+
+The tagger used with a cache must be started with the same params (see TaggingCache.check_tagger).
+"""
+
+from pathlib import Path
+from typing import Iterable, Optional
+import hashlib
+import os
+import pickle
+import sqlite3
+
+import treetaggerwrapper
+
+from mempy4.config import TAGGING_CACHE_PATH
+from mempy4.nlpparams import TREETAGGER_PARAMS
+
+
+class TaggingCache:
+    """SQLite cache mapping paragraphs to their tags
+
+    Attributes
+    ----------
+    tagger_params: dict
+        Params of the tagger (as passed to treetaggerwrapper.TreeTagger) the cached tags are made with.
+    tagger_config: str
+        Repr of tagger_params, part of every key so tags made with different tagger params are never reused.
+    max_bytes: int
+        Max total size of the cached tags. Least recently used entries are evicted down to 90% of it when exceeded.
+    hits, misses, evictions: int
+        Stats since the cache was opened.
+    """
+
+    def __init__(self, path: Path = TAGGING_CACHE_PATH, tagger_params: dict = TREETAGGER_PARAMS,
+                 max_bytes: int = 20 * 1024 ** 3):
+        self.path = path
+        self.tagger_params = dict(tagger_params)
+        self.tagger_config = repr(sorted(self.tagger_params.items()))
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS tags (key BLOB PRIMARY KEY, tags BLOB, size INTEGER, last_used INTEGER);
+            CREATE INDEX IF NOT EXISTS tags_last_used ON tags (last_used);
+        ''')
+        self.total_bytes, last_used = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM tags').fetchone()
+        # Access counter used as LRU clock
+        self._clock = last_used
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM tags').fetchone()[0]
+
+    def make_key(self, paragraph: str, batched: bool = False) -> bytes:
+        mode = 'batched' if batched else 'paragraph'
+        return hashlib.sha1(f'{self.tagger_config}\0{mode}\0{paragraph.lower()}'.encode('utf-8')).digest()
+
+    def check_tagger(self, tagger):
+        """Asserts that the tagger was started with tagger_params, so its tags can be cached with them"""
+
+        mismatches = []
+        for name, attr in [('TAGLANG', 'lang'), ('TAGOPT', 'tagopt'), ('TAGPARFILE', 'tagparfile')]:
+            expected = self.tagger_params.get(name, 'en' if name == 'TAGLANG' else None)
+            if expected is None or not hasattr(tagger, attr):
+                continue
+            value = getattr(tagger, attr)
+            if name == 'TAGPARFILE':
+                # The tagger resolves the param file to its full path
+                value, expected = os.path.basename(value), os.path.basename(expected)
+            if value != expected:
+                mismatches.append(name)
+        assert not mismatches, f'Error, the tagger and the tagging cache have different {", ".join(mismatches)}'
+
+    def _select(self, columns: str, keys: list[bytes]) -> dict:
+        """Returns {key: row} for the keys found, selected in batches of up to 500 keys"""
+
+        rows = {}
+        for beg in range(0, len(keys), 500):
+            batch = keys[beg:beg + 500]
+            query = f'SELECT key, {columns} FROM tags WHERE key IN ({", ".join("?" * len(batch))})'
+            rows.update((row[0], row[1:]) for row in self.connection.execute(query, batch))
+        return rows
+
+    def get_many(self, paragraphs: Iterable[str], batched: bool = False) -> list[Optional[list]]:
+        """Returns the cached Tag list of each paragraph, or None for paragraphs not in the cache
+
+        Set batched to get the tags of paragraphs tagged in batches (see tagging.batch_treetag_paragraphs).
+        """
+
+        keys = [self.make_key(para, batched) for para in paragraphs]
+        rows = self._select('tags', list(set(keys)))
+        results = []
+        used = []
+        for key in keys:
+            row = rows.get(key)
+            if row is None:
+                self.misses += 1
+                results.append(None)
+            else:
+                self.hits += 1
+                self._clock += 1
+                used.append((self._clock, key))
+                results.append([treetaggerwrapper.Tag(*tag) for tag in pickle.loads(row[0])])
+        self.connection.executemany('UPDATE tags SET last_used = ? WHERE key = ?', used)
+        return results
+
+    def put_many(self, paragraphs: Iterable[str], tagged: Iterable[list], batched: bool = False):
+        """Caches the Tag list of each paragraph, then evicts old entries if the cache is over max_bytes
+
+        Set batched if the paragraphs were tagged in batches (see tagging.batch_treetag_paragraphs).
+        """
+
+        rows = {}
+        for para, tags in zip(paragraphs, tagged):
+            data = pickle.dumps([tuple(tag) for tag in tags], protocol=pickle.HIGHEST_PROTOCOL)
+            self._clock += 1
+            key = self.make_key(para, batched)
+            rows[key] = (key, data, len(data), self._clock)
+        rows = list(rows.values())
+
+        replaced = self._select('size', [row[0] for row in rows])
+        self.total_bytes -= sum(size for size, in replaced.values())
+        self.connection.executemany('INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?)', rows)
+        self.total_bytes += sum(row[2] for row in rows)
+
+        if self.total_bytes > self.max_bytes:
+            self._evict(int(0.9 * self.max_bytes))
+        self.connection.commit()
+
+    def _evict(self, target_bytes: int):
+        """Deletes least recently used entries until the cache is under target_bytes"""
+
+        to_delete = []
+        for key, size in self.connection.execute('SELECT key, size FROM tags ORDER BY last_used'):
+            if self.total_bytes <= target_bytes:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany('DELETE FROM tags WHERE key = ?', to_delete)
+        self.evictions += len(to_delete)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+            'evictions': self.evictions,
+            'total_bytes': self.total_bytes,
+        }
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,232 @@
+"""Batched TreeTagger tagging
+
+Each tag_text() call is a round trip to the TreeTagger process, which costs more than tagging itself for short
+paragraphs. Here, many paragraphs (from one or many docs) are joined with a sentinel SGML tag and sent in a single
+tag_text() call. TreeTagger passes SGML tags through untouched, so the output is split back on the sentinel lines.
+If the number of sentinels found does not match (e.g. a paragraph contains broken markup), the batch is tagged
+paragraph by paragraph instead.
+
+TreeTagger's context is not reset at the sentinels, so tags at the start of a paragraph can differ from tagging it
+alone (see batch_treetag_paragraphs). Batching is opt-in: DocModels are tagged paragraph by paragraph (max_chars=0,
+same tags as before batching) unless max_chars is set, e.g. to MAX_BATCH_CHARS.
+
+>>> for dm in treetag_docmodels(generate_docmodels_from_paths(paths), tagger, max_chars=MAX_BATCH_CHARS):
+...     dm.to_pickle()
+
+treetag_docmodels_parallel() does the same across a pool of worker processes, each running its own TreeTagger.
+
+All functions take an optional TaggingCache (see tagcache.py): cached paragraphs are not sent to TreeTagger, and newly
+tagged paragraphs are added to the cache. Batched and paragraph by paragraph tags are cached apart.
+"""
+
+from functools import partial
+from typing import Iterable, Optional
+
+import treetaggerwrapper
+
+from mempy4.nlpparams import TREETAGGER_PARAMS
+from mempy4.utils.parallel import parallel_map
+from mempy4.utils.tagvocab import get_tag_vocab
+
+SENTINEL = '<mempyparabreak/>'
+# Max number of characters sent in a single tag_text() call
+MAX_BATCH_CHARS = 200000
+
+
+def _tag_batch(paragraphs: list[str], tagger) -> list[list]:
+    """Tags a list of (lowercase) paragraphs in a single tag_text call, returns a list of Tag lists"""
+
+    if not paragraphs:
+        return []
+
+    lines = tagger.tag_text(f'\n{SENTINEL}\n'.join(paragraphs))
+    chunks = [[]]
+    for line in lines:
+        if line.strip() == SENTINEL:
+            chunks.append([])
+        else:
+            chunks[-1].append(line)
+
+    if len(chunks) != len(paragraphs):
+        return [treetaggerwrapper.make_tags(tagger.tag_text(para), exclude_nottags=True) for para in paragraphs]
+    return [treetaggerwrapper.make_tags(chunk, exclude_nottags=True) for chunk in chunks]
+
+
+def batch_treetag_paragraphs(paragraphs: Iterable[str], tagger, max_chars: int = MAX_BATCH_CHARS,
+                             cache=None) -> list[list]:
+    """Tags paragraphs (lowercased first) with as few tag_text calls as possible
+
+    Returns a list holding a list of Tags for each paragraph. Tags can differ slightly from tagging each paragraph
+    separately: TreeTagger's context carries over the sentinel, so the first tokens of a paragraph can be tagged
+    differently when the previous paragraph doesn't end with a sentence boundary. Tag paragraphs one by one (e.g.
+    max_chars=0) where exact per-paragraph results matter.
+    If a TaggingCache is passed, only the paragraphs missing from the cache are tagged. The tagger must have been
+    started with the cache's tagger params.
+    """
+
+    if cache is not None:
+        cache.check_tagger(tagger)
+        paragraphs = list(paragraphs)
+        tagged = cache.get_many(paragraphs, batched=max_chars > 0)
+        misses = [i for i, tags in enumerate(tagged) if tags is None]
+        if misses:
+            missed_paragraphs = [paragraphs[i] for i in misses]
+            missed_tagged = batch_treetag_paragraphs(missed_paragraphs, tagger, max_chars)
+            cache.put_many(missed_paragraphs, missed_tagged, batched=max_chars > 0)
+            for i, tags in zip(misses, missed_tagged):
+                tagged[i] = tags
+        return tagged
+
+    tagged = []
+    batch = []
+    batch_chars = 0
+    for para in paragraphs:
+        if batch and batch_chars + len(para) > max_chars:
+            tagged += _tag_batch(batch, tagger)
+            batch, batch_chars = [], 0
+        batch.append(para.lower())
+        batch_chars += len(para)
+    tagged += _tag_batch(batch, tagger)
+    return tagged
+
+
+def treetag_docmodels(dms: Iterable, tagger, sections: tuple = ('text', 'abs'), max_chars: int = 0,
+                      cache=None, vocal: bool = True):
+    """Tags the raw paragraphs of many DocModels, in shared batches if max_chars is set, yields each DocModel once its
+    tags are set
+
+    Drop-in for calling treetag_text and treetag_abstract on each DocModel (with the same max_chars). sections can
+    include 'text' (raw_text -> tt_text) and 'abs' (raw_abs -> tt_abs). DocModels are not saved. New tag values are logged when they are (see
+    DocModel.to_pickle), save the tag vocab when done to compact the log (see tagvocab.save_tag_vocab).
+    """
+
+    vocab = get_tag_vocab()
+    pending = []  # (dm, section, raw paragraphs)
+    paragraphs = []
+    n_done = 0
+
+    def flush():
+        nonlocal n_done
+        try:
+            tagged = batch_treetag_paragraphs(paragraphs, tagger, max_chars, cache)
+            i = 0
+            for dm, section, raw in pending:
+                dm.set_section_tags(section, [vocab.encode_tags(tags) for tags in tagged[i:i + len(raw)]])
+                i += len(raw)
+        except Exception:
+            # Retag doc by doc, so a single bad doc doesn't fail the whole batch
+            for dm, section, raw in pending:
+                dm.set_section_tags(section, dm.treetag_paragraphs(raw, tagger, cache))
+
+        done_dms = list(dict.fromkeys(dm for dm, _, _ in pending))
+        pending.clear()
+        paragraphs.clear()
+        if vocal and (n_done + len(done_dms)) // 5000 > n_done // 5000:
+            print(f'Tagged {n_done + len(done_dms)} docmodels')
+        n_done += len(done_dms)
+        return done_dms
+
+    batch_chars = 0
+    for dm in dms:
+        for section in sections:
+            raw = getattr(dm, f'raw_{section}_paragraphs') or []
+            pending.append((dm, section, raw))
+            paragraphs.extend(raw)
+            batch_chars += sum(len(para) for para in raw)
+        if batch_chars >= max_chars:
+            yield from flush()
+            batch_chars = 0
+    if pending:
+        yield from flush()
+
+
+# Tagger of the current worker process, started when the worker tags its first doc
+_worker_tagger = None
+
+
+def _tag_doc_in_worker(item, tagger_params, retries, max_chars):
+    """Worker side of treetag_docmodels_parallel. Returns (key, {section: tags as tuples}, error)"""
+
+    global _worker_tagger
+    key, doc_id, raw_sections = item
+    error = None
+    for _ in range(retries + 1):
+        try:
+            if _worker_tagger is None:
+                _worker_tagger = treetaggerwrapper.TreeTagger(**tagger_params)
+            tagged = {section: [[tuple(tag) for tag in tags]
+                                for tags in batch_treetag_paragraphs(raw, _worker_tagger, max_chars)]
+                      for section, raw in raw_sections.items()}
+            return key, tagged, None
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            # The TreeTagger process might be dead (or failed to start), a new one is started before retrying
+            _worker_tagger = None
+    return key, None, error
+
+
+def treetag_docmodels_parallel(dms: Iterable, workers: Optional[int] = None, sections: tuple = ('text', 'abs'),
+                               retries: int = 2, tagger_params: dict = TREETAGGER_PARAMS,
+                               failures: Optional[list] = None, cache=None, vocal: bool = True, max_chars: int = 0):
+    """Tags DocModels across a pool of worker processes, each running its own TreeTagger
+
+    Same as treetag_docmodels, but only the raw paragraphs are sent to the workers, and tags come back to be set on the
+    DocModels (encoded with the corpus tag vocab) in the main process. At most a few docs per worker are in flight, so
+    reading DocModels never gets far ahead of tagging. Docs are yielded in the order they are tagged. Set max_chars to
+    tag the paragraphs of each doc in batches (see batch_treetag_paragraphs), by default they are tagged one by one.
+
+    Each worker starts its TreeTagger when it gets its first doc. A doc failing to tag (including when the TreeTagger
+    fails to start) is retried up to retries times with a fresh TreeTagger. Docs that still fail are not yielded,
+    they are appended to failures as (doc id, error) if a list is passed, and printed at the end of the run.
+
+    The cache is only used in the main process: cached paragraphs are looked up before sending a doc, only the misses
+    go to the workers, and their tags are added to the cache when they come back.
+    """
+
+    assert cache is None or cache.tagger_params == tagger_params, \
+        'Error, the tagging cache was opened with other tagger params'
+    vocab = get_tag_vocab()
+    failures = [] if failures is None else failures
+    in_flight = {}  # key: (dm, {section: cached Tag lists, None for misses})
+
+    def items():
+        for key, dm in enumerate(dms):
+            raw_sections = {section: getattr(dm, f'raw_{section}_paragraphs') or [] for section in sections}
+            cached = {}
+            if cache is not None:
+                for section, raw in raw_sections.items():
+                    cached[section] = cache.get_many(raw, batched=max_chars > 0)
+                    raw_sections[section] = [para for para, tags in zip(raw, cached[section]) if tags is None]
+            in_flight[key] = dm, cached
+            yield key, dm.id, raw_sections
+
+    n_done = 0
+    tag_fct = partial(_tag_doc_in_worker, tagger_params=tagger_params, retries=retries, max_chars=max_chars)
+    results = parallel_map(tag_fct, items(), workers, ordered=False)
+    for key, tagged, error in results:
+        dm, cached = in_flight.pop(key)
+        if error is not None:
+            failures.append((dm.id, error))
+            continue
+        for section, paragraphs in tagged.items():
+            paragraphs = [[treetaggerwrapper.Tag(*tag) for tag in tags] for tags in paragraphs]
+            if cache is not None:
+                section_tags = cached[section]
+                misses = [i for i, tags in enumerate(section_tags) if tags is None]
+                raw = getattr(dm, f'raw_{section}_paragraphs') or []
+                cache.put_many([raw[i] for i in misses], paragraphs, batched=max_chars > 0)
+                for i, tags in zip(misses, paragraphs):
+                    section_tags[i] = tags
+                paragraphs = section_tags
+            dm.set_section_tags(section, [vocab.encode_tags(tags) for tags in paragraphs])
+        n_done += 1
+        if vocal and n_done % 5000 == 0:
+            print(f'Tagged {n_done} docmodels, {len(failures)} failures')
+        yield dm
+
+    if vocal:
+        print(f'Done tagging {n_done} docmodels, {len(failures)} failures')
+        if cache is not None:
+            print(f'Tagging cache: {cache.stats()}')
+        for doc_id, error in failures:
+            print(f'Tagging failed on {doc_id}: {error}')
@@ -1,9 +1,17 @@
-"""Tools to run through saved DocModels and update specific attributes"""
+"""Tools to run through saved DocModels and update specific attributes
 
-from mempy4.config import DOCMODEL_PATHS_LIST, DOCMODELS_PATH, DOCTYPE_CATS_CSV_PATH, SECONDARY_SUBJECTS_CSV_PATH
+Saved DocModels are also updated in the metadata index (utils/dmindex.py) to keep it in sync.
+"""
+
+from mempy4.config import DOCMODEL_PATHS_LIST, DOCMODELS_PATH, DOCTYPE_CATS_CSV_PATH, SECONDARY_SUBJECTS_CSV_PATH, \
+    DOCMODEL_PAYLOADS_PATH
 from mempy4.utils.generators import generate_docmodels_from_paths
 from mempy4.docmodel import DocModel
 from mempy4.utils.csvmappings import make_value_mapping_from_csv_path, make_list_mapping_from_csv_path
+from mempy4.utils.tagvocab import save_tag_vocab
+from mempy4.utils.dmindex import DocModelIndex
+from mempy4.preprocess.tagging import treetag_docmodels_parallel
+from mempy4.preprocess.tagcache import TaggingCache
 
 
 def update_dm_metadata(doc_id):
@@ -11,6 +19,8 @@ def update_dm_metadata(doc_id):
     dm.extract_all_metadata()
     dm.extract_citation()
     dm.to_pickle()
+    with DocModelIndex() as index:
+        index.update(dm)
 
 
 def update_dms(*args):
@@ -22,10 +32,12 @@ def update_dms(*args):
 
     generator = generate_docmodels_from_paths(DOCMODEL_PATHS_LIST)
 
-    for dm in generator:
-        for fct in args:
-            getattr(dm, fct)()
-        dm.to_pickle()
+    with DocModelIndex() as index:
+        for dm in generator:
+            for fct in args:
+                getattr(dm, fct)()
+            dm.to_pickle()
+            index.update(dm)
 
 
 def update_dms_with_mapping(fct, mapping):
@@ -35,9 +47,47 @@ def update_dms_with_mapping(fct, mapping):
     """
 
     generator = generate_docmodels_from_paths(DOCMODEL_PATHS_LIST)
-    for dm in generator:
-        getattr(dm, fct)(mapping)
-        dm.to_pickle()
+    with DocModelIndex() as index:
+        for dm in generator:
+            getattr(dm, fct)(mapping)
+            dm.to_pickle()
+            index.update(dm)
+
+
+def encode_all_tags():
+    """Converts the Tag lists of older DocModels to id arrays, computes their sentence bounds and saves the tag vocab"""
+
+    update_dms('encode_tags')
+    save_tag_vocab()
+
+
+def retag_dms(workers=None, sections=('text', 'abs'), use_cache=True, max_chars=0):
+    """Retags the raw paragraphs of all dms across a pool of TreeTagger processes and saves them
+
+    If use_cache, paragraphs already in the tagging cache are not retagged (see preprocess/tagcache.py). Set max_chars
+    to tag paragraphs in batches, which can change tags at paragraph starts (see tagging.batch_treetag_paragraphs).
+    Returns the (doc id, error) list of docs that could not be tagged, these are left unchanged.
+    """
+
+    failures = []
+    cache = TaggingCache() if use_cache else None
+    try:
+        for dm in treetag_docmodels_parallel(generate_docmodels_from_paths(DOCMODEL_PATHS_LIST), workers, sections,
+                                             failures=failures, cache=cache, max_chars=max_chars):
+            dm.to_pickle()
+    finally:
+        if cache is not None:
+            cache.close()
+    save_tag_vocab()
+    return failures
+
+
+def split_dms_payloads():
+    """Resaves all dms with split header and payloads, see DocModel.to_pickle"""
+
+    DOCMODEL_PAYLOADS_PATH.mkdir(parents=True, exist_ok=True)
+    for dm in generate_docmodels_from_paths(DOCMODEL_PATHS_LIST):
+        dm.to_pickle(split=True)
 
 
 def update_doctype_cats():
@@ -13,8 +13,13 @@ from umap import UMAP
 def make_metadata_corpusframe(generator, *args):
     """Base metadata df"""
 
-    return pd.DataFrame.from_records([
-        {
+    def is_word(tag):
+        return tag_pos_is_word(tag) and tag_lemma_has_no_special_char_base(tag)
+
+    records = []
+    for dm in generator:
+        abs_tokens, text_tokens = dm.get_abs_tokens(), dm.get_text_tokens()
+        records.append({
             'id': dm.id,
             'title': dm.title,
             'year': dm.year,
@@ -29,16 +34,14 @@ def make_metadata_corpusframe(generator, *args):
             'collab': dm.collab,
             'page': dm.page,
             'citation': dm.citation,
-            'abs_tokens': len(dm.get_abs_tags(flatten=True)),
-            'text_tokens': len(dm.get_text_tags(flatten=True)),
-            'abs_words': len([tag for tag in dm.get_abs_tags(flatten=True)
-                               if tag_pos_is_word(tag) and tag_lemma_has_no_special_char_base(tag)]),
-            'text_words': len([tag for tag in dm.get_text_tags(flatten=True)
-                                if tag_pos_is_word(tag) and tag_lemma_has_no_special_char_base(tag)]),
-            'abs_n_paras': len(dm.get_abs_tags(flatten=False)),
-            'text_n_paras': len(dm.get_text_tags(flatten=False)),
-        }
-        for dm in generator], index='id').rename_axis(None)
+            'abs_tokens': len(abs_tokens),
+            'text_tokens': len(text_tokens),
+            'abs_words': sum(map(is_word, abs_tokens)),
+            'text_words': sum(map(is_word, text_tokens)),
+            'abs_n_paras': abs_tokens.n_paragraphs(),
+            'text_n_paras': text_tokens.n_paragraphs(),
+        })
+    return pd.DataFrame.from_records(records, index='id').rename_axis(None)
 
 
 def make_secondary_subjects_corpusframe(generator, *args):
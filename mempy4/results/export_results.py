@@ -9,7 +9,7 @@ from mempy4.utils.csvmappings import make_list_mapping_from_csv_path
 from mempy4.nlpparams import SPECIAL_CHARACTERS_BASE, SPECIAL_CHARACTERS, TT_NVA_TAGS
 
 from mempyapi.lexcats import LexCounter
-from mempyapi.coocs import CoocsCounter
+from mempyapi.coocs import CoocsCounter, CoocsMatrix
 from mempyapi.tagcounts import TagCounter
 
 # DFs
@@ -88,6 +88,7 @@ def coocs_top_dict():
     Second level keys are lexicon words
     Third level have 2 keys: 'n_occs' (total occs of the word in cluster) and 'coocs', which is a list of tuples
     representing the top 100 cooccurring words, [('word', n_coocs)...]
+    Reads the sparse results (coocs_matrix_*.npz) when present, else the dense dfs saved by older runs.
 
     TODO: Change to json
     """
@@ -96,14 +97,19 @@ def coocs_top_dict():
     d = {}
     clusters = ['full_corpus'] + [f'cluster_{i}' for i in range(7)]
     for cluster in clusters:
-        df = pd.read_pickle(COOCS_PATH / 'coocs_211212' / f'coocs_df_{cluster}.p')
-        cc = CoocsCounter.read_pickle(COOCS_PATH / 'coocs_211212' / f'coocs_counter_{cluster}.p')
         cd = {}
-
-        for word in df.columns:
-            n_occs = cc.word_occs[word]
-            top_100 = df[word].nlargest(100).astype(int)
-            cd[word] = {'n_occs': n_occs, 'coocs': [t for t in top_100.iteritems()]}
+        matrix_path = COOCS_PATH / 'coocs_211212' / f'coocs_matrix_{cluster}.npz'
+        if matrix_path.is_file():
+            cm = CoocsMatrix.load_npz(matrix_path)
+            for word, n_occs in zip(cm.vocab_words, cm.word_occs.tolist()):
+                cd[word] = {'n_occs': n_occs, 'coocs': list(cm.top_k(word, 100).items())}
+        else:
+            df = pd.read_pickle(COOCS_PATH / 'coocs_211212' / f'coocs_df_{cluster}.p')
+            cc = CoocsCounter.read_pickle(COOCS_PATH / 'coocs_211212' / f'coocs_counter_{cluster}.p')
+            for word in df.columns:
+                n_occs = cc.word_occs[word]
+                top_100 = df[word].nlargest(100).astype(int)
+                cd[word] = {'n_occs': n_occs, 'coocs': [t for t in top_100.iteritems()]}
         d[cluster] = cd
         print(f'Done with {cluster}')
         print(f'Added top coocs for {len(cd)} words\n')
@@ -0,0 +1,261 @@
+"""Columnar corpus store, built from the pickled DocModels
+
+Reading a full DocModel (tree, raw text and tags) for every document is slow when a pass only needs lemmas. The store
+keeps the metadata in a single DataFrame and the tags of each section as separate token columns, so a pass only reads
+the columns it needs. Built once with build_corpus_store(), then read through the usual generators by passing a
+CorpusStore instead of a path list:
+>>> store = CorpusStore(CORPUS_STORE_PATH, columns=('lemma', 'pos'))
+... for doc_id, lemmas in generate_ids_lemmas(store, 'get_text_tags', flatten=False):
+...     pass
+
+Store directory content:
+* metadata.p: DataFrame of the metadata fields, indexed by doc id, in store order
+* {section}_doc_offsets.npy: index of the first paragraph of each doc (n_docs + 1 values)
+* {section}_para_offsets.npy: index of the first token of each paragraph (n_paras + 1 values)
+* {section}_{column}.npy: the token column, as uint32 codes
+* {section}_{column}_values.p: list of the strings represented by each code
+* {section}_doc_sent_offsets.npy: index of the first sentence of each doc (n_docs + 1 values)
+* {section}_sent_bounds.npy: (start, end) token indexes of each sentence, from the start of its doc
+
+Sections are 'text' and 'abs', columns are 'word', 'pos' and 'lemma'. Arrays are memory mapped on read.
+"""
+
+from array import array
+from pathlib import Path
+from typing import Iterable, Optional, Callable
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from mempy4.config import CORPUS_STORE_PATH
+from mempy4.utils.tokenview import TokenView
+
+SECTIONS = {'text': 'get_text_tags', 'abs': 'get_abs_tags'}
+COLUMNS = ('word', 'pos', 'lemma')
+METADATA_FIELDS = ['id', 'year', 'title', 'source', 'doctype', 'issn', 'keywords', 'authors', 'collab', 'doi', 'url',
+                   'volume', 'issue', 'page', 'citation', 'doctype_cat', 'primary_subjects', 'secondary_subjects']
+
+
+class StoredDoc:
+    """Read-only document from a CorpusStore, exposes the same getters as DocModel for metadata and tags
+
+    Tags are treetaggerwrapper Tag namedtuples. Attributes for columns that were not loaded are set to None.
+    """
+
+    def __init__(self, metadata: dict, tokens: dict):
+        self.__dict__.update(metadata)
+        self._tokens = tokens
+
+    def get_id(self):
+        return self.id
+
+    def get_year(self):
+        return self.year
+
+    def get_title(self):
+        return self.title
+
+    def get_source(self):
+        return self.source
+
+    def get_doctype(self):
+        return self.doctype
+
+    def get_issn(self):
+        return self.issn
+
+    def get_keywords(self):
+        return self.keywords
+
+    def get_doctype_cat(self):
+        return self.doctype_cat
+
+    def get_primary_subjects(self):
+        return self.primary_subjects
+
+    def get_secondary_subjects(self):
+        return self.secondary_subjects
+
+    def get_text_tags(self, flatten=False):
+        """Get text tags as 2d list [[para1 Tags], [para2 Tags], ...]"""
+
+        return self._get_section_tags('text', flatten)
+
+    def get_abs_tags(self, flatten=False):
+        """Get abstract tags as 2d list [[para1 Tags], [para2 Tags], ...]"""
+
+        return self._get_section_tags('abs', flatten)
+
+    def get_text_tokens(self):
+        """Get text tags as a TokenView over the store columns (see utils/tokenview.py)"""
+
+        return self._tokens['text']
+
+    def get_abs_tokens(self):
+        """Get abstract tags as a TokenView over the store columns (see utils/tokenview.py)"""
+
+        return self._tokens['abs']
+
+    def get_text_sentences_tags(self, *args, **kwargs):
+        for sentence in self.get_text_tokens().sentences():
+            yield sentence.tags()
+
+    def get_abs_sentences_tags(self, *args, **kwargs):
+        for sentence in self.get_abs_tokens().sentences():
+            yield sentence.tags()
+
+    def _get_section_tags(self, section, flatten):
+        tokens = self._tokens[section]
+        return tokens.tags() if flatten else [para.tags() for para in tokens.paragraphs()]
+
+    def __str__(self):
+        return f'StoredDoc {self.id} - {self.title}'
+
+
+class CorpusStore:
+    """Reader for a columnar corpus store made by build_corpus_store()
+
+    Only the columns passed on init are read from disk, the others are set to None in the yielded tags. Reading only
+    'lemma' and 'pos' is enough for most analysis.
+
+    Attributes
+    ----------
+    path: Path
+        The store directory.
+    columns: tuple[str]
+        The token columns to read, any of 'word', 'pos' and 'lemma'.
+    metadata: pandas.DataFrame
+        The metadata of all docs, indexed by doc id, in store order.
+    """
+
+    def __init__(self, path: Path = CORPUS_STORE_PATH, columns: Iterable[str] = COLUMNS):
+        assert all(col in COLUMNS for col in columns), f'Error, store columns must be in {COLUMNS}'
+
+        self.path = Path(path)
+        self.columns = tuple(columns)
+        self.metadata = pd.read_pickle(self.path / 'metadata.p')
+
+        self._doc_offsets = {}
+        self._para_offsets = {}
+        self._doc_sent_offsets = {}
+        self._sent_bounds = {}
+        self._codes = {}
+        self._values = {}
+        for section in SECTIONS:
+            self._doc_offsets[section] = np.load(self.path / f'{section}_doc_offsets.npy', mmap_mode='r')
+            self._para_offsets[section] = np.load(self.path / f'{section}_para_offsets.npy', mmap_mode='r')
+            try:
+                self._doc_sent_offsets[section] = np.load(self.path / f'{section}_doc_sent_offsets.npy',
+                                                          mmap_mode='r')
+                self._sent_bounds[section] = np.load(self.path / f'{section}_sent_bounds.npy', mmap_mode='r')
+            except FileNotFoundError:
+                # Stores built before sentence bounds were saved, sentences are found from the pos column
+                pass
+            for col in self.columns:
+                self._codes[section, col] = np.load(self.path / f'{section}_{col}.npy', mmap_mode='r')
+                self._values[section, col] = pickle.load(open(self.path / f'{section}_{col}_values.p', 'rb'))
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def get_ids(self):
+        return list(self.metadata.index)
+
+    def get_doc(self, doc_id: str) -> StoredDoc:
+        return self._make_doc(self.metadata.index.get_loc(doc_id))
+
+    def generate_docs(self, vocal: bool = True, filter_fct: Optional[Callable[[StoredDoc], bool]] = None,
+                      doc_ids: Optional[Iterable[str]] = None):
+        """Yields a StoredDoc for each doc in the store, in store order. Same behaviour as generate_docmodels_from_paths
+
+        If doc_ids is passed, only these docs are read. Ids missing from the store are ignored.
+        """
+
+        if doc_ids is None:
+            positions = range(len(self.metadata))
+        else:
+            positions = sorted(n for n in self.metadata.index.get_indexer(list(doc_ids)) if n >= 0)
+
+        i = 0
+        for n in positions:
+            doc = self._make_doc(n)
+            if (filter_fct is None) or filter_fct(doc):
+                i += 1
+                if vocal and i % 5000 == 0:
+                    print(f'Generated {i} docs from store')
+                yield doc
+
+    def _make_doc(self, n: int) -> StoredDoc:
+        metadata = self.metadata.iloc[n].to_dict()
+        metadata['id'] = self.metadata.index[n]
+        return StoredDoc(metadata, {section: self._read_section(section, n) for section in SECTIONS})
+
+    def _read_section(self, section: str, n: int) -> TokenView:
+        """Returns a view of the tokens of the nth doc for a section, over the memory mapped columns"""
+
+        para_beg, para_end = self._doc_offsets[section][n:n + 2]
+        para_offsets = self._para_offsets[section][para_beg:para_end + 1].astype(np.int64)
+        tok_beg, tok_end = int(para_offsets[0]), int(para_offsets[-1])
+        columns = {col: self._codes[section, col][tok_beg:tok_end] if col in self.columns else None
+                   for col in COLUMNS}
+        values = {col: self._values.get((section, col)) for col in COLUMNS}
+        sent_bounds = None
+        if section in self._sent_bounds:
+            sent_beg, sent_end = self._doc_sent_offsets[section][n:n + 2]
+            sent_bounds = self._sent_bounds[section][sent_beg:sent_end]
+        return TokenView(columns, values, para_offsets - tok_beg, sent_bounds)
+
+
+def build_corpus_store(path_list, store_path: Path = CORPUS_STORE_PATH):
+    """Builds a columnar corpus store from pickled DocModels
+
+    Reads each DocModel once and writes the store files described in the module docstring to store_path. Existing
+    store files are overwritten.
+    """
+
+    from mempy4.utils.generators import generate_docmodels_from_paths
+
+    store_path = Path(store_path)
+    store_path.mkdir(parents=True, exist_ok=True)
+
+    records = []
+    doc_offsets = {section: array('Q', [0]) for section in SECTIONS}
+    para_offsets = {section: array('Q', [0]) for section in SECTIONS}
+    doc_sent_offsets = {section: array('Q', [0]) for section in SECTIONS}
+    sent_bounds = {section: array('Q') for section in SECTIONS}
+    codes = {(section, col): array('I') for section in SECTIONS for col in COLUMNS}
+    value_ids = {(section, col): {} for section in SECTIONS for col in COLUMNS}
+
+    for dm in generate_docmodels_from_paths(path_list):
+        records.append({field: getattr(dm, field, None) for field in METADATA_FIELDS})
+        for section, getter in SECTIONS.items():
+            paragraphs = getattr(dm, getter)(flatten=False) or []
+            for para in paragraphs:
+                for tag in para:
+                    for col, value in zip(COLUMNS, (tag.word, tag.pos, tag.lemma)):
+                        ids = value_ids[section, col]
+                        codes[section, col].append(ids.setdefault(value, len(ids)))
+                para_offsets[section].append(len(codes[section, 'word']))
+            doc_offsets[section].append(len(para_offsets[section]) - 1)
+            sent_bounds[section].extend(getattr(dm, f'get_{section}_tokens')().sentence_bounds().ravel().tolist())
+            doc_sent_offsets[section].append(len(sent_bounds[section]) // 2)
+
+    pd.DataFrame.from_records(records, columns=METADATA_FIELDS, index='id').to_pickle(store_path / 'metadata.p')
+    for section in SECTIONS:
+        np.save(store_path / f'{section}_doc_offsets.npy', np.frombuffer(doc_offsets[section], dtype=np.uint64))
+        np.save(store_path / f'{section}_para_offsets.npy', np.frombuffer(para_offsets[section], dtype=np.uint64))
+        np.save(store_path / f'{section}_doc_sent_offsets.npy',
+                np.frombuffer(doc_sent_offsets[section], dtype=np.uint64))
+        np.save(store_path / f'{section}_sent_bounds.npy',
+                np.frombuffer(sent_bounds[section], dtype=np.uint64).reshape(-1, 2))
+        for col in COLUMNS:
+            np.save(store_path / f'{section}_{col}.npy', np.frombuffer(codes[section, col], dtype=np.uint32))
+            pickle.dump(list(value_ids[section, col]), open(store_path / f'{section}_{col}_values.p', 'wb'))
+
+    print(f'Done building corpus store with {len(records)} docs at {store_path}')
+
+
+if __name__ == '__main__':
+    from mempy4.config import DOCMODEL_PATHS_LIST
+    build_corpus_store(DOCMODEL_PATHS_LIST)
@@ -0,0 +1,132 @@
+"""SQLite index of DocModel metadata
+
+Lets the generators select docs on their metadata (year, source, doctype_cat, secondary subjects or ids) before opening
+any file, so a restricted pass only reads the matching DocModels. The index is kept in sync by preprocess/updatedms.py
+every time DocModels are saved, and can be rebuilt from scratch with build_docmodel_index().
+
+Queries are passed to the generators as a dict of DocModelIndex.query() kwargs:
+>>> for dm in generate_docmodels_from_paths(DOCMODEL_PATHS_LIST, query={'years': [2010, 2011]}):
+...     pass
+"""
+
+from pathlib import Path
+from typing import Iterable, Optional
+import sqlite3
+
+from mempy4.config import DOCMODEL_INDEX_PATH
+
+
+class DocModelIndex:
+    """Metadata index stored in a SQLite database
+
+    Docs are stored in a 'docs' table (id, filename, year, source, doctype, doctype_cat) and their secondary subjects
+    in a 'doc_subjects' table (id, subject). Writes are committed on commit() or when used as a context manager.
+    """
+
+    def __init__(self, path: Path = DOCMODEL_INDEX_PATH):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS docs (
+                id TEXT PRIMARY KEY, filename TEXT, year TEXT, source TEXT, doctype TEXT, doctype_cat TEXT);
+            CREATE TABLE IF NOT EXISTS doc_subjects (id TEXT, subject TEXT);
+            CREATE INDEX IF NOT EXISTS docs_year ON docs (year);
+            CREATE INDEX IF NOT EXISTS docs_source ON docs (source);
+            CREATE INDEX IF NOT EXISTS docs_doctype_cat ON docs (doctype_cat);
+            CREATE INDEX IF NOT EXISTS doc_subjects_id ON doc_subjects (id);
+            CREATE INDEX IF NOT EXISTS doc_subjects_subject ON doc_subjects (subject);
+        ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commit()
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM docs').fetchone()[0]
+
+    def update(self, dm):
+        """Adds the DocModel to the index, or replaces its entry if it is already indexed"""
+
+        self.connection.execute('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)',
+                                (dm.id, dm.filename, dm.year, dm.source, dm.doctype, dm.doctype_cat))
+        self.connection.execute('DELETE FROM doc_subjects WHERE id = ?', (dm.id,))
+        self.connection.executemany('INSERT INTO doc_subjects VALUES (?, ?)',
+                                    [(dm.id, subject) for subject in dm.secondary_subjects or []])
+
+    def commit(self):
+        self.connection.commit()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM docs')
+        self.connection.execute('DELETE FROM doc_subjects')
+
+    def query(self, **query) -> list[str]:
+        """Returns the filenames of docs matching the query, see _select() for the accepted conditions"""
+
+        return self._select('filename', **query)
+
+    def query_ids(self, **query) -> list[str]:
+        """Same as query(), but returns doc ids"""
+
+        return self._select('id', **query)
+
+    def filter_paths(self, path_list: Iterable[Path], **query) -> list[Path]:
+        """Keeps the paths of path_list pointing to docs matching the query, in the same order"""
+
+        filenames = set(self.query(**query))
+        return [path for path in path_list if Path(path).name in filenames]
+
+    def _select(self,
+                column: str,
+                years: Optional[Iterable] = None,
+                sources: Optional[Iterable[str]] = None,
+                doctype_cats: Optional[Iterable[str]] = None,
+                secondary_subjects: Optional[Iterable[str]] = None,
+                ids: Optional[Iterable[str]] = None
+                ) -> list[str]:
+        """Returns the column values of docs matching all of the passed conditions
+
+        Each condition is a list of accepted values, docs must match one of them. Docs match secondary_subjects if at
+        least one of their subjects is in the list. Conditions left to None are ignored.
+        """
+
+        conditions = []
+        params = []
+        for col, values in (('year', years), ('source', sources), ('doctype_cat', doctype_cats)):
+            if values is not None:
+                values = [str(v) for v in values]
+                conditions.append(f'{col} IN ({", ".join("?" * len(values))})')
+                params += values
+        if ids is not None:
+            # Id lists can be longer than the max number of sql params, so they go through a temp table
+            self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS query_ids (id TEXT PRIMARY KEY)')
+            self.connection.execute('DELETE FROM query_ids')
+            self.connection.executemany('INSERT OR IGNORE INTO query_ids VALUES (?)', ((i,) for i in ids))
+            conditions.append('id IN (SELECT id FROM query_ids)')
+        if secondary_subjects is not None:
+            subjects = list(secondary_subjects)
+            conditions.append(f'id IN (SELECT id FROM doc_subjects WHERE subject IN ({", ".join("?" * len(subjects))}))')
+            params += subjects
+
+        sql = f'SELECT {column} FROM docs' + (' WHERE ' + ' AND '.join(conditions) if conditions else '')
+        return [row[0] for row in self.connection.execute(sql, params)]
+
+
+def build_docmodel_index(path_list, index_path: Path = DOCMODEL_INDEX_PATH):
+    """(Re)builds the metadata index from pickled DocModels"""
+
+    from mempy4.utils.generators import generate_docmodels_from_paths
+
+    with DocModelIndex(index_path) as index:
+        index.clear()
+        for dm in generate_docmodels_from_paths(path_list):
+            index.update(dm)
+        print(f'Done indexing {len(index)} docs')
+
+
+if __name__ == '__main__':
+    from mempy4.config import DOCMODEL_PATHS_LIST
+    build_docmodel_index(DOCMODEL_PATHS_LIST)
@@ -0,0 +1,301 @@
+"""Single corpus pass feeding many counters
+
+Each exec script used to make its own pass over the DocModels, one per counter. run_analyzers() reads each doc once and
+feeds every analyzer from it:
+>>> specs = [
+...     AnalyzerSpec('abs', LexCounter(lexicon), 'get_abs_tags', flatten=True, save_path=base_path / 'lc_abs.p'),
+...     AnalyzerSpec('paras', LexCounter(lexicon), 'get_text_tags', flatten=False, save_path=base_path / 'lc_paras.p'),
+...     AnalyzerSpec('nva', TagCounter('lemma'), 'get_text_tags', tags_filter_fct=tag_pos_in_nva),
+... ]
+... counters = run_analyzers(specs, DOCMODEL_PATHS_LIST, workers=N_WORKERS)
+
+Docs are projected to the inputs of all analyzers at once (see generate_projections), so only lemma and tag lists are
+sent back from the workers when running in parallel. Analyzers sharing the same input reuse it.
+With use_streams=True, lemma inputs are read from lemma streams (see utils/lemmastreams.py) and DocModels are only
+read when a stream has to be built.
+
+When updating the analyzer is what takes time (e.g. a CoocsCounter), run_map_reduce() runs it in the workers instead:
+each worker updates its own copy of the counter on a chunk of the docs, and the copies are merged back with
+counter.merge(). Only counters with a merge method can be used.
+
+To count separately for groups of docs (e.g. clusters) in the same pass, wrap the counter in a GroupedCounter:
+>>> spec = AnalyzerSpec('clusters', GroupedCounter(CoocsCounter(vocab, 5), cluster_series.to_dict()), 'get_text_tags')
+... grouped = run_map_reduce(spec, DOCMODEL_PATHS_LIST, doc_ids=list(cluster_series.index), workers=N_WORKERS)
+... cluster_counters, total = grouped.counters, grouped.total()
+"""
+
+from functools import partial
+from math import ceil
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+import copy
+import pickle
+
+from mempy4.config import DOCMODEL_PATHS_LIST
+from mempy4.utils.corpusstore import CorpusStore
+from mempy4.utils.generators import (generate_docmodels_from_sources, generate_projections, project_lemmas,
+                                     project_tags, select_doc_sources)
+from mempy4.utils.lemmastreams import LemmaStream, get_lemma_stream, get_lemma_streams
+from mempy4.utils.metrics import PassMetrics, measure, measure_iter
+from mempy4.utils.parallel import chunk_iterable, parallel_map
+from mempy4.utils.timer import Timer
+
+# How each counter type is fed: 'lemmas' -> update(id, lemma list), 'tags' -> update(tag list),
+# 'id_tags' -> update(id, tag list)
+FEEDS = {
+    'LexCounter': 'lemmas',
+    'CoocsCounter': 'lemmas',
+    'CoocsCounterTags': 'id_tags',
+    'TagCounter': 'tags',
+    'DocTermCounter': 'id_tags',
+}
+
+
+class GroupedCounter:
+    """Routes each doc to a counter of its own group, so all groups are counted in the same pass
+
+    Counters are copies of the template counter, made the first time a group is found. Docs missing from groups are
+    skipped. Use it as the counter of an AnalyzerSpec, it is fed as the template counter would be.
+
+    Attributes
+    ----------
+    template: object
+        The empty counter copied for each group, e.g. CoocsCounter(vocab, window).
+    groups: dict[str, str]
+        Maps doc ids to group names, e.g. doc_cluster_series.to_dict().
+    counters: dict[str, object]
+        The counter of each group found.
+    """
+
+    def __init__(self, template, groups: dict):
+        self.template = template
+        self.groups = dict(groups)
+        self.counters = {}
+
+    def get_counter(self, doc_id: str):
+        """Returns the counter of the doc's group, None if the doc is not in any group"""
+
+        group = self.groups.get(doc_id)
+        if group is None:
+            return None
+        if group not in self.counters:
+            self.counters[group] = copy.deepcopy(self.template)
+        return self.counters[group]
+
+    def merge(self, *others: 'GroupedCounter') -> 'GroupedCounter':
+        """Merges the group counters of others into these ones (see run_map_reduce). Returns self."""
+
+        for other in others:
+            for group, counter in other.counters.items():
+                if group in self.counters:
+                    self.counters[group].merge(counter)
+                else:
+                    self.counters[group] = counter
+        return self
+
+    def total(self):
+        """Returns a new counter merging all groups, i.e. the counts of all the docs in groups"""
+
+        return copy.deepcopy(self.template).merge(*self.counters.values())
+
+    def to_pickle(self, path):
+        pickle.dump(self, open(path, 'wb'))
+
+
+class AnalyzerSpec:
+    """A counter to feed in run_analyzers and how to feed it
+
+    Attributes
+    ----------
+    name: str
+        Used in progress messages and as key of the returned counters.
+    counter: object
+        The counter to update, e.g. LexCounter(lexicon) or TagCounter('lemma', 'pos').
+    function_name: str
+        DocModel tags getter, e.g. 'get_text_tags', 'get_abs_tags' or 'get_text_sentences_tags'.
+    flatten: bool
+        If True, the counter is updated once per doc, else once per paragraph (or sentence).
+    tags_filter_fct: Callable, optional
+        Tags are only counted if tags_filter_fct(tag) is True. Must be picklable when running with workers.
+    save_path: Path, optional
+        The counter is pickled there when done.
+    df_path: Path, optional
+        The counter's as_df() is pickled there when done.
+    feed: str, optional
+        'lemmas', 'tags' or 'id_tags', see FEEDS. Found from the counter's type (or its template's, for a
+        GroupedCounter) if None.
+    """
+
+    def __init__(self, name: str, counter, function_name: str, flatten: bool = True,
+                 tags_filter_fct: Optional[Callable] = None, save_path: Optional[Path] = None,
+                 df_path: Optional[Path] = None, feed: Optional[str] = None):
+        self.name = name
+        self.counter = counter
+        self.function_name = function_name
+        self.flatten = flatten
+        self.tags_filter_fct = tags_filter_fct
+        self.save_path = save_path
+        self.df_path = df_path
+        counter_type = type(counter.template if isinstance(counter, GroupedCounter) else counter)
+        self.feed = feed or FEEDS[counter_type.__name__]
+
+    def input_key(self) -> tuple:
+        """Analyzers with the same input key are fed the same lists"""
+
+        return self.feed == 'lemmas', self.function_name, self.flatten, self.tags_filter_fct
+
+    def update(self, pairs: list, doc_id: Optional[str] = None):
+        """Feeds the pairs of a doc to the counter, or to the counter of the doc's group for a GroupedCounter"""
+
+        counter = self.counter.get_counter(doc_id) if isinstance(self.counter, GroupedCounter) else self.counter
+        if counter is None:
+            return
+        for pair_id, values in pairs:
+            if self.feed == 'tags':
+                counter.update(values)
+            else:
+                counter.update(pair_id, values)
+
+    def save(self):
+        if self.save_path is not None:
+            self.counter.to_pickle(self.save_path)
+        if self.df_path is not None:
+            self.counter.as_df().to_pickle(self.df_path)
+
+
+def project_inputs(dm, input_keys: list) -> list:
+    """Returns [(doc id, [pairs for each input key])], see AnalyzerSpec.input_key"""
+
+    inputs = []
+    for lemmas, function_name, flatten, tags_filter_fct in input_keys:
+        if lemmas:
+            inputs.append(project_lemmas(dm, function_name, flatten, tags_filter_fct))
+        else:
+            pairs = project_tags(dm, function_name, flatten)
+            if tags_filter_fct is not None:
+                pairs = [(pair_id, [tag for tag in tags if tags_filter_fct(tag)]) for pair_id, tags in pairs]
+            inputs.append(pairs)
+    return [(dm.get_id(), inputs)]
+
+
+def run_analyzers(specs: Iterable[AnalyzerSpec], path_list=None, dms_filter_fct=None, query=None, doc_ids=None,
+                  workers=None, save=True, use_streams=False, metrics=None, corpus_version=None) -> dict:
+    """Updates all analyzers with a single read of each doc, then saves them. Returns the counters by spec name.
+
+    path_list defaults to DOCMODEL_PATHS_LIST, the other parameters are passed to generate_projections. If use_streams
+    and all analyzers are fed lemmas, they are read from lemma streams instead of the DocModels (see
+    utils/lemmastreams.py), missing streams are built in the same pass. Pass the corpus_version of the run (see
+    get_corpus_version) to avoid computing it again. Pass a PassMetrics to record throughput and stage times of the
+    pass, analyzer updates being the consumer stage (see utils/metrics.py).
+    """
+
+    specs = list(specs)
+    input_keys = list(dict.fromkeys(spec.input_key() for spec in specs))
+    spec_inputs = [input_keys.index(spec.input_key()) for spec in specs]
+
+    print(f'Running {len(specs)} analyzers on {len(input_keys)} inputs: {", ".join(spec.name for spec in specs)}')
+    timer = Timer()
+    path_list = DOCMODEL_PATHS_LIST if path_list is None else path_list
+    for doc_id, inputs in _generate_inputs(input_keys, path_list, dms_filter_fct, query, doc_ids, workers, use_streams,
+                                           metrics, corpus_version):
+        for spec, i in zip(specs, spec_inputs):
+            spec.update(inputs[i], doc_id)
+    timer.step('Done updating analyzers.')
+
+    if save:
+        for spec in specs:
+            spec.save()
+    return {spec.name: spec.counter for spec in specs}
+
+
+def _generate_inputs(input_keys, path_list, dms_filter_fct, query, doc_ids, workers, use_streams, metrics,
+                     corpus_version):
+    """Yields (doc id, list of pairs for each input key), doc by doc"""
+
+    if use_streams and all(lemmas for lemmas, *_ in input_keys):
+        streams = get_lemma_streams(path_list, [key[1:] for key in input_keys], dms_filter_fct, workers,
+                                    corpus_version=corpus_version)
+        for docs in zip(*(stream.generate_docs(doc_ids, query, metrics, count_docs=False) for stream in streams)):
+            if metrics is not None:
+                metrics.n_docs += 1
+            with measure(metrics, 'consumer'):
+                yield docs[0][0], [pairs for _, pairs in docs]
+        return
+
+    if use_streams:
+        print('Lemma streams only hold lemmas, some analyzers need tags: reading DocModels')
+    projection = partial(project_inputs, input_keys=input_keys)
+    yield from generate_projections(path_list, projection, dms_filter_fct, query, workers, doc_ids=doc_ids,
+                                    metrics=metrics)
+
+
+def run_map_reduce(spec: AnalyzerSpec, path_list=None, dms_filter_fct=None, query=None, doc_ids=None, workers=None,
+                   n_chunks=None, use_streams=False, save=True, metrics=None, corpus_version=None):
+    """Updates an analyzer across worker processes, each on a chunk of the docs, then merges the results. Returns it.
+
+    spec.counter must be empty and have a merge method (e.g. CoocsCounter, or a GroupedCounter of them). The selected
+    docs (see select_doc_sources) are split in n_chunks chunks of consecutive docs, 4 per worker by default, and the
+    chunk counters are merged in chunk order. If workers is None, the counter is updated in this process. If use_streams
+    and the analyzer is fed lemmas, the chunks are read from the lemma stream (see utils/lemmastreams.py). Pass a
+    PassMetrics to record the stage times measured in the workers, plus the merges. corpus_version is passed to
+    get_lemma_stream.
+    """
+
+    path_list = DOCMODEL_PATHS_LIST if path_list is None else path_list
+    assert not isinstance(path_list, CorpusStore), 'Error, run_map_reduce reads DocModel paths or lemma streams only'
+
+    stream_path = None
+    if use_streams and spec.feed == 'lemmas':
+        _, function_name, flatten, tags_filter_fct = spec.input_key()
+        stream = get_lemma_stream(path_list, function_name, flatten, dms_filter_fct, tags_filter_fct, workers,
+                                  corpus_version=corpus_version)
+        stream_path = stream.path
+        items = [stream.doc_ids[n] for n in stream.select_docs(doc_ids, query)]
+    else:
+        items = select_doc_sources(path_list, query, doc_ids)
+
+    print(f'Running {spec.name} on {len(items)} docs with {workers or 1} processes')
+    timer = Timer()
+    # Chunks are sent with a copy of the spec, as spec.counter is filled by the merges while chunks are submitted
+    count_fct = partial(_count_chunk, spec=copy.deepcopy(spec), dms_filter_fct=dms_filter_fct, stream_path=stream_path,
+                        trace_memory=None if metrics is None else metrics.trace_memory)
+    if workers is None:
+        counter, chunk_metrics = count_fct(items)
+        spec.counter = counter
+        if metrics is not None:
+            metrics.merge(chunk_metrics)
+    else:
+        n_chunks = n_chunks or 4 * workers
+        chunks = chunk_iterable(items, max(1, ceil(len(items) / n_chunks)))
+        results = parallel_map(count_fct, chunks, workers)
+        for counter, chunk_metrics in measure_iter(results, metrics, 'wait'):
+            with measure(metrics, 'merge'):
+                spec.counter.merge(counter)
+            if metrics is not None:
+                metrics.merge(chunk_metrics)
+    timer.step(f'Done with {spec.name}.')
+
+    if save:
+        spec.save()
+    return spec.counter
+
+
+def _count_chunk(chunk, spec, dms_filter_fct, stream_path, trace_memory):
+    """Worker side of run_map_reduce, returns (updated counter, PassMetrics or None)
+
+    chunk holds doc ids when reading a lemma stream, else (path, shard ids) sources.
+    """
+
+    metrics = None if trace_memory is None else PassMetrics(trace_memory=trace_memory)
+    if stream_path is not None:
+        for doc_id, pairs in LemmaStream(stream_path).generate_docs(doc_ids=chunk, metrics=metrics):
+            with measure(metrics, 'consumer'):
+                spec.update(pairs, doc_id)
+    else:
+        input_keys = [spec.input_key()]
+        for dm in generate_docmodels_from_sources(chunk, dms_filter_fct, metrics):
+            with measure(metrics, 'projection'):
+                [(doc_id, [pairs])] = project_inputs(dm, input_keys)
+            with measure(metrics, 'consumer'):
+                spec.update(pairs, doc_id)
+    return spec.counter, metrics
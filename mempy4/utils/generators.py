@@ -1,51 +1,292 @@
+from functools import partial
+from pathlib import Path
 import pickle
+import numpy as np
 
 from mempy4.config import DOCMODEL_PATHS_LIST
+from mempy4.nlpparams import TT_TAGLIST
+from mempy4.utils.corpusstore import CorpusStore
+from mempy4.utils.dmindex import DocModelIndex
+from mempy4.utils.metrics import PassMetrics, measure, measure_iter
+from mempy4.utils.tagvocab import get_tag_vocab
+from mempy4.utils.parallel import parallel_map, chunk_iterable
+from mempy4.utils.shards import ShardReader, is_shard_path
 
+# Tag getters served from TokenViews (see utils/tokenview.py): {getter: (TokenView getter, split if not flattened)}
+# The _ids getters are projected to id arrays, the others to Tags, as returned by the DocModel getters
+TOKEN_GETTERS = {
+    'get_text_tags': ('get_text_tokens', 'paragraphs'),
+    'get_abs_tags': ('get_abs_tokens', 'paragraphs'),
+    'get_text_tag_ids': ('get_text_tokens', 'paragraphs'),
+    'get_abs_tag_ids': ('get_abs_tokens', 'paragraphs'),
+    'get_text_sentences_tags': ('get_text_tokens', 'sentences'),
+    'get_abs_sentences_tags': ('get_abs_tokens', 'sentences'),
+}
+ID_GETTERS = {'get_text_tag_ids', 'get_abs_tag_ids'}
 
-def generate_docmodels_from_paths(path_list, vocal=True, filter_fct=None):
-    """Base generator, yields DocModels based on a path list pointing to pickled DocModels"""
+
+def generate_docmodels_from_paths(path_list, vocal=True, filter_fct=None, query=None, doc_ids=None, metrics=None):
+    """Base generator, yields DocModels based on a path list pointing to pickled DocModels
+
+    Paths to shard files (see utils/shards.py) can be included in the list, all of their DocModels are then yielded.
+    A CorpusStore can be passed instead of a path list, in which case StoredDocs are read from the store instead.
+    If a query is passed (dict of DocModelIndex.query() kwargs, e.g. {'years': [2010]}) or a collection of doc_ids,
+    docs are first selected with the metadata index and only the matching ones are opened, see select_doc_sources.
+    filter_fct is still applied on the opened docs. Pass a PassMetrics to record the time spent opening and unpickling
+    the docs (see utils/metrics.py).
+    """
+
+    if isinstance(path_list, CorpusStore):
+        selected_ids = None
+        if query is not None:
+            with DocModelIndex() as index:
+                selected_ids = index.query_ids(**query)
+        if doc_ids is not None:
+            selected_ids = doc_ids if selected_ids is None else set(selected_ids) & set(doc_ids)
+        for doc in measure_iter(path_list.generate_docs(vocal=vocal, filter_fct=filter_fct, doc_ids=selected_ids),
+                                metrics, 'open'):
+            if metrics is not None:
+                metrics.n_docs += 1
+            yield doc
+        return
 
     i = 0
+    for path, shard_ids in select_doc_sources(path_list, query, doc_ids):
+        for dm in _read_docmodels(path, shard_ids, metrics):
+            if (filter_fct is None) or filter_fct(dm):
+                i += 1
+                if vocal and i % 5000 == 0:
+                    print(f'Generated {i} docmodels')
+                yield dm
+
+
+def generate_docmodels_from_ids(doc_ids, path_list=None, vocal=True, filter_fct=None):
+    """Yields the DocModels of doc_ids only, reading none of the other docs. path_list defaults to DOCMODEL_PATHS_LIST.
+
+    Docs are yielded in path list order, ids not found are ignored.
+    """
+
+    yield from generate_docmodels_from_paths(DOCMODEL_PATHS_LIST if path_list is None else path_list, vocal,
+                                             filter_fct, doc_ids=doc_ids)
+
+
+def select_doc_sources(path_list, query=None, doc_ids=None) -> list:
+    """Resolves a query and/or a collection of doc ids to the sources to read, without opening any DocModel
+
+    Returns a list of (path, shard ids) pairs, in path list order. shard ids is None for DocModel paths, and the list of
+    selected ids for shard paths (shards holding none of them are left out), read by seeking to their offsets. Doc ids
+    missing from the metadata index are matched on filename ('{doc id}.p') if no other condition is passed.
+    """
+
+    if query is None and doc_ids is None:
+        return [(path, None) for path in path_list]
+
+    query = dict(query or {})
+    if doc_ids is not None:
+        doc_ids = set(doc_ids)
+        query['ids'] = doc_ids if query.get('ids') is None else doc_ids & set(query['ids'])
+    with DocModelIndex() as index:
+        filenames = set(index.query(**query))
+        selected_ids = set(index.query_ids(**query))
+    if doc_ids is not None and query.keys() == {'ids'}:
+        filenames.update(f'{doc_id}.p' for doc_id in query['ids'])
+        selected_ids.update(query['ids'])
+
+    sources = []
     for path in path_list:
+        if is_shard_path(path):
+            shard_ids = [doc_id for doc_id in ShardReader(path).get_ids() if doc_id in selected_ids]
+            if shard_ids:
+                sources.append((path, shard_ids))
+        elif Path(path).name in filenames:
+            sources.append((path, None))
+    return sources
+
+
+def generate_docmodels_from_sources(sources, filter_fct=None, metrics=None):
+    """Yields the DocModels of a list of (path, shard ids) sources, as returned by select_doc_sources"""
+
+    for path, shard_ids in sources:
+        for dm in _read_docmodels(path, shard_ids, metrics):
+            if filter_fct is None or filter_fct(dm):
+                yield dm
+
+
+def _read_docmodels(path, shard_ids=None, metrics=None):
+    """Yields the DocModel pickled at path, or the DocModels of a shard (only those in shard_ids if passed)"""
+
+    if is_shard_path(path):
+        yield from ShardReader(path).generate_docmodels(shard_ids, metrics)
+        return
+
+    with measure(metrics, 'open'):
         with open(path, 'rb') as f:
-            try:
-                dm = pickle.load(f)
-                if (filter_fct is None) or filter_fct(dm):
-                    i += 1
-                    if vocal and i % 5000 == 0:
-                        print(f'Generated {i} docmodels')
-                    yield dm
-            except EOFError:
-                print(f'ERROR! Could not open docmodel at: {path}')
+            data = f.read()
+    try:
+        with measure(metrics, 'unpickle'):
+            dm = pickle.loads(data)
+    except EOFError:
+        print(f'ERROR! Could not open docmodel at: {path}')
+        return
+    if metrics is not None:
+        metrics.n_docs += 1
+        metrics.bytes_read += len(data)
+    yield dm
+
+
+def generate_projections(path_list, projection, dms_filter_fct=None, query=None, workers=None, ordered=True,
+                         prefetch=None, chunksize=16, doc_ids=None, metrics=None):
+    """Yields the (id, value) pairs returned by projection(dm) for each DocModel, optionally across worker processes
+
+    If workers is None, DocModels are loaded and projected one after the other, as in generate_docmodels_from_paths.
+    Else, paths are sent by chunks of chunksize to a pool of workers processes which load and project the DocModels, so
+    only the projections are sent back. At most prefetch chunks are processed ahead of the consumer. If ordered is False,
+    chunks are yielded as soon as they are ready instead of in path order. projection and dms_filter_fct must be
+    picklable (module level functions or partials, no lambdas). CorpusStores are always read sequentially.
+    If a PassMetrics is passed, stage times are recorded in it, see utils/metrics.py. With workers, the open, unpickle
+    and projection times are measured in the workers and sent back with each chunk.
+    """
+
+    if workers is None or isinstance(path_list, CorpusStore):
+        for dm in generate_docmodels_from_paths(path_list, filter_fct=dms_filter_fct, query=query, doc_ids=doc_ids,
+                                                metrics=metrics):
+            with measure(metrics, 'projection'):
+                pairs = projection(dm)
+            with measure(metrics, 'consumer'):
+                yield from pairs
+        return
+
+    i = 0
+    sources = select_doc_sources(path_list, query, doc_ids)
+    load_fct = partial(_load_and_project, projection=projection, filter_fct=dms_filter_fct,
+                       trace_memory=None if metrics is None else metrics.trace_memory)
+    chunks = parallel_map(load_fct, chunk_iterable(sources, chunksize), workers, ordered, prefetch)
+    for chunk in measure_iter(chunks, metrics, 'wait'):
+        if metrics is not None:
+            chunk, chunk_metrics = chunk
+            metrics.merge(chunk_metrics)
+        for pairs in chunk:
+            i += 1
+            if i % 5000 == 0:
+                print(f'Generated {i} docmodels')
+            with measure(metrics, 'consumer'):
+                yield from pairs
+
+
+def _load_and_project(sources, projection, filter_fct, trace_memory=None):
+    """Worker side of generate_projections, returns the projections of a chunk of (path, shard ids) sources
+
+    If trace_memory is not None, returns (projections, PassMetrics of the chunk) instead.
+    """
+
+    metrics = None if trace_memory is None else PassMetrics(trace_memory=trace_memory)
+    projections = []
+    for dm in generate_docmodels_from_sources(sources, filter_fct, metrics):
+        with measure(metrics, 'projection'):
+            projections.append(projection(dm))
+    return projections if metrics is None else (projections, metrics)
+
+
+def get_token_views(dm, function_name, flatten=True):
+    """Returns the (id, TokenView) pairs matching what getattr(dm, function_name)(flatten=flatten) returns
+
+    If flatten, a single pair with the doc id. Else, one pair per paragraph, with the paragraph number appended to the
+    doc id: '{doc id}_{num}'. Sentence getters always yield one pair per sentence, sliced with the stored sentence
+    bounds, see DocModel.set_section_tags.
+    """
+
+    view_getter, split = TOKEN_GETTERS[function_name]
+    tokens = getattr(dm, view_getter)()
+    if flatten and split == 'paragraphs':
+        return [(dm.get_id(), tokens)]
+    return [(f'{dm.get_id()}_{i}', view) for i, view in enumerate(getattr(tokens, split)())]
+
+
+def project_lemmas(dm, function_name, flatten=True, tags_filter_fct=None):
+    """Returns the (id, lemma list) pairs of a DocModel, see generate_ids_lemmas"""
+
+    if function_name not in TOKEN_GETTERS:
+        if flatten:
+            return [(dm.get_id(), [tag.lemma for tag in getattr(dm, function_name)(flatten=flatten)
+                                   if tags_filter_fct is None or tags_filter_fct(tag)])]
+        return [(f'{dm.get_id()}_{i}', [tag.lemma for tag in para if tags_filter_fct is None or tags_filter_fct(tag)])
+                for i, para in enumerate(getattr(dm, function_name)(flatten=flatten))]
 
+    if tags_filter_fct is None:
+        return [(view_id, view.get_strings('lemma')) for view_id, view in get_token_views(dm, function_name, flatten)]
+    return [(view_id, [tag.lemma for tag in view.tags() if tags_filter_fct(tag)])
+            for view_id, view in get_token_views(dm, function_name, flatten)]
 
 
+def project_tags(dm, function_name, flatten=True):
+    """Returns the (id, tag list) pairs of a DocModel, see generate_ids_tags"""
 
-def generate_ids_lemmas(path_list, function_name, flatten=True, dms_filter_fct=None, tags_filter_fct=None):
+    if function_name not in TOKEN_GETTERS:
+        if flatten:
+            return [(dm.get_id(), getattr(dm, function_name)(flatten=flatten))]
+        return [(f'{dm.get_id()}_{i}', para) for i, para in enumerate(getattr(dm, function_name)(flatten=flatten))]
+
+    if function_name in ID_GETTERS:
+        return [(view_id, view.get_ids()) for view_id, view in get_token_views(dm, function_name, flatten)]
+    return [(view_id, view.tags()) for view_id, view in get_token_views(dm, function_name, flatten)]
+
+
+def generate_ids_lemmas(path_list, function_name, flatten=True, dms_filter_fct=None, tags_filter_fct=None,
+                        query=None, workers=None, ordered=True, doc_ids=None, use_stream=False, metrics=None,
+                        corpus_version=None):
     """Extends generate_docmodels_from_paths, yields pairs of doc_ids and lemma lists
 
     For each DocModel, yields the doc id (str) and a list of lemmas (str). The specified function should return a list
     of tags with a 'lemma' attribute. If flatten, paragraphs will be merged. Else, each paragraph will be yielded
     individually, and word_list number will be appended to doc id: '{doc id}_{word_list num}'
+    Set workers to load and project docs in parallel, see generate_projections. Pass doc_ids to only read these docs.
+    If use_stream, pairs are read from the lemma stream of the projection, built first if missing or outdated (see
+    utils/lemmastreams.py). The stream holds the whole corpus, query and doc_ids only select the docs yielded from it.
+    Pass the corpus_version of the run (see get_corpus_version) to avoid computing it again.
+    Pass a PassMetrics to record throughput and stage times, see utils/metrics.py.
     """
 
-    for dm in generate_docmodels_from_paths(path_list, filter_fct=dms_filter_fct):
-        if flatten:
-            yield dm.get_id(), [tag.lemma for tag in getattr(dm, function_name)(flatten=flatten)
-                                if tags_filter_fct is None or tags_filter_fct(tag)]
-        else:
-            for i, para in enumerate(getattr(dm, function_name)(flatten=flatten)):
-                yield f'{dm.get_id()}_{i}', [tag.lemma for tag in para if tags_filter_fct is None or tags_filter_fct(tag)]
+    if use_stream:
+        from mempy4.utils.lemmastreams import get_lemma_stream
+        stream = get_lemma_stream(path_list, function_name, flatten, dms_filter_fct, tags_filter_fct, workers,
+                                  corpus_version=corpus_version)
+        yield from stream.generate_ids(doc_ids, query, metrics)
+        return
 
+    projection = partial(project_lemmas, function_name=function_name, flatten=flatten, tags_filter_fct=tags_filter_fct)
+    yield from generate_projections(path_list, projection, dms_filter_fct, query, workers, ordered, doc_ids=doc_ids,
+                                    metrics=metrics)
 
-def generate_ids_tags(path_list, function_name, flatten=True):
-    for dm in generate_docmodels_from_paths(path_list):
-        if flatten:
-            yield dm.get_id(), getattr(dm, function_name)(flatten=flatten)
-        else:
-            for i, para in enumerate(getattr(dm, function_name)(flatten=flatten)):
-                yield f'{dm.get_id()}_{i}', para
+
+def generate_ids_lemma_ids(path_list, function_name, flatten=True, dms_filter_fct=None, pos_filter=None, query=None,
+                           doc_ids=None):
+    """Same as generate_ids_lemmas, but yields lemma ids (see utils/tagvocab.py) instead of lemma strings
+
+    function_name should be a DocModel tag getter, e.g. 'get_text_tag_ids'. Tags are filtered on their POS if a list of
+    accepted POS values is passed as pos_filter (e.g. TT_NVA_TAGS). Lemma ids are yielded as a list of int, to be used
+    with counters built on encoded values (see TagVocab.encode_mapping).
+    """
+
+    if pos_filter is not None:
+        unknown = [pos for pos in pos_filter if pos not in TT_TAGLIST]
+        assert not unknown, f'Error, unknown POS tags in pos_filter: {unknown}'
+    pos_ids = None if pos_filter is None else get_tag_vocab().encode_values('pos', pos_filter, vocal=False)
+
+    for dm in generate_docmodels_from_paths(path_list, filter_fct=dms_filter_fct, query=query, doc_ids=doc_ids):
+        for view_id, view in get_token_views(dm, function_name, flatten):
+            lemma_ids = view.get_column('lemma')
+            if pos_ids is not None:
+                lemma_ids = lemma_ids[np.isin(view.get_column('pos'), pos_ids)]
+            yield view_id, lemma_ids.tolist()
+
+
+def generate_ids_tags(path_list, function_name, flatten=True, query=None, workers=None, ordered=True, doc_ids=None,
+                      metrics=None):
+    """Same as generate_ids_lemmas, but yields the tag lists themselves"""
+
+    projection = partial(project_tags, function_name=function_name, flatten=flatten)
+    yield from generate_projections(path_list, projection, query=query, workers=workers, ordered=ordered,
+                                    doc_ids=doc_ids, metrics=metrics)
 
 
 def generate_all_docmodels():
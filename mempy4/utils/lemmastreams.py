@@ -0,0 +1,305 @@
+"""Lemma streams: projections of the corpus materialized on disk
+
+Most passes only need the (id, lemma list) pairs of generate_ids_lemmas for a given getter, flatten and tags filter,
+and recompute them from the DocModels each time. A lemma stream stores these pairs once, as compact columns, so later
+runs read them directly without opening any DocModel:
+>>> stream = get_lemma_stream(DOCMODEL_PATHS_LIST, 'get_text_tags', flatten=False, tags_filter_fct=tag_pos_in_nva)
+... for para_id, lemmas in stream.generate_ids(doc_ids=cluster_ids):
+...     pass
+
+Streams are keyed by a hash of their spec (getter, flatten, docs filter and tags filter, including the code and the
+globals used by the filter functions) and a version of the corpus (path, size and modification time of each
+DocModel, and the version of the tag vocab their ids are decoded with). A stream is rebuilt automatically when either
+changes, older versions of the same spec are removed. The corpus version stats every DocModel: compute it once with
+get_corpus_version and pass it to the passes of a run.
+Docs can be selected on read (doc_ids, query), so a single stream of the whole corpus serves all subsets.
+
+Stream directory content:
+* spec.p: dict describing the stream, written last (a stream without it is incomplete)
+* doc_ids.p: list of doc ids, in corpus order
+* doc_offsets.npy: index of the first pair of each doc (n_docs + 1 values)
+* pair_ids.p: list of the pair ids (doc id, or '{doc id}_{num}' when not flattened)
+* token_offsets.npy: index of the first lemma of each pair (n_pairs + 1 values)
+* lemmas.npy: the lemma column, as uint32 codes
+* lemma_values.p: list of the strings represented by each code
+"""
+
+from array import array
+from functools import partial
+from pathlib import Path
+from types import CodeType, FunctionType, ModuleType
+from typing import Callable, Iterable, Optional
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+from mempy4.config import LEMMA_STREAMS_PATH
+from mempy4.utils.corpusstore import CorpusStore
+from mempy4.utils.dmindex import DocModelIndex
+from mempy4.utils.generators import generate_projections, project_lemmas
+from mempy4.utils.metrics import PassMetrics, measure
+from mempy4.utils.tagvocab import get_tag_vocab
+from mempy4.utils.timer import Timer
+
+
+class LemmaStream:
+    """Reader for a lemma stream made by get_lemma_streams()
+
+    Attributes
+    ----------
+    path: Path
+        The stream directory.
+    spec: dict
+        Getter, flatten and filters the stream was built with, along with its key and corpus version.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.spec = pickle.load(open(self.path / 'spec.p', 'rb'))
+        self.doc_ids = pickle.load(open(self.path / 'doc_ids.p', 'rb'))
+        self.pair_ids = pickle.load(open(self.path / 'pair_ids.p', 'rb'))
+        self.values = pickle.load(open(self.path / 'lemma_values.p', 'rb'))
+        self._doc_offsets = np.load(self.path / 'doc_offsets.npy', mmap_mode='r')
+        self._token_offsets = np.load(self.path / 'token_offsets.npy', mmap_mode='r')
+        self._codes = np.load(self.path / 'lemmas.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.pair_ids)
+
+    def __iter__(self):
+        return self.generate_ids()
+
+    def __repr__(self):
+        return f'LemmaStream({self.spec["function_name"]}, flatten={self.spec["flatten"]}, {len(self.doc_ids)} docs)'
+
+    def select_docs(self, doc_ids: Optional[Iterable[str]] = None, query: Optional[dict] = None) -> Iterable[int]:
+        """Returns the positions of the selected docs (all if no doc_ids nor query), in stream order"""
+
+        if doc_ids is None and query is None:
+            return range(len(self.doc_ids))
+        selected = None if doc_ids is None else set(doc_ids)
+        if query is not None:
+            with DocModelIndex() as index:
+                query_ids = set(index.query_ids(**query))
+            selected = query_ids if selected is None else selected & query_ids
+        return [n for n, doc_id in enumerate(self.doc_ids) if doc_id in selected]
+
+    def _read_pairs(self, n: int, metrics=None, count_doc: bool = True) -> list:
+        """Returns the (pair id, lemma list) pairs of the nth doc, counted in metrics.n_docs if count_doc"""
+
+        pair_beg, pair_end = (int(i) for i in self._doc_offsets[n:n + 2])
+        with measure(metrics, 'open'):
+            offsets = self._token_offsets[pair_beg:pair_end + 1].tolist()
+            codes = self._codes[offsets[0]:offsets[-1]].tolist()
+        if metrics is not None:
+            metrics.n_docs += count_doc
+            metrics.bytes_read += 4 * len(codes) + 8 * len(offsets)
+        values = self.values
+        return [(self.pair_ids[pair_beg + i], [values[c] for c in codes[beg - offsets[0]:end - offsets[0]]])
+                for i, (beg, end) in enumerate(zip(offsets[:-1], offsets[1:]))]
+
+    def generate_ids(self, doc_ids: Optional[Iterable[str]] = None, query: Optional[dict] = None,
+                     metrics: Optional[PassMetrics] = None):
+        """Yields (id, lemma list) pairs, same as generate_ids_lemmas. Only for doc_ids and/or the query if passed
+
+        Reads are recorded as the open stage of metrics if passed, see utils/metrics.py.
+        """
+
+        for n in self.select_docs(doc_ids, query):
+            pairs = self._read_pairs(n, metrics)
+            with measure(metrics, 'consumer'):
+                yield from pairs
+
+    def generate_docs(self, doc_ids: Optional[Iterable[str]] = None, query: Optional[dict] = None,
+                      metrics: Optional[PassMetrics] = None, count_docs: bool = True):
+        """Yields (doc id, [(id, lemma list) pairs]) for each doc
+
+        Pass count_docs=False when the caller counts the docs, e.g. when reading several streams of the same docs.
+        """
+
+        for n in self.select_docs(doc_ids, query):
+            yield self.doc_ids[n], self._read_pairs(n, metrics, count_docs)
+
+
+class _StreamWriter:
+    """Accumulates the pairs of a stream, then writes the stream files to a directory"""
+
+    def __init__(self):
+        self.doc_ids = []
+        self.pair_ids = []
+        self.doc_offsets = array('Q', [0])
+        self.token_offsets = array('Q', [0])
+        self.codes = array('I')
+        self.value_ids = {}
+
+    def add_doc(self, doc_id: str, pairs: list):
+        value_ids = self.value_ids
+        for pair_id, lemmas in pairs:
+            self.pair_ids.append(pair_id)
+            self.codes.extend(value_ids.setdefault(lemma, len(value_ids)) for lemma in lemmas)
+            self.token_offsets.append(len(self.codes))
+        self.doc_ids.append(doc_id)
+        self.doc_offsets.append(len(self.pair_ids))
+
+    def save(self, path: Path, spec: dict):
+        """Writes the stream to a temp directory, then renames it, so path never holds a partial stream"""
+
+        tmp_path = path.with_name(path.name + '.tmp')
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        tmp_path.mkdir(parents=True)
+        pickle.dump(self.doc_ids, open(tmp_path / 'doc_ids.p', 'wb'))
+        pickle.dump(self.pair_ids, open(tmp_path / 'pair_ids.p', 'wb'))
+        pickle.dump(list(self.value_ids), open(tmp_path / 'lemma_values.p', 'wb'))
+        np.save(tmp_path / 'doc_offsets.npy', np.frombuffer(self.doc_offsets, dtype=np.uint64))
+        np.save(tmp_path / 'token_offsets.npy', np.frombuffer(self.token_offsets, dtype=np.uint64))
+        np.save(tmp_path / 'lemmas.npy', np.frombuffer(self.codes, dtype=np.uint32))
+        pickle.dump(spec, open(tmp_path / 'spec.p', 'wb'))
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+
+
+def _stable_repr(value) -> str:
+    """repr() that doesn't depend on set or dict ordering"""
+
+    if isinstance(value, (set, frozenset)):
+        return '{' + ', '.join(sorted(_stable_repr(v) for v in value)) + '}'
+    if isinstance(value, dict):
+        return '{' + ', '.join(sorted(f'{_stable_repr(k)}: {_stable_repr(v)}' for k, v in value.items())) + '}'
+    if isinstance(value, (list, tuple)):
+        return f'{type(value).__name__}(' + ', '.join(_stable_repr(v) for v in value) + ')'
+    return repr(value)
+
+
+def describe_callable(fct: Optional[Callable], _seen: Optional[set] = None) -> str:
+    """Returns a description of a function that changes whenever its behaviour may change
+
+    Includes the code of the function, its constants, closure values and the values of the globals it uses. Functions
+    it calls are described recursively, so editing TT_NVA_TAGS changes the description of tag_pos_in_nva.
+    """
+
+    if fct is None:
+        return 'None'
+    _seen = set() if _seen is None else _seen
+    if isinstance(fct, functools.partial):
+        return (f'partial({describe_callable(fct.func, _seen)}, {_stable_repr(fct.args)}, '
+                f'{_stable_repr(fct.keywords)})')
+    if not isinstance(fct, FunctionType):
+        return f'{getattr(fct, "__module__", None)}.{getattr(fct, "__qualname__", repr(fct))}'
+
+    name = f'{fct.__module__}.{fct.__qualname__}'
+    if name in _seen:
+        return name
+    _seen.add(name)
+
+    def describe_code(code: CodeType) -> list:
+        parts = [code.co_code.hex(), _stable_repr(code.co_names)]
+        for const in code.co_consts:
+            parts.extend(describe_code(const) if isinstance(const, CodeType) else [_stable_repr(const)])
+        return parts
+
+    parts = [name] + describe_code(fct.__code__)
+    for cell in fct.__closure__ or ():
+        parts.append(describe_callable(cell.cell_contents, _seen) if callable(cell.cell_contents)
+                     else _stable_repr(cell.cell_contents))
+    for global_name in fct.__code__.co_names:
+        if global_name not in fct.__globals__:
+            continue
+        value = fct.__globals__[global_name]
+        if isinstance(value, ModuleType):
+            parts.append(f'{global_name}=module {value.__name__}')
+        elif callable(value):
+            parts.append(f'{global_name}={describe_callable(value, _seen)}')
+        else:
+            parts.append(f'{global_name}={_stable_repr(value)}')
+    return '|'.join(parts)
+
+
+def get_corpus_version(path_list) -> str:
+    """Hash of the path, size and mtime of each doc of a path list (or CorpusStore files) and of the tag vocab"""
+
+    if isinstance(path_list, CorpusStore):
+        path_list = sorted(path_list.path.iterdir())
+    sha = hashlib.sha1()
+    for path in path_list:
+        try:
+            stat = os.stat(path)
+            sha.update(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+        except FileNotFoundError:
+            sha.update(f'{path}\0missing\n'.encode())
+    sha.update(f'tag_vocab\0{get_tag_vocab().get_version()}'.encode())
+    return sha.hexdigest()
+
+
+def make_stream_spec(function_name: str, flatten: bool = True, dms_filter_fct: Optional[Callable] = None,
+                     tags_filter_fct: Optional[Callable] = None) -> dict:
+    """Returns the spec of a stream with its key, a hash of everything that changes its content except the corpus"""
+
+    spec = {
+        'function_name': function_name,
+        'flatten': flatten,
+        'dms_filter_fct': describe_callable(dms_filter_fct),
+        'tags_filter_fct': describe_callable(tags_filter_fct),
+    }
+    spec['key'] = hashlib.sha1(_stable_repr(spec).encode()).hexdigest()
+    return spec
+
+
+def _project_streams(dm, stream_specs: list) -> list:
+    """Returns [(doc id, [pairs for each stream spec])], stream_specs being (function_name, flatten, tags_filter_fct)"""
+
+    return [(dm.get_id(), [project_lemmas(dm, function_name, flatten, tags_filter_fct)
+                           for function_name, flatten, tags_filter_fct in stream_specs])]
+
+
+def get_lemma_streams(path_list, stream_specs: list, dms_filter_fct: Optional[Callable] = None,
+                      workers: Optional[int] = None, streams_path: Path = LEMMA_STREAMS_PATH,
+                      corpus_version: Optional[str] = None) -> list:
+    """Returns a LemmaStream for each (function_name, flatten, tags_filter_fct) spec, building the missing ones
+
+    Streams that are missing or outdated (corpus or spec changed) are all built in a single pass over the corpus, with
+    workers if passed (see generate_projections, filters must then be picklable). corpus_version is computed from
+    path_list if None, see get_corpus_version.
+    """
+
+    streams_path = Path(streams_path)
+    corpus_version = corpus_version or get_corpus_version(path_list)
+    specs = [make_stream_spec(function_name, flatten, dms_filter_fct, tags_filter_fct)
+             for function_name, flatten, tags_filter_fct in stream_specs]
+    paths = [streams_path / f'{spec["key"][:16]}_{corpus_version[:16]}' for spec in specs]
+
+    to_build = {}  # stream path: position in stream_specs, specs sharing a key are built once
+    for i, path in enumerate(paths):
+        if not (path / 'spec.p').is_file():
+            to_build.setdefault(path, i)
+
+    if to_build:
+        print(f'Building {len(to_build)} lemma streams in {streams_path}')
+        timer = Timer()
+        positions = list(to_build.values())
+        writers = [_StreamWriter() for _ in positions]
+        projection = partial(_project_streams, stream_specs=[stream_specs[i] for i in positions])
+        for doc_id, inputs in generate_projections(path_list, projection, dms_filter_fct, workers=workers):
+            for writer, pairs in zip(writers, inputs):
+                writer.add_doc(doc_id, pairs)
+
+        for writer, (path, i) in zip(writers, to_build.items()):
+            # Older versions of the same spec are outdated
+            for old_path in streams_path.glob(f'{specs[i]["key"][:16]}_*'):
+                shutil.rmtree(old_path, ignore_errors=True)
+            writer.save(path, {**specs[i], 'corpus_version': corpus_version, 'n_docs': len(writer.doc_ids)})
+        timer.step('Done building lemma streams.')
+
+    return [LemmaStream(path) for path in paths]
+
+
+def get_lemma_stream(path_list, function_name: str, flatten: bool = True, dms_filter_fct: Optional[Callable] = None,
+                     tags_filter_fct: Optional[Callable] = None, workers: Optional[int] = None,
+                     streams_path: Path = LEMMA_STREAMS_PATH, corpus_version: Optional[str] = None) -> LemmaStream:
+    """Returns the LemmaStream of a single projection, see get_lemma_streams"""
+
+    return get_lemma_streams(path_list, [(function_name, flatten, tags_filter_fct)], dms_filter_fct, workers,
+                             streams_path, corpus_version)[0]
@@ -0,0 +1,202 @@
+"""Throughput, stage times and memory of corpus passes
+
+Timer only gives the total time of a pass, which doesn't tell whether a slow run is bound by I/O, unpickling or the
+counters. Pass a PassMetrics to the generators (or run_analyzers) to record, for each stage of the pass, the time spent,
+the number of calls and the peak memory sampled:
+>>> metrics = PassMetrics('lexcats')
+... for doc_id, lemmas in generate_ids_lemmas(DOCMODEL_PATHS_LIST, 'get_abs_tags', metrics=metrics):
+...     lc.update(doc_id, lemmas)
+... metrics.save_json(working_dir / 'pass_metrics.json')
+
+Stages:
+* open: opening and reading DocModel files (or shard records, or lemma streams), bytes_read counts what was read
+* unpickle: unpickling DocModels from the bytes read
+* projection: getting the tags from a DocModel and projecting them to lemma or tag lists, including lazy payload loads
+* consumer: time spent in the loop consuming the generator, e.g. updating counters
+* wait: with workers, time the consumer waited for the next chunk of projections
+
+With workers, open, unpickle and projection are measured in the worker processes and summed, so they can exceed the
+wall time. Peak RSS is sampled with psutil if installed, else falls back to the peak RSS of the process so far
+(resource module, not available on Windows). Python allocations are traced with tracemalloc if trace_memory is set,
+which slows the pass down noticeably.
+"""
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Optional
+import json
+import sys
+import time
+import tracemalloc
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_process = None
+
+
+def get_rss() -> Optional[int]:
+    """Returns the current RSS of the process in bytes with psutil, else its peak RSS so far, None if unavailable"""
+
+    global _process
+    if psutil is not None:
+        if _process is None:
+            _process = psutil.Process()
+        return _process.memory_info().rss
+    if resource is not None:
+        # ru_maxrss is in kilobytes, except on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    return None
+
+
+def get_rss_source() -> Optional[str]:
+    return 'psutil' if psutil is not None else 'resource' if resource is not None else None
+
+
+class PassMetrics:
+    """Stage times, throughput and memory of a corpus pass, see the module docstring
+
+    Attributes
+    ----------
+    name: str
+        Name of the pass, written in the report.
+    trace_memory: bool
+        Whether to trace Python allocations with tracemalloc, and record the peak traced memory of each stage.
+    stages: dict[str, dict]
+        For each stage: total seconds, number of calls, peak RSS and peak traced memory (bytes).
+    n_docs: int
+        Number of docs read.
+    bytes_read: int
+        Number of bytes read from disk.
+    """
+
+    def __init__(self, name: str = '', trace_memory: bool = False):
+        self.name = name
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.n_docs = 0
+        self.bytes_read = 0
+        self.started_at = datetime.now().isoformat(timespec='seconds')
+        self._start = time.perf_counter()
+        self._end = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __getstate__(self):
+        # Sent back from the workers, perf_counter values are meaningless in another process
+        state = self.__dict__.copy()
+        state['_start'] = state['_end'] = None
+        return state
+
+    @contextmanager
+    def stage(self, name: str):
+        """Context manager adding the time spent in the block to a stage"""
+
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float, calls: int = 1):
+        """Adds time to a stage and samples memory"""
+
+        stats = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'peak_rss': None, 'peak_traced': None})
+        stats['seconds'] += seconds
+        stats['calls'] += calls
+        stats['peak_rss'] = _max(stats['peak_rss'], get_rss())
+        if self.trace_memory:
+            stats['peak_traced'] = _max(stats['peak_traced'], tracemalloc.get_traced_memory()[1])
+
+    def merge(self, other: 'PassMetrics'):
+        """Adds the stages, docs and bytes of other, e.g. metrics sent back from a worker"""
+
+        for name, other_stats in other.stages.items():
+            stats = self.stages.setdefault(name, {'seconds': 0., 'calls': 0, 'peak_rss': None, 'peak_traced': None})
+            stats['seconds'] += other_stats['seconds']
+            stats['calls'] += other_stats['calls']
+            stats['peak_rss'] = _max(stats['peak_rss'], other_stats['peak_rss'])
+            stats['peak_traced'] = _max(stats['peak_traced'], other_stats['peak_traced'])
+        self.n_docs += other.n_docs
+        self.bytes_read += other.bytes_read
+
+    def stop(self):
+        """Ends the pass, the wall time is fixed from here. Stops tracemalloc if it was started."""
+
+        self._end = time.perf_counter()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def get_wall_time(self) -> float:
+        return (self._end or time.perf_counter()) - self._start
+
+    def report(self) -> dict:
+        """Returns the metrics as a json serializable dict"""
+
+        wall_time = self.get_wall_time()
+        stage_time = sum(stats['seconds'] for stats in self.stages.values()) or 1.
+        return {
+            'name': self.name,
+            'started_at': self.started_at,
+            'wall_seconds': wall_time,
+            'n_docs': self.n_docs,
+            'docs_per_sec': self.n_docs / wall_time if wall_time else None,
+            'bytes_read': self.bytes_read,
+            'mb_per_sec': self.bytes_read / 2 ** 20 / wall_time if wall_time else None,
+            'rss_source': get_rss_source(),
+            'peak_rss': _max(*(stats['peak_rss'] for stats in self.stages.values()), get_rss()),
+            'stages': {name: {**stats, 'share': stats['seconds'] / stage_time} for name, stats in self.stages.items()},
+        }
+
+    def save_json(self, path: Path):
+        """Stops the pass and writes the report to path"""
+
+        if self._end is None:
+            self.stop()
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def print_summary(self):
+        report = self.report()
+        print(f'{report["n_docs"]} docs in {report["wall_seconds"]:.1f}s ({report["docs_per_sec"]:.1f} docs/s), '
+              f'{report["bytes_read"] / 2 ** 20:.1f} MB read')
+        for name, stats in report['stages'].items():
+            print(f'  {name}: {stats["seconds"]:.2f}s ({stats["share"]:.0%}), {stats["calls"]} calls')
+
+
+def _max(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def measure(metrics: Optional[PassMetrics], stage: str):
+    """metrics.stage(stage), or a no-op context if metrics is None"""
+
+    return nullcontext() if metrics is None else metrics.stage(stage)
+
+
+def measure_iter(iterable: Iterable, metrics: Optional[PassMetrics], stage: str):
+    """Yields the items of iterable, adding the time spent getting each item to a stage"""
+
+    if metrics is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        with metrics.stage(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
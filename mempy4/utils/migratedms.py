@@ -1,7 +1,8 @@
 
 from mempy4.docmodel import DocModel
 from mempy4.utils.generators import generate_docmodels_from_paths
-from mempy4.config import DOCMODEL_PATHS_LIST, DOCMODELS_PATH, BASE_DATA_PATH
+from mempy4.config import DOCMODEL_PATHS_LIST, DOCMODELS_PATH, BASE_DATA_PATH, DOCMODEL_SHARDS_PATH
+from mempy4.utils.shards import write_shards, ShardReader
 
 import sys
 import pickle
@@ -43,6 +44,18 @@ def migrate_single_dm(source_dm_path):
     clone_m3_docmodel(old, DOCMODELS_PATH)
 
 
+def shard_dms(path_list=DOCMODEL_PATHS_LIST, dest_dir=DOCMODEL_SHARDS_PATH, docs_per_shard=1000, compression=None):
+    """Packs pickled DocModels into shard files (see utils/shards.py), then checks every doc can be read back
+
+    Pass compression='zstd' or 'lz4' to compress the docs, this needs the zstandard or lz4 package.
+    """
+
+    shard_paths = write_shards(generate_docmodels_from_paths(path_list), dest_dir, docs_per_shard, compression)
+    n_docs = sum(len(ShardReader(path)) for path in shard_paths)
+    print(f'Packed {n_docs} docmodels from {len(path_list)} files into {len(shard_paths)} shards in {dest_dir}')
+    return shard_paths
+
+
 if __name__ == '__main__':
     doc = '1477-9560-7-11.p'
     migrate_single_dm(Path('C:/Users/Sanchez/Desktop/m3data/docmodels') / doc)
@@ -0,0 +1,66 @@
+"""Process pool helpers used to spread corpus passes across cores
+
+Functions and arguments sent to the workers must be picklable: use module level functions (e.g. from utils/filters.py)
+or functools.partial, not lambdas. On Windows, scripts using the pool must be run under `if __name__ == '__main__':`.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterable, Optional
+import os
+
+
+def chunk_iterable(iterable: Iterable, size: int):
+    """Yields lists of up to size consecutive items from iterable"""
+
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def parallel_map(fct: Callable, items: Iterable, workers: Optional[int] = None, ordered: bool = True,
+                 prefetch: Optional[int] = None):
+    """Yields fct(item) for each item, computed in a pool of worker processes
+
+    At most prefetch items are submitted ahead of the consumer, so results never pile up in memory if the consumer is
+    slower than the workers.
+
+    Parameters
+    ----------
+    fct: Callable
+        Picklable function applied to each item.
+    items: Iterable
+        Items to process, consumed lazily.
+    workers: int, optional
+        Number of worker processes. Defaults to the number of cores.
+    ordered: bool, default: True
+        If True, results are yielded in the order of items. Else, they are yielded as soon as they are ready.
+    prefetch: int, optional
+        Max number of items in flight. Defaults to 4 per worker.
+    """
+
+    workers = workers or os.cpu_count()
+    prefetch = prefetch or 4 * workers
+    items = iter(items)
+
+    executor = ProcessPoolExecutor(workers)
+    try:
+        pending = deque() if ordered else set()
+        submit = pending.append if ordered else pending.add
+        for item in islice(items, prefetch):
+            submit(executor.submit(fct, item))
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = done.pop()
+                pending.remove(future)
+            result = future.result()
+            for item in islice(items, 1):
+                submit(executor.submit(fct, item))
+            yield result
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
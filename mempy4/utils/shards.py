@@ -0,0 +1,204 @@
+"""Shard files packing many pickled DocModels, to avoid opening one small file per doc
+
+Shard layout:
+* the MAGIC bytes
+* one (optionally compressed) pickled DocModel per record, one after the other
+* the table: a pickled dict with the compression name and a list of (doc id, filename, offset, length) tuples
+* the table offset, as an 8 bytes little endian unsigned int
+
+Docs can be streamed in shard order or read one at a time by id, which only reads the table and the doc's record.
+Compression is optional and requires either the zstandard or the lz4 package.
+
+Use migratedms.shard_dms() to convert a directory of pickled DocModels. Shard paths can be mixed with DocModel paths in
+the path lists passed to the generators.
+"""
+
+from pathlib import Path
+from typing import Iterable, Optional
+import os
+import pickle
+import struct
+
+from mempy4.utils.metrics import measure
+from mempy4.utils.tagvocab import persist_tag_vocab
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+SHARD_SUFFIX = '.dms'
+MAGIC = b'MEMPYDMS'
+COMPRESSIONS = (None, 'zstd', 'lz4')
+
+
+def _compress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return lz4.frame.compress(data)
+
+
+def _decompress(data: bytes, compression: Optional[str]) -> bytes:
+    if compression is None:
+        return data
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return lz4.frame.decompress(data)
+
+
+def is_shard_path(path) -> bool:
+    return Path(path).suffix == SHARD_SUFFIX
+
+
+class ShardWriter:
+    """Writes DocModels to a new shard file. Use as a context manager, or call close() when done.
+
+    The shard is written to a temp file and only moved to path on close, so an interrupted write never leaves a
+    truncated shard behind.
+    """
+
+    def __init__(self, path: Path, compression: Optional[str] = None):
+        assert compression in COMPRESSIONS, f'Error, compression must be one of {COMPRESSIONS}'
+        assert compression != 'zstd' or zstandard is not None, 'Error, zstd compression requires zstandard'
+        assert compression != 'lz4' or lz4 is not None, 'Error, lz4 compression requires lz4'
+
+        self.path = Path(path)
+        self.compression = compression
+        self.table = []
+        self._tmp_path = self.path.with_name(self.path.name + '.tmp')
+        self._file = open(self._tmp_path, 'wb')
+        self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.table)
+
+    def add(self, dm):
+        """Appends a DocModel to the shard. Split payloads are loaded first, shards always hold full DocModels."""
+
+        dm.load_payloads()
+        dm.split_payloads = False
+        persist_tag_vocab()
+        data = _compress(pickle.dumps(dm, protocol=pickle.HIGHEST_PROTOCOL), self.compression)
+        self.table.append((dm.id, dm.filename, self._file.tell(), len(data)))
+        self._file.write(data)
+
+    def close(self):
+        if self._file.closed:
+            return
+        table_offset = self._file.tell()
+        pickle.dump({'compression': self.compression, 'docs': self.table}, self._file)
+        self._file.write(struct.pack('<Q', table_offset))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+
+class ShardReader:
+    """Reads DocModels from a shard file, either sequentially or by doc id"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            assert f.read(len(MAGIC)) == MAGIC, f'Error, {path} is not a DocModel shard'
+            f.seek(-8, os.SEEK_END)
+            table_end = f.tell()
+            (table_offset,) = struct.unpack('<Q', f.read(8))
+            f.seek(table_offset)
+            table = pickle.loads(f.read(table_end - table_offset))
+
+        self.compression = table['compression']
+        self.table = table['docs']
+        self.locations = {doc_id: (offset, length) for doc_id, _, offset, length in self.table}
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.locations
+
+    def __iter__(self):
+        return self.generate_docmodels()
+
+    def get_ids(self) -> list[str]:
+        return [doc_id for doc_id, *_ in self.table]
+
+    def get(self, doc_id: str):
+        """Reads a single DocModel by id"""
+
+        offset, length = self.locations[doc_id]
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return self._load(f.read(length))
+
+    def generate_docmodels(self, doc_ids: Optional[Iterable[str]] = None, metrics=None):
+        """Yields the shard's DocModels in shard order. If doc_ids is passed, only these docs are read.
+
+        Reads and loads are recorded in metrics if a PassMetrics is passed (see utils/metrics.py).
+        """
+
+        selected = None if doc_ids is None else set(doc_ids)
+        with open(self.path, 'rb') as f:
+            for doc_id, _, offset, length in self.table:
+                if selected is None or doc_id in selected:
+                    with measure(metrics, 'open'):
+                        f.seek(offset)
+                        data = f.read(length)
+                    with measure(metrics, 'unpickle'):
+                        dm = self._load(data)
+                    if metrics is not None:
+                        metrics.n_docs += 1
+                        metrics.bytes_read += length
+                    yield dm
+
+    def _load(self, data: bytes):
+        return pickle.loads(_decompress(data, self.compression))
+
+
+class ShardSet:
+    """Random access by doc id across several shards. Only the shard tables are read on init."""
+
+    def __init__(self, shard_paths: Iterable[Path]):
+        self.readers = [ShardReader(path) for path in shard_paths]
+        self.doc_readers = {doc_id: reader for reader in self.readers for doc_id in reader.locations}
+
+    def __len__(self):
+        return len(self.doc_readers)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_readers
+
+    def get(self, doc_id: str):
+        return self.doc_readers[doc_id].get(doc_id)
+
+
+def write_shards(dms: Iterable, dest_dir: Path, docs_per_shard: int = 1000, compression: Optional[str] = None,
+                 name: str = 'docmodels') -> list[Path]:
+    """Packs DocModels into shards of docs_per_shard docs, saved as {name}_{shard num}.dms in dest_dir"""
+
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    shard_paths = []
+    writer = None
+    for dm in dms:
+        if writer is None:
+            shard_paths.append(dest_dir / f'{name}_{len(shard_paths):05d}{SHARD_SUFFIX}')
+            writer = ShardWriter(shard_paths[-1], compression)
+        writer.add(dm)
+        if len(writer) >= docs_per_shard:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+    return shard_paths
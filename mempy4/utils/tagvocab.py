@@ -0,0 +1,190 @@
+"""Corpus-wide vocabulary registry for TreeTagger tags
+
+DocModels store their tags as uint32 arrays of shape (n_tokens, 3), one row per token and one column per tag attribute
+(word, pos, lemma). The TagVocab maps each attribute value to its integer id and back. A single registry is shared by
+the whole corpus and saved at TAG_VOCAB_PATH; use get_tag_vocab() to get it and save_tag_vocab() after tagging new docs.
+
+DocModel.to_pickle calls persist_tag_vocab() first, which appends the values registered since the last save to a log
+next to the vocab (TAG_VOCAB_PATH + '.log'), replayed by get_tag_vocab(). Pickled id arrays can then always be decoded
+in later runs, even if save_tag_vocab() was never called. Only one process should register values at a time.
+
+Counters can work on the ids directly, e.g. by feeding lemma ids to a LexCounter built with an encoded lexicon:
+>>> vocab = get_tag_vocab()
+... lc = LexCounter(vocab.encode_mapping(lexicon, 'lemma'))
+"""
+
+from pathlib import Path
+from typing import Iterable, Mapping, Optional
+import hashlib
+import pickle
+
+import numpy as np
+import treetaggerwrapper
+
+from mempy4.config import TAG_VOCAB_PATH
+
+TAG_FIELDS = ('word', 'pos', 'lemma')
+WORD, POS, LEMMA = range(3)
+
+
+class TagVocab:
+    """Maps the values of each tag attribute (word, pos, lemma) to integer ids
+
+    Attributes
+    ----------
+    values: dict[str, list[str]]
+        For each field, the list of registered values. A value's id is its index in the list.
+    ids: dict[str, dict[str, int]]
+        For each field, maps registered values to their id.
+    """
+
+    def __init__(self):
+        self.values = {field: [] for field in TAG_FIELDS}
+        self.ids = {field: {} for field in TAG_FIELDS}
+        self._n_persisted = {field: 0 for field in TAG_FIELDS}
+
+    def __len__(self):
+        return sum(len(v) for v in self.values.values())
+
+    def get_id(self, field: str, value: str) -> int:
+        """Returns the id of value for field, registering it if needed"""
+
+        ids = self.ids[field]
+        try:
+            return ids[value]
+        except KeyError:
+            ids[value] = len(ids)
+            self.values[field].append(value)
+            return ids[value]
+
+    def lookup(self, field: str, value: str) -> Optional[int]:
+        """Returns the id of value for field without registering it, or None if value is unknown"""
+
+        return self.ids[field].get(value)
+
+    def decode(self, field: str, value_id: int) -> str:
+        return self.values[field][value_id]
+
+    def encode_values(self, field: str, values: Iterable[str], vocal: bool = True) -> list[int]:
+        """Returns the ids of known values. Unknown values are dropped, with a warning if vocal."""
+
+        ids = self.ids[field]
+        values = list(values)
+        unknown = [v for v in values if v not in ids]
+        if vocal and unknown:
+            print(f'Warning! {len(unknown)} {field} values unknown to the tag vocab were dropped: {unknown[:10]}')
+        return [ids[v] for v in values if v in ids]
+
+    def encode_mapping(self, mapping: Mapping[str, Iterable[str]], field: str = 'lemma', vocal: bool = True) -> dict:
+        """Encodes the values of a {key: [values]} mapping (e.g. a lexicon). Keys are kept, unknown values are dropped"""
+
+        encoded = {key: self.encode_values(field, values, vocal=False) for key, values in mapping.items()}
+        if vocal:
+            self.encode_values(field, {v for values in mapping.values() for v in values})
+        return encoded
+
+    def encode_tags(self, tags: Iterable) -> np.ndarray:
+        """Encodes a list of TreeTagger Tags as an uint32 array of shape (n_tags, 3)"""
+
+        encoded = [(self.get_id('word', tag.word), self.get_id('pos', tag.pos), self.get_id('lemma', tag.lemma))
+                   for tag in tags]
+        return np.array(encoded, dtype=np.uint32).reshape(-1, 3)
+
+    def decode_tags(self, tag_ids: np.ndarray) -> list:
+        """Decodes an array made by encode_tags back to a list of TreeTagger Tags"""
+
+        self.check_ids(tag_ids)
+        words, pos, lemmas = self.values['word'], self.values['pos'], self.values['lemma']
+        return [treetaggerwrapper.Tag(words[w], pos[p], lemmas[l]) for w, p, l in tag_ids.tolist()]
+
+    def get_version(self) -> str:
+        """Hash of the registered values, changes whenever ids are decoded differently (e.g. values were added)"""
+
+        sha = hashlib.sha1()
+        for field in TAG_FIELDS:
+            sha.update(f'{field}\0{len(self.values[field])}\0'.encode())
+            sha.update('\0'.join(self.values[field]).encode())
+        return sha.hexdigest()
+
+    def check_ids(self, tag_ids: np.ndarray):
+        """Raises a ValueError if a (n_tags, 3) id array holds ids unknown to the vocab"""
+
+        if len(tag_ids) and (tag_ids.max(axis=0) >= [len(self.values[field]) for field in TAG_FIELDS]).any():
+            raise ValueError('Unknown tag ids, the tags were encoded with values missing from the tag vocab. '
+                             'Was it saved after tagging (see save_tag_vocab)?')
+
+    def get_unpersisted(self) -> dict:
+        """Returns {field: (first id, values)} for the values registered since the vocab was last saved or logged"""
+
+        n_persisted = self.__dict__.setdefault('_n_persisted', {field: len(self.values[field]) for field in TAG_FIELDS})
+        return {field: (n_persisted[field], self.values[field][n_persisted[field]:]) for field in TAG_FIELDS
+                if len(self.values[field]) > n_persisted[field]}
+
+    def set_persisted(self):
+        self._n_persisted = {field: len(self.values[field]) for field in TAG_FIELDS}
+
+    def replay(self, record: dict):
+        """Registers the values of a get_unpersisted() record, checking their ids match"""
+
+        for field, (first_id, values) in record.items():
+            known = self.values[field][first_id:first_id + len(values)]
+            if first_id > len(self.values[field]) or known != values[:len(known)]:
+                raise ValueError(f'Tag vocab log does not match the tag vocab on {field} values')
+            for value in values[len(known):]:
+                self.get_id(field, value)
+
+    def to_pickle(self, path=TAG_VOCAB_PATH):
+        """Pickles the TagVocab object at the specified location."""
+
+        pickle.dump(self, open(path, 'wb'))
+
+    @classmethod
+    def read_pickle(cls, path=TAG_VOCAB_PATH):
+        return pickle.load(open(path, 'rb'))
+
+
+_tag_vocab = None
+
+
+def get_tag_vocab() -> TagVocab:
+    """Returns the corpus TagVocab, loaded from TAG_VOCAB_PATH on first call (or created if there is none yet)"""
+
+    global _tag_vocab
+    if _tag_vocab is None:
+        try:
+            _tag_vocab = TagVocab.read_pickle(TAG_VOCAB_PATH)
+        except FileNotFoundError:
+            _tag_vocab = TagVocab()
+        try:
+            with open(_get_log_path(), 'rb') as f:
+                while True:
+                    _tag_vocab.replay(pickle.load(f))
+        except (FileNotFoundError, EOFError):
+            pass
+        _tag_vocab.set_persisted()
+    return _tag_vocab
+
+
+def save_tag_vocab():
+    """Saves the corpus TagVocab to TAG_VOCAB_PATH and clears its log. Call it after encoding tags of new docs."""
+
+    vocab = get_tag_vocab()
+    vocab.set_persisted()
+    vocab.to_pickle(TAG_VOCAB_PATH)
+    _get_log_path().unlink(missing_ok=True)
+
+
+def persist_tag_vocab():
+    """Appends the values registered since the last save to the tag vocab log, so ids written to disk can be decoded"""
+
+    if _tag_vocab is None:
+        return
+    record = _tag_vocab.get_unpersisted()
+    if record:
+        with open(_get_log_path(), 'ab') as f:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+        _tag_vocab.set_persisted()
+
+
+def _get_log_path() -> Path:
+    return Path(f'{TAG_VOCAB_PATH}.log')
@@ -0,0 +1,189 @@
+"""Read-only views over the tags of a doc section
+
+A TokenView holds the tags of a section (text or abstract) as one id column per tag attribute (word, pos, lemma), all
+slices of a single backing buffer, along with the offsets of each paragraph. Paragraphs, sentences and slices are
+TokenViews over the same buffer, so no intermediate list is built until tags are actually decoded:
+>>> tokens = dm.get_text_tokens()
+... n_tokens, n_paras = len(tokens), tokens.n_paragraphs()
+... lemmas = tokens.get_strings('lemma')
+... for sentence in tokens.sentences():
+...     tags = sentence.tags()
+
+Iterating or indexing a TokenView yields TreeTagger Tags, as the lists returned by DocModel.get_text_tags.
+
+Sentence bounds are computed once when docs are tagged (see DocModel.set_section_tags) and passed to the views, so
+sentences are sliced directly. Views made without bounds find them by scanning the pos column for SENT tags.
+"""
+
+from typing import Iterable, Mapping, Optional
+
+import numpy as np
+import treetaggerwrapper
+
+from mempy4.utils.tagvocab import TAG_FIELDS, get_tag_vocab
+
+
+class TokenView:
+    """Sequence of Tags over id columns, with paragraph offsets
+
+    Attributes
+    ----------
+    columns: dict[str, np.ndarray]
+        For each tag field (word, pos, lemma), a 1d array of value ids, or None if the field was not loaded.
+    values: dict[str, list[str]]
+        For each tag field, the list of values represented by the ids (e.g. TagVocab.values).
+    para_offsets: np.ndarray
+        Index of the first token of each paragraph, plus the number of tokens (n_paragraphs + 1 values).
+    sent_bounds: np.ndarray, optional
+        (start, end) token indexes of each sentence, as a (n_sentences, 2) array. Found from the pos column if None.
+    """
+
+    def __init__(self, columns: Mapping[str, Optional[np.ndarray]], values: Mapping[str, list],
+                 para_offsets: Optional[np.ndarray] = None, sent_bounds: Optional[np.ndarray] = None):
+        self.columns = {field: columns.get(field) for field in TAG_FIELDS}
+        self.values = values
+        if para_offsets is None:
+            para_offsets = np.array([0, len(next(col for col in self.columns.values() if col is not None))])
+        self.para_offsets = para_offsets
+        self.sent_bounds = sent_bounds
+        self._len = int(para_offsets[-1])
+
+    @classmethod
+    def from_paragraphs(cls, paragraphs: Optional[list], vocab=None,
+                        sent_bounds: Optional[np.ndarray] = None) -> 'TokenView':
+        """Makes a view over the tags of a DocModel section: a list of (n_tags, 3) id arrays, one per paragraph
+
+        Paragraphs from older DocModels (lists of Tags) are encoded with the tag vocab first.
+        """
+
+        vocab = vocab or get_tag_vocab()
+        paragraphs = paragraphs or []
+        if paragraphs and not isinstance(paragraphs[0], np.ndarray):
+            paragraphs = [vocab.encode_tags(para) for para in paragraphs]
+
+        buffer = np.concatenate(paragraphs) if paragraphs else np.empty((0, 3), dtype=np.uint32)
+        vocab.check_ids(buffer)
+        para_offsets = np.zeros(len(paragraphs) + 1, dtype=np.int64)
+        np.cumsum([len(para) for para in paragraphs], out=para_offsets[1:])
+        return cls({field: buffer[:, i] for i, field in enumerate(TAG_FIELDS)}, vocab.values, para_offsets, sent_bounds)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return iter(self.tags())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self._view(item)
+        if item < 0:
+            item += self._len
+        if not 0 <= item < self._len:
+            raise IndexError('TokenView index out of range')
+        return treetaggerwrapper.Tag(*(None if col is None else self.values[field][col[item]]
+                                       for field, col in self.columns.items()))
+
+    def __repr__(self):
+        return f'TokenView({self._len} tokens, {self.n_paragraphs()} paragraphs)'
+
+    def _view(self, item: slice, para_offsets: Optional[np.ndarray] = None) -> 'TokenView':
+        """View of a slice of the tokens, as a single paragraph unless para_offsets are passed"""
+
+        columns = {field: None if col is None else col[item] for field, col in self.columns.items()}
+        return TokenView(columns, self.values, para_offsets)
+
+    def get_column(self, field: str) -> Optional[np.ndarray]:
+        """Returns the value ids of a tag field (word, pos or lemma), as a view on the buffer"""
+
+        return self.columns[field]
+
+    def get_strings(self, field: str) -> list:
+        """Returns the decoded values of a tag field, e.g. the list of lemmas"""
+
+        col = self.columns[field]
+        if col is None:
+            return [None] * self._len
+        values = self.values[field]
+        return [values[i] for i in col.tolist()]
+
+    def get_ids(self) -> np.ndarray:
+        """Returns the tokens as a (n_tags, 3) id array, as stored in DocModels (see DocModel.get_text_tag_ids)"""
+
+        assert all(col is not None for col in self.columns.values()), 'Error, all tag fields must be loaded'
+        return np.stack([self.columns[field] for field in TAG_FIELDS], axis=1)
+
+    def tags(self) -> list:
+        """Decodes the tokens to a list of Tags"""
+
+        return [treetaggerwrapper.Tag(*t) for t in zip(*(self.get_strings(field) for field in TAG_FIELDS))]
+
+    def select(self, field: str, accepted: Iterable[str]) -> 'TokenView':
+        """Returns a view of the tokens whose field value is in accepted, e.g. select('pos', TT_NVA_TAGS)
+
+        Unlike other views, the selected tokens are copied and paragraph boundaries are lost.
+        """
+
+        accepted = set(accepted)
+        accepted_ids = [i for i, value in enumerate(self.values[field]) if value in accepted]
+        mask = np.isin(self.columns[field], accepted_ids)
+        return self._view(mask)
+
+    def n_paragraphs(self) -> int:
+        return len(self.para_offsets) - 1
+
+    def paragraph(self, i: int) -> 'TokenView':
+        return self._view(slice(int(self.para_offsets[i]), int(self.para_offsets[i + 1])))
+
+    def paragraphs(self):
+        """Yields a view for each paragraph"""
+
+        for i in range(self.n_paragraphs()):
+            yield self.paragraph(i)
+
+    def sentence_bounds(self) -> np.ndarray:
+        """Returns the (start, end) token indexes of each sentence, as a (n_sentences, 2) array
+
+        Same splitting as DocModel.get_text_sentences_tags: tokens are split on SENT tags, across paragraphs, SENT tags
+        are left out and tokens after the last SENT tag are dropped.
+        """
+
+        if self.sent_bounds is None:
+            self.sent_bounds = find_sentence_bounds(self.columns['pos'], self.values['pos'])
+        return self.sent_bounds
+
+    def n_sentences(self) -> int:
+        return len(self.sentence_bounds())
+
+    def sentence(self, i: int) -> 'TokenView':
+        start, end = self.sentence_bounds()[i]
+        return self._view(slice(int(start), int(end)))
+
+    def sentences(self):
+        """Yields a view for each sentence, see sentence_bounds"""
+
+        for start, end in self.sentence_bounds().tolist():
+            yield self._view(slice(start, end))
+
+    def sentence_paragraphs(self) -> np.ndarray:
+        """Returns the number of the paragraph each sentence starts in"""
+
+        return np.searchsorted(self.para_offsets, self.sentence_bounds()[:, 0], side='right') - 1
+
+    def paragraph_sentences(self, i: int) -> range:
+        """Returns the numbers of the sentences starting in paragraph i"""
+
+        starts = self.sentence_bounds()[:, 0]
+        return range(*np.searchsorted(starts, self.para_offsets[i:i + 2]).tolist())
+
+
+def find_sentence_bounds(pos_ids: Optional[np.ndarray], pos_values: Optional[list]) -> np.ndarray:
+    """Returns the (start, end) token indexes of the sentences delimited by SENT tags in a pos id column"""
+
+    if pos_ids is None or 'SENT' not in pos_values:
+        return np.empty((0, 2), dtype=np.int64)
+    ends = np.flatnonzero(pos_ids == pos_values.index('SENT'))
+    bounds = np.empty((len(ends), 2), dtype=np.int64)
+    bounds[:1, 0] = 0
+    bounds[1:, 0] = ends[:-1] + 1
+    bounds[:, 1] = ends
+    return bounds
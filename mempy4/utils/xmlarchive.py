@@ -0,0 +1,60 @@
+"""Append-only archive of the source XML files
+
+DocModels ingested in streaming mode (see preprocess/ingest.py) don't keep their parsed tree. Instead, the source XML is
+appended to an archive file in XML_ARCHIVE_PATH and the DocModel keeps a reference to it, xml_ref: (archive filename,
+offset, length). The tree is parsed back from the archive the first time dm.tree is accessed.
+
+Archives are only ever appended to, so refs held by DocModels stay valid. Refs only hold the archive filename, archives
+can be moved along with XML_ARCHIVE_PATH.
+"""
+
+from pathlib import Path
+import io
+import xml.etree.ElementTree as ET
+
+from mempy4.config import XML_ARCHIVE_PATH
+
+ARCHIVE_SUFFIX = '.xmla'
+
+
+class XmlArchiveWriter:
+    """Appends XML docs to an archive file. Use as a context manager, or call close() when done."""
+
+    def __init__(self, name: str = 'xml_sources', archive_dir: Path = XML_ARCHIVE_PATH):
+        Path(archive_dir).mkdir(parents=True, exist_ok=True)
+        self.filename = name + ARCHIVE_SUFFIX
+        self._file = open(Path(archive_dir) / self.filename, 'ab')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, data: bytes) -> tuple[str, int, int]:
+        """Appends a doc's XML bytes, returns its ref (archive filename, offset, length)"""
+
+        offset = self._file.tell()
+        self._file.write(data)
+        return self.filename, offset, len(data)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_xml(xml_ref: tuple[str, int, int], archive_dir: Path = XML_ARCHIVE_PATH) -> bytes:
+    """Returns the XML bytes of a doc from its ref"""
+
+    filename, offset, length = xml_ref
+    with open(Path(archive_dir) / filename, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def read_xml_tree(xml_ref: tuple[str, int, int], archive_dir: Path = XML_ARCHIVE_PATH) -> ET.ElementTree:
+    """Parses the XML of a doc from its ref"""
+
+    return ET.parse(io.BytesIO(read_xml(xml_ref, archive_dir)))
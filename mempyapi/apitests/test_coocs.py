@@ -0,0 +1,211 @@
+"""Tests of CoocsCounter and CoocsCounterTags against small hand-computed cases
+
+Run with: python -m unittest discover mempyapi/apitests
+"""
+
+from collections import Counter, namedtuple
+from unittest import mock
+import pickle
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from mempyapi import coocs
+from mempyapi.coocs import CoocsCounter, shuffle_ref_ids
+from mempyapi.extensions.coocstags import CoocsCounterTags
+
+# Same fields as treetaggerwrapper.Tag
+Tag = namedtuple('Tag', ['word', 'pos', 'lemma'])
+
+# 'cat' is listed twice, duplicate vocab words count as a single word
+VOCAB = ['cat', 'dog', 'cat']
+WINDOW = 1
+DOCS = [
+    ('d1', ['cat', 'eats', 'dog', 'cat']),
+    ('d2', ['dog', 'dog', 'bird']),
+]
+
+# d1: cat -> eats | dog -> eats, cat | cat -> dog, the (cat, dog) pair is found from both sides
+# d2: dog -> (dog is not its own cooc) | dog -> bird
+EXPECTED_COOCS = {
+    'cat': Counter({'eats': 1, 'dog': 1}),
+    'dog': Counter({'eats': 1, 'cat': 1, 'bird': 1}),
+}
+EXPECTED_WORD_OCCS = Counter({'cat': 2, 'dog': 3})
+EXPECTED_REFS = {('cat', 'dog'): Counter({'d1': 2})}
+# Vocab words in the order they were found, context words in the order they were first seen
+EXPECTED_DF = pd.DataFrame([[np.nan, 1], [1, 1], [1, np.nan], [np.nan, 1]],
+                           index=['cat', 'eats', 'dog', 'bird'], columns=['cat', 'dog'])
+
+
+def pos_is_verb(tag) -> bool:
+    return tag.pos == 'VV'
+
+
+def make_counter(docs=DOCS, **kwargs) -> CoocsCounter:
+    cc = CoocsCounter(VOCAB, WINDOW, **kwargs)
+    for doc_id, words in docs:
+        cc.update(doc_id, words)
+    return cc
+
+
+def make_corpus(n_docs: int = 60, seed: int = 0) -> list:
+    """Random docs over a small vocabulary, so that pairs are found in many docs"""
+
+    rng = np.random.default_rng(seed)
+    words = [f'w{i}' for i in range(12)]
+    return [(f'doc{i}', [words[j] for j in rng.integers(0, len(words), rng.integers(0, 30))]) for i in range(n_docs)]
+
+
+class TestCoocsCounter(unittest.TestCase):
+
+    def assert_same_results(self, cc, other):
+        self.assertEqual(cc.coocs, other.coocs)
+        self.assertEqual(list(cc.word_occs.items()), list(other.word_occs.items()))
+        self.assertEqual(dict(cc.refs), dict(other.refs))
+        pd.testing.assert_frame_equal(cc.as_df(), other.as_df())
+
+    def test_hand_computed(self):
+        cc = make_counter()
+        self.assertEqual(cc.coocs, EXPECTED_COOCS)
+        self.assertEqual(cc.word_occs, EXPECTED_WORD_OCCS)
+        self.assertEqual(dict(cc.refs), EXPECTED_REFS)
+        pd.testing.assert_frame_equal(cc.as_df(), EXPECTED_DF)
+
+    def test_as_df_filter(self):
+        df = make_counter().as_df(filter_fct=lambda word: word != 'eats')
+        pd.testing.assert_frame_equal(df, EXPECTED_DF.drop(index='eats'))
+
+    def test_update_coocs_or_refs_only(self):
+        cc = CoocsCounter(VOCAB, WINDOW)
+        for doc_id, words in DOCS:
+            cc.update_coocs_only(doc_id, words)
+        self.assertEqual(cc.coocs, EXPECTED_COOCS)
+        self.assertEqual(dict(cc.refs), {})
+
+        cc = CoocsCounter(VOCAB, WINDOW)
+        for doc_id, words in DOCS:
+            cc.update_refs_only(doc_id, words)
+        self.assertEqual(cc.coocs, {})
+        self.assertEqual(dict(cc.refs), EXPECTED_REFS)
+
+    def test_small_buffers(self):
+        """Results don't depend on when the coocs and refs buffers are flushed"""
+
+        corpus = make_corpus()
+        vocab = [f'w{i}' for i in range(6)]
+        expected = CoocsCounter(vocab, 2)
+        for doc_id, words in corpus:
+            expected.update(doc_id, words)
+        with mock.patch.object(coocs, 'FLUSH_SIZE', 3), mock.patch.object(coocs, 'REFS_FLUSH_SIZE', 2):
+            cc = CoocsCounter(vocab, 2)
+            for doc_id, words in corpus:
+                cc.update(doc_id, words)
+            self.assert_same_results(cc, expected)
+
+    def test_merge_equals_sequential(self):
+        corpus = make_corpus()
+        vocab = [f'w{i}' for i in range(6)] + ['w0']
+        for kwargs in ({}, {'refs_sample_size': 5, 'random_state': 1}):
+            with self.subTest(**kwargs):
+                sequential = CoocsCounter(vocab, 2, **kwargs)
+                for doc_id, words in corpus:
+                    sequential.update(doc_id, words)
+
+                chunks = [CoocsCounter(vocab, 2, **kwargs) for _ in range(3)]
+                for i, (doc_id, words) in enumerate(corpus):
+                    chunks[i * len(chunks) // len(corpus)].update(doc_id, words)
+                merged = chunks[0].merge(*chunks[1:])
+                self.assert_same_results(merged, sequential)
+
+    def test_shuffled_refs_same_across_workers(self):
+        """Seeded ref samples don't depend on how docs were split across workers or clusters before merging"""
+
+        corpus = [(f'{doc_id}_{i}', words[i:i + 10]) for doc_id, words in make_corpus() for i in range(0, 30, 10)]
+        vocab = [f'w{i}' for i in range(6)]
+        for kwargs in ({}, {'refs_sample_size': 5, 'random_state': 1}):
+            with self.subTest(**kwargs):
+                sequential = CoocsCounter(vocab, 2, **kwargs)
+                for para_id, words in corpus:
+                    sequential.update(para_id, words)
+                expected = shuffle_ref_ids(sequential.refs, 42)
+                self.assertEqual(sorted(expected), sorted(sequential.refs))
+                self.assertEqual(sorted(map(sorted, expected.values())), sorted(map(sorted, sequential.refs.values())))
+
+                for n_workers in (2, 3, 7):
+                    # Consecutive chunks, as in run_map_reduce, and interleaved groups, as clusters merged in a total
+                    for group_of in (lambda i: i * n_workers // len(corpus), lambda i: i % n_workers):
+                        chunks = [CoocsCounter(vocab, 2, **kwargs) for _ in range(n_workers)]
+                        for i, (para_id, words) in enumerate(corpus):
+                            chunks[group_of(i)].update(para_id, words)
+                        merged = CoocsCounter(vocab, 2, **kwargs).merge(*chunks)
+                        self.assertEqual(shuffle_ref_ids(merged.refs, 42), expected)
+
+    def test_merge_checks_vocab(self):
+        with self.assertRaises(AssertionError):
+            CoocsCounter(VOCAB, WINDOW).merge(CoocsCounter(['cat', 'dog'], WINDOW))
+
+    def test_pickle_round_trip(self):
+        for kwargs in ({}, {'refs_sample_size': 5, 'random_state': 1}):
+            with self.subTest(**kwargs):
+                cc = make_counter(**kwargs)
+                loaded = pickle.loads(pickle.dumps(cc))
+                self.assert_same_results(loaded, cc)
+
+                # Unpickled counters keep counting
+                cc.update('d3', ['bird', 'cat', 'dog'])
+                loaded.update('d3', ['bird', 'cat', 'dog'])
+                self.assert_same_results(loaded, cc)
+
+
+class TestCoocsCounterTags(unittest.TestCase):
+
+    def test_filter_and_lemma_rules(self):
+        """Vocab words are only counted if the filter rejects their tag, coocs only if it accepts it and the lemma
+        differs"""
+
+        cc = CoocsCounterTags(['cat', 'dog'], 1, pos_is_verb)
+        cc.update('d1', [Tag('cats', 'NN', 'cat'), Tag('eat', 'VV', 'eat'), Tag('dog', 'NN', 'dog'),
+                         Tag('cat', 'VV', 'cat'), Tag('runs', 'VV', 'run')])
+        # The verb 'cat' is not a vocab hit, but is a cooc of 'dog'. 'run' is out of the window of any hit.
+        self.assertEqual(cc.coocs, {'cat': Counter({'eat': 1}), 'dog': Counter({'eat': 1, 'cat': 1})})
+        self.assertEqual(cc.word_occs, Counter({'cat': 1, 'dog': 1}))
+        self.assertEqual(dict(cc.refs), {})
+
+    def test_tag_attribute(self):
+        """Coocs are keyed by the tag attribute, word occurrences by lemma, and words sharing the hit's lemma are not
+        coocs"""
+
+        cc = CoocsCounterTags(['cats'], 2, pos_is_verb, tag_attribute='word')
+        cc.update('d1', [Tag('cats', 'NN', 'cat'), Tag('cat', 'VV', 'cat'), Tag('eats', 'VV', 'eat')])
+        self.assertEqual(cc.coocs, {'cats': Counter({'eats': 1})})
+        self.assertEqual(cc.word_occs, Counter({'cat': 1}))
+
+    def test_merge_equals_sequential(self):
+        rng = np.random.default_rng(2)
+        corpus = [(f'doc{i}', [Tag(f'w{j}', pos, f'w{j // 2}') for j, pos in
+                               zip(rng.integers(0, 12, 20), rng.choice(['NN', 'VV'], 20))]) for i in range(30)]
+        vocab = ['w0', 'w1', 'w2']
+        sequential = CoocsCounterTags(vocab, 2, pos_is_verb)
+        for doc_id, tags in corpus:
+            sequential.update(doc_id, tags)
+
+        chunks = [CoocsCounterTags(vocab, 2, pos_is_verb) for _ in range(3)]
+        for i, (doc_id, tags) in enumerate(corpus):
+            chunks[i % len(chunks)].update(doc_id, tags)
+        merged = chunks[0].merge(*chunks[1:])
+        self.assertEqual(merged.coocs, sequential.coocs)
+        self.assertEqual(merged.word_occs, sequential.word_occs)
+
+    def test_pickle_round_trip(self):
+        cc = CoocsCounterTags(['cat', 'dog'], 1, pos_is_verb)
+        cc.update('d1', [Tag('cats', 'NN', 'cat'), Tag('eat', 'VV', 'eat'), Tag('dog', 'NN', 'dog')])
+        loaded = pickle.loads(pickle.dumps(cc))
+        self.assertEqual(loaded.coocs, cc.coocs)
+        self.assertEqual(loaded.word_occs, cc.word_occs)
+        self.assertIs(loaded.filter_fct, pos_is_verb)
+
+
+if __name__ == '__main__':
+    unittest.main()
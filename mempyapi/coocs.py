@@ -1,9 +1,455 @@
 """Coocs!"""
 
 from typing import Callable, Iterable, Optional
-from collections import defaultdict, Counter
+from array import array
+from collections import Counter
+from collections.abc import Mapping
+from itertools import islice
+import numpy as np
 import pandas as pd
+import hashlib
 import pickle
+import random
+from scipy import sparse
+
+# Number of buffered (vocab word, context word) pairs before they are added to the sparse matrix
+FLUSH_SIZE = 2 ** 22
+# Number of buffered refs postings before they are sorted into a run (see CoocsRefs)
+REFS_FLUSH_SIZE = 2 ** 20
+POSTING_FIELDS = ('pos', 'docs', 'paras', 'counts')
+
+
+def window_positions(hits: np.ndarray, n: int, window: int):
+    """Returns (hit index, position) arrays for all the positions within window of each hit, hits themselves excluded
+
+    Positions are ordered hit by hit, then from left to right, and clipped to [0, n).
+    """
+
+    offsets = np.r_[-window:0, 1:window + 1]
+    positions = hits[:, None] + offsets[None, :]
+    hit_idx = np.broadcast_to(np.arange(len(hits))[:, None], positions.shape)
+    valid = (positions >= 0) & (positions < n)
+    return hit_idx[valid], positions[valid]
+
+
+class CoocsMatrix:
+    """Sparse cooccurrence results, as returned by CoocsCounter.as_matrix()
+
+    Holds the counts as a scipy.sparse matrix with a row for each vocab word found and a column for each word
+    cooccurring at least once with one of them, along with the row and column labels. Top cooccurrences and normalized
+    counts are computed on the sparse data, the dense DataFrame of as_df() is never built. Saved as a compressed npz,
+    a small fraction of the size of the pickled df.
+
+    Attributes
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        The cooccurrence counts (or normalized values), vocab words by context words.
+    vocab_words: list[str]
+        Row labels, the vocab words found at least once.
+    context_words: list[str]
+        Column labels, the words cooccurring with a vocab word.
+    word_occs: np.ndarray
+        Number of occurrences of each vocab word (row).
+    """
+
+    def __init__(self, matrix: sparse.spmatrix, vocab_words: list[str], context_words: list[str],
+                 word_occs: Iterable[int]):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.vocab_words = list(vocab_words)
+        self.context_words = list(context_words)
+        self.word_occs = np.asarray(word_occs)
+        self._rows = {word: i for i, word in enumerate(self.vocab_words)}
+
+    def __repr__(self):
+        return f'CoocsMatrix({len(self.vocab_words)} vocab words, {len(self.context_words)} context words, ' \
+               f'{self.matrix.nnz} coocs)'
+
+    def get_coocs(self, word: str) -> pd.Series:
+        """Returns the non-zero cooccurrences of a vocab word, indexed by context word"""
+
+        row = self._rows[word]
+        beg, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        return pd.Series(self.matrix.data[beg:end], index=[self.context_words[col] for col in
+                                                           self.matrix.indices[beg:end].tolist()], name=word)
+
+    def top_k(self, word: str, k: int = 100) -> pd.Series:
+        """Returns the k largest cooccurrences of a vocab word, ties kept in context words order"""
+
+        row = self._rows[word]
+        beg, end = self.matrix.indptr[row], self.matrix.indptr[row + 1]
+        cols, values = self.matrix.indices[beg:end], self.matrix.data[beg:end]
+        order = np.lexsort((cols, -values))[:k]
+        return pd.Series(values[order], index=[self.context_words[col] for col in cols[order].tolist()], name=word)
+
+    def top_k_dict(self, k: int = 100) -> dict:
+        """Returns {vocab word: [(context word, value), ...]} with the k largest cooccurrences of each vocab word"""
+
+        return {word: list(self.top_k(word, k).items()) for word in self.vocab_words}
+
+    def normalized(self, by: str = 'occs') -> 'CoocsMatrix':
+        """Returns a CoocsMatrix of normalized values, still sparse
+
+        by='occs': counts divided by the number of occurrences of the vocab word (coocs per occurrence)
+        by='row': counts divided by the total coocs of the vocab word, each row summing to 1
+        """
+
+        assert by in ('occs', 'row'), 'Error, by must be either "occs" or "row"'
+        totals = self.word_occs if by == 'occs' else np.asarray(self.matrix.sum(axis=1)).ravel()
+        scale = np.divide(1., totals, out=np.zeros(len(totals)), where=totals > 0)
+        return CoocsMatrix(sparse.diags(scale) @ self.matrix, self.vocab_words, self.context_words, self.word_occs)
+
+    def to_sparse_df(self) -> pd.DataFrame:
+        """Returns a DataFrame with the same layout as CoocsCounter.as_df() (context words by vocab words), backed by
+        sparse columns with 0 as the fill value"""
+
+        return pd.DataFrame.sparse.from_spmatrix(self.matrix.T.tocsc(), index=self.context_words,
+                                                 columns=self.vocab_words)
+
+    def save_npz(self, path):
+        """Saves the matrix, labels and word occurrences in a compressed npz file"""
+
+        np.savez_compressed(path, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                            shape=np.array(self.matrix.shape), vocab_words=np.array(self.vocab_words, dtype=str),
+                            context_words=np.array(self.context_words, dtype=str), word_occs=self.word_occs)
+
+    @classmethod
+    def load_npz(cls, path) -> 'CoocsMatrix':
+        with np.load(path) as npz:
+            matrix = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=tuple(npz['shape']))
+            return cls(matrix, npz['vocab_words'].tolist(), npz['context_words'].tolist(), npz['word_occs'])
+
+
+def _downcast(values: np.ndarray) -> np.ndarray:
+    """Returns values as the smallest int dtype holding them"""
+
+    if not len(values):
+        return values
+    return values.astype(np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max())))
+
+
+def _sort_postings(pos: np.ndarray, docs: np.ndarray, paras: np.ndarray, counts: np.ndarray) -> tuple:
+    """Sorts postings by pair position, keeping the order they were added in for each pair, and sums the counts of
+    postings of the same (pair, id), kept at the place of the first one. Returns the downcast arrays."""
+
+    seq = np.arange(len(pos))
+    order = np.lexsort((seq, paras, docs, pos))
+    pos, docs, paras = pos[order], docs[order], paras[order]
+    starts = np.flatnonzero(np.r_[len(pos) > 0, (np.diff(pos) != 0) | (np.diff(docs) != 0) | (np.diff(paras) != 0)])
+    counts = np.add.reduceat(counts[order].astype(np.int64), starts) if len(starts) else counts
+    first = order[starts]
+    pos, docs, paras = pos[starts], docs[starts], paras[starts]
+    final = np.lexsort((first, pos))
+    return tuple(_downcast(values[final]) for values in (pos, docs, paras, counts))
+
+
+class CoocsRefs(Mapping):
+    """Cooccurrence references of a CoocsCounter, stored as integer posting arrays
+
+    Maps each sorted (word, word) tuple of vocab words cooccurring at least once to a Counter of the ids (typically
+    paragraph ids, like '1471-2121-11-53_12') where they were found, with the number of coocs. Ids are stored as
+    (doc index, paragraph index) postings: ids are split on their last '_' when followed by a paragraph number, the
+    doc part being kept once in doc_ids (paragraph index is -1 for ids without a paragraph number). Postings are
+    appended to typed int32 buffers, then sorted by pair into runs of arrays with the smallest int dtype holding their
+    values (e.g. uint16 doc indices on corpus of less than 65536 docs, uint8 counts). Runs are merged as they grow,
+    and into a single run when pairs are read. Counters are only built when a pair is read.
+
+    Pairs and ids are kept in the order they were first found, as with the defaultdict(Counter) this replaces.
+
+    Attributes
+    ----------
+    vocab: list[str]
+        Vocab of the CoocsCounter, pairs are encoded from vocab rows.
+    doc_ids: list[str]
+        Doc part of every id added, the position of a doc being its doc index.
+    """
+
+    def __init__(self, vocab: list[str]):
+        self.vocab = vocab
+        self.doc_ids = []
+        self._doc_index = {}
+        self._vocab_ids = {}
+        for i, word in enumerate(self.vocab):
+            self._vocab_ids.setdefault(word, i)
+        self._pair_pos = {}  # Pair code (first row * len(vocab) + second row): position, in the order first found
+        # New postings, one int32 array per field, turned into a sorted run once REFS_FLUSH_SIZE postings are buffered
+        self._buffer = {field: array('i') for field in POSTING_FIELDS}
+        # Sorted runs of postings: (pos, docs, paras, counts) arrays ordered by pair position, then first found
+        self._runs = []
+        self._indptr = None  # Postings of the pair at position i: [indptr[i], indptr[i + 1]) of the single run
+
+    def _get_doc(self, doc_id: str) -> int:
+        doc = self._doc_index.setdefault(doc_id, len(self._doc_index))
+        if doc == len(self.doc_ids):
+            self.doc_ids.append(doc_id)
+        return doc
+
+    def encode_id(self, ref_id: str) -> tuple[int, int]:
+        """Returns the (doc index, paragraph index) posting of an id, adding its doc part to doc_ids"""
+
+        doc_id, _, para = ref_id.rpartition('_')
+        if not doc_id or not para.isdigit() or str(int(para)) != para:
+            return self._get_doc(ref_id), -1
+        return self._get_doc(doc_id), int(para)
+
+    def decode_id(self, doc: int, para: int) -> str:
+        return self.doc_ids[doc] if para < 0 else f'{self.doc_ids[doc]}_{para}'
+
+    def encode_pair(self, pair: tuple[str, str]) -> int:
+        first, second = sorted(pair)
+        return self._vocab_ids[first] * len(self.vocab) + self._vocab_ids[second]
+
+    def decode_pair(self, code: int) -> tuple[str, str]:
+        return self.vocab[code // len(self.vocab)], self.vocab[code % len(self.vocab)]
+
+    def add(self, ref_id: str, pair_codes: np.ndarray, counts: np.ndarray):
+        """Adds an id to the postings of pairs, with the number of coocs of each pair"""
+
+        doc, para = self.encode_id(ref_id)
+        positions = [self._pair_pos.setdefault(code, len(self._pair_pos)) for code in pair_codes.tolist()]
+        self._buffer['pos'].extend(positions)
+        self._buffer['docs'].extend([doc] * len(positions))
+        self._buffer['paras'].extend([para] * len(positions))
+        self._buffer['counts'].extend(counts.tolist())
+        if len(self._buffer['pos']) >= REFS_FLUSH_SIZE:
+            self._flush()
+
+    def merge(self, other: 'CoocsRefs') -> 'CoocsRefs':
+        """Adds the postings of other (same vocab) after these ones. Returns self."""
+
+        self._flush()
+        pos, docs, paras, counts = other._get_run()
+        doc_map = np.fromiter((self._get_doc(doc_id) for doc_id in other.doc_ids), dtype=np.int64,
+                              count=len(other.doc_ids))
+        pos_map = np.fromiter((self._pair_pos.setdefault(code, len(self._pair_pos)) for code in other._pair_pos),
+                              dtype=np.int64, count=len(other._pair_pos))
+        self._add_run(pos_map[pos], doc_map[docs], paras, counts)
+        return self
+
+    def _flush(self):
+        """Turns the buffered postings into a sorted run"""
+
+        if not len(self._buffer['pos']):
+            return
+        self._add_run(*(np.array(self._buffer[field], dtype=np.int64) for field in POSTING_FIELDS))
+        self._buffer = {field: array('i') for field in POSTING_FIELDS}
+
+    def _add_run(self, pos: np.ndarray, docs: np.ndarray, paras: np.ndarray, counts: np.ndarray):
+        """Adds postings as a new sorted run. Runs are merged as soon as a run is not more than twice as large as
+        the next one, so each posting is only sorted again a logarithmic number of times."""
+
+        self._runs.append(_sort_postings(pos, docs, paras, counts))
+        while len(self._runs) > 1 and len(self._runs[-2][0]) <= 2 * len(self._runs[-1][0]):
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            self._runs.append(_sort_postings(*(np.concatenate([a, b]) for a, b in zip(older, newer))))
+        self._indptr = None
+
+    def _get_run(self) -> tuple:
+        """Merges the buffer and all runs into a single run, and returns it"""
+
+        self._flush()
+        if len(self._runs) > 1:
+            self._runs = [_sort_postings(*(np.concatenate(arrays) for arrays in zip(*self._runs)))]
+        if not self._runs:
+            self._runs = [tuple(np.empty(0, dtype=np.uint8) for _ in POSTING_FIELDS)]
+        return self._runs[0]
+
+    def get_postings(self, pair: tuple[str, str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the (doc indices, paragraph indices, counts) arrays of a pair, in the order ids were first found"""
+
+        pos, docs, paras, counts = self._get_run()
+        if self._indptr is None or len(self._indptr) != len(self._pair_pos) + 1:
+            self._indptr = np.r_[0, np.cumsum(np.bincount(pos, minlength=len(self._pair_pos)))]
+        i = self._pair_pos[self.encode_pair(pair)]
+        beg, end = self._indptr[i], self._indptr[i + 1]
+        return docs[beg:end], paras[beg:end], counts[beg:end]
+
+    def __getitem__(self, pair: tuple[str, str]) -> Counter:
+        try:
+            docs, paras, counts = self.get_postings(pair)
+        except (KeyError, ValueError):
+            raise KeyError(pair)
+        return Counter({self.decode_id(doc, para): count
+                        for doc, para, count in zip(docs.tolist(), paras.tolist(), counts.tolist())})
+
+    def __iter__(self):
+        return (self.decode_pair(code) for code in self._pair_pos)
+
+    def __len__(self):
+        return len(self._pair_pos)
+
+    def __repr__(self):
+        n_postings = sum(len(run[0]) for run in self._runs) + len(self._buffer['pos'])
+        return f'CoocsRefs({len(self)} pairs, {n_postings} postings)'
+
+    def get_nbytes(self) -> int:
+        """Size of the posting arrays and buffer, in bytes"""
+
+        return sum(values.nbytes for run in self._runs for values in run) + \
+            sum(buffer.itemsize * len(buffer) for buffer in self._buffer.values())
+
+    def __getstate__(self):
+        self._get_run()
+        state = self.__dict__.copy()
+        # Rebuilt on load, pair codes are saved as an array
+        del state['_doc_index'], state['_vocab_ids'], state['_indptr']
+        state['_pair_pos'] = np.fromiter(self._pair_pos, dtype=np.int64, count=len(self._pair_pos))
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self._vocab_ids = {}
+        for i, word in enumerate(self.vocab):
+            self._vocab_ids.setdefault(word, i)
+        self._pair_pos = {code: i for i, code in enumerate(state['_pair_pos'].tolist())}
+        self._indptr = None
+
+    @classmethod
+    def from_dict(cls, vocab: list[str], refs: dict) -> 'CoocsRefs':
+        """Builds CoocsRefs from a dict of Counters, e.g. the refs of a CoocsCounter pickled before CoocsRefs"""
+
+        coocs_refs = cls(vocab)
+        postings = {field: array('i') for field in POSTING_FIELDS}
+        encoded_ids = {}  # Ids are found in many pairs
+        for pair, counter in refs.items():
+            pos = coocs_refs._pair_pos.setdefault(coocs_refs.encode_pair(pair), len(coocs_refs._pair_pos))
+            encoded = [encoded_ids[ref_id] if ref_id in encoded_ids else
+                       encoded_ids.setdefault(ref_id, coocs_refs.encode_id(ref_id)) for ref_id in counter]
+            postings['pos'].extend([pos] * len(encoded))
+            postings['docs'].extend(doc for doc, _ in encoded)
+            postings['paras'].extend(para for _, para in encoded)
+            postings['counts'].extend(counter.values())
+        coocs_refs._add_run(*(np.array(postings[field], dtype=np.int64) for field in POSTING_FIELDS))
+        return coocs_refs
+
+
+class CoocsRefsSample(Mapping):
+    """Sampled cooccurrence references of a CoocsCounter, a fixed size reservoir of ids per pair
+
+    Same mapping as CoocsRefs (each sorted (word, word) tuple of cooccurring vocab words to a Counter of ids with their
+    number of coocs), but only sample_size ids are kept per pair, along with the exact number of ids and coocs of the
+    pair (get_n_refs, get_n_coocs). Memory is O(pairs x sample_size) instead of O(refs).
+
+    Each (pair, id) gets a pseudo-random key hashed from random_state, and the ids with the smallest keys are kept
+    (bottom-k sampling), a uniform sample of the pair's ids. Keys only depend on random_state, the pair and the id, so
+    the sample is the same whatever the order of the updates, and merging counters updated in parallel gives the same
+    sample as a single counter updated with all the docs. Ids are read in key order, which is a random order.
+
+    Attributes
+    ----------
+    vocab: list[str]
+        Vocab of the CoocsCounter, pairs are encoded from vocab rows.
+    sample_size: int
+        Number of ids kept per pair.
+    random_state: int
+        Seed of the keys. Drawn at random if None is passed.
+    """
+
+    def __init__(self, vocab: list[str], sample_size: int, random_state: Optional[int] = None):
+        assert sample_size > 0, 'Error, sample_size must be a positive int'
+        self.vocab = vocab
+        self.sample_size = sample_size
+        self.random_state = random.getrandbits(63) if random_state is None else random_state
+        self._vocab_ids = {}
+        for i, word in enumerate(self.vocab):
+            self._vocab_ids.setdefault(word, i)
+        # Pair code (first row * len(vocab) + second row): [n refs, n coocs, {id: [key, count]}, max key in sample]
+        self._pairs = {}
+
+    def encode_pair(self, pair: tuple[str, str]) -> int:
+        first, second = sorted(pair)
+        return self._vocab_ids[first] * len(self.vocab) + self._vocab_ids[second]
+
+    def decode_pair(self, code: int) -> tuple[str, str]:
+        return self.vocab[code // len(self.vocab)], self.vocab[code % len(self.vocab)]
+
+    def get_keys(self, ref_id: str, pair_codes: np.ndarray) -> np.ndarray:
+        """Returns the sampling keys of an id for each pair"""
+
+        digest = hashlib.blake2b(f'{self.random_state}:{ref_id}'.encode(), digest_size=8).digest()
+        return _mix64(np.uint64(int.from_bytes(digest, 'little')) +
+                      np.asarray(pair_codes, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15))
+
+    def add(self, ref_id: str, pair_codes: np.ndarray, counts: np.ndarray):
+        """Adds an id to the pairs, with the number of coocs of each pair"""
+
+        keys = self.get_keys(ref_id, pair_codes)
+        for code, key, count in zip(pair_codes.tolist(), keys.tolist(), counts.tolist()):
+            entry = self._get_entry(code)
+            entry[0] += 1
+            entry[1] += count
+            self._sample(entry, ref_id, key, count)
+
+    def _get_entry(self, code: int) -> list:
+        entry = self._pairs.get(code)
+        if entry is None:
+            entry = self._pairs[code] = [0, 0, {}, -1]
+        return entry
+
+    def _sample(self, entry: list, ref_id: str, key: int, count: int):
+        """Adds an id to the sample of a pair if its key is among the sample_size smallest"""
+
+        sample = entry[2]
+        if ref_id in sample:
+            sample[ref_id][1] += count
+        elif len(sample) < self.sample_size:
+            sample[ref_id] = [key, count]
+            entry[3] = max(entry[3], key)
+        elif key < entry[3]:
+            del sample[max(sample, key=lambda i: sample[i][0])]
+            sample[ref_id] = [key, count]
+            entry[3] = max(key for key, _ in sample.values())
+
+    def merge(self, other: 'CoocsRefsSample') -> 'CoocsRefsSample':
+        """Adds the counts and samples of other (same vocab, sample_size and random_state). Returns self."""
+
+        assert isinstance(other, CoocsRefsSample) and other.sample_size == self.sample_size and \
+            other.random_state == self.random_state, \
+            'Error, merged refs samples must have the same sample size and random state'
+        for code, (n_refs, n_coocs, sample, _) in other._pairs.items():
+            entry = self._get_entry(code)
+            entry[0] += n_refs
+            entry[1] += n_coocs
+            for ref_id, (key, count) in sample.items():
+                self._sample(entry, ref_id, key, count)
+        return self
+
+    def get_n_refs(self, pair: tuple[str, str]) -> int:
+        """Returns the number of ids where the pair was found"""
+
+        return self._pairs[self.encode_pair(pair)][0]
+
+    def get_n_coocs(self, pair: tuple[str, str]) -> int:
+        """Returns the number of coocs of the pair, all ids included (counts are doubled, as in CoocsRefs)"""
+
+        return self._pairs[self.encode_pair(pair)][1]
+
+    def __getitem__(self, pair: tuple[str, str]) -> Counter:
+        try:
+            sample = self._pairs[self.encode_pair(pair)][2]
+        except (KeyError, ValueError):
+            raise KeyError(pair)
+        return Counter({ref_id: count for ref_id, (key, count) in sorted(sample.items(), key=lambda item: item[1][0])})
+
+    def __iter__(self):
+        return (self.decode_pair(code) for code in self._pairs)
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def __repr__(self):
+        return f'CoocsRefsSample({len(self)} pairs, {self.sample_size} ids per pair)'
+
+
+def _mix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer, spreads uint64 values uniformly"""
+
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xBF58476D1CE4E5B9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
 
 
 class CoocsCounter:
@@ -13,8 +459,13 @@ class CoocsCounter:
     Also tracks which combinations of vocab word cooccur at least once in each document, making it easy to retrieve the
     ids of all documents in which any specific combination of vocab words were found in the same cooccurrence.
 
-    Ref tracking might consume a lot of memory on large corpus / vocabularies. Consider updating coocs only if it
-    becomes a problem.
+    Words are mapped to integer ids as they are seen (context_words), and the windows of each word list are counted
+    with numpy over the id array. Counts are accumulated in a sparse matrix with a row for each vocab word and a column
+    for each context word (cooc_matrix).
+
+    Refs are stored as integer (doc index, paragraph index) postings for each pair of vocab words (CoocsRefs), read
+    back as Counters of ids. If refs_sample_size is set, only a seeded sample of refs_sample_size ids is kept for each
+    pair, with exact counts (CoocsRefsSample).
 
     Attributes
     ----------
@@ -23,17 +474,20 @@ class CoocsCounter:
     window: int
         How many words to consider in each direction when counting cooccurrences for a targeted word. The value is
         inclusive.
-    coocs: defaultdict[Counter]
-        Variable used to track the cooccurrences. Dict mapping each vocab word to a Counter tracking its cooccurring
-        terms.
-    refs: set[tuple]
-        Collection of tuples tracking cooccurrence references.
+    context_words: list[str]
+        Every word seen in the updates, the position of a word being its id (column in cooc_matrix).
+    coocs: dict[str, Counter]
+        Cooccurrences as a dict mapping each vocab word to a Counter of its cooccurring terms, built from cooc_matrix.
+    refs: CoocsRefs or CoocsRefsSample
+        Mapping of each sorted (word, word) tuple of cooccurring vocab words to a Counter of the ids where they were
+        found (or a sample of them), with the number of coocs.
     word_occs: Counter
         Tracks how many times each vocab word was found.
 
     """
 
-    def __init__(self, vocab: list[str], window: int):
+    def __init__(self, vocab: list[str], window: int, refs_sample_size: Optional[int] = None,
+                 random_state: Optional[int] = None):
         """CoocsCounter constructor,
 
         Parameters
@@ -42,18 +496,55 @@ class CoocsCounter:
             The list of targeted words to count cooccurrences on.
         window: int
             The cooccurrence window (inclusive).
+        refs_sample_size: int, optional
+            If set, only keeps a sample of refs_sample_size ids per pair of vocab words (see CoocsRefsSample).
+        random_state: int, optional
+            Seed of the refs sample. Counters must have the same seed to be merged.
         """
 
         self.vocab = vocab
         self.window = window
-        self.coocs = defaultdict(Counter)
         self.word_occs = Counter()
         self.pairs = [
             tuple(sorted([w1, w2])) for i, w1 in enumerate(self.vocab) for j, w2 in enumerate(self.vocab[i+1:])
         ]
         # Keys: (word, word) sorted
         # values: para, n coocs for each pair. Counts are doubled since registered both for word1 and word2
-        self.refs = defaultdict(Counter)
+        if refs_sample_size is None:
+            self.refs = CoocsRefs(self.vocab)
+        else:
+            self.refs = CoocsRefsSample(self.vocab, refs_sample_size, random_state)
+
+        self.context_words = []
+        self._context_ids = {}
+        self._vocab_rows = np.empty(0, dtype=np.int64)  # Vocab row of each context id, -1 if not a vocab word
+        self._vocab_ids = {}
+        for i, word in enumerate(self.vocab):
+            self._vocab_ids.setdefault(word, i)
+        # Sort position of each vocab row, refs keys are sorted tuples
+        self._vocab_ranks = np.argsort(np.argsort(np.array(self.vocab, dtype=object)))
+        self._cooc_rows = {}  # Rows with coocs, in the order their word was first found
+        self._matrix = sparse.csr_matrix((len(self.vocab), 0), dtype=np.int64)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def encode(self, words: Iterable[str]) -> np.ndarray:
+        """Returns the context ids of words, adding the new ones to context_words"""
+
+        context_ids = self._context_ids
+        n_before = len(context_ids)
+        ids = np.fromiter((context_ids.setdefault(word, len(context_ids)) for word in words), dtype=np.int64)
+        n_after = len(context_ids)
+        if n_after > n_before:
+            new_words = list(islice(reversed(context_ids), n_after - n_before))[::-1]
+            self.context_words.extend(new_words)
+            if n_after > len(self._vocab_rows):
+                # Grown by doubling, only the first len(context_words) values are used
+                vocab_rows = np.full(max(2 * len(self._vocab_rows), n_after, 1024), -1, dtype=np.int64)
+                vocab_rows[:n_before] = self._vocab_rows[:n_before]
+                self._vocab_rows = vocab_rows
+            self._vocab_rows[n_before:n_after] = [self._vocab_ids.get(word, -1) for word in new_words]
+        return ids
 
     def update(self, doc_id: str, word_list: Iterable[str],
                update_coocs: Optional[bool] = True, update_refs: Optional[bool] = True):
@@ -76,23 +567,104 @@ class CoocsCounter:
             Whether to update vocab words cooccurrence references
         """
 
-        for i, word in enumerate(word_list):
-            if word in self.vocab:
-                self.word_occs.update([word])
-                beg = max(i - self.window, 0)
-                end = i + self.window + 1
-                sequence = [w for w in word_list[beg:end] if w != word]
+        ids = self.encode(word_list)
+        rows = self._vocab_rows[ids]
+        hits = np.flatnonzero(rows >= 0)
+        if not len(hits):
+            return
+        self._update_word_occs(rows[hits], update_coocs)
+
+        hit_idx, positions = window_positions(hits, len(ids), self.window)
+        hit_rows = rows[hits][hit_idx]
+        keep = ids[positions] != ids[hits][hit_idx]
+        hit_rows, positions = hit_rows[keep], positions[keep]
+
+        if update_coocs:
+            self._add_coocs(hit_rows, ids[positions])
+
+        if update_refs:
+            cooc_rows = rows[positions]
+            is_vocab = cooc_rows >= 0
+            self._update_refs(doc_id, hit_rows[is_vocab], cooc_rows[is_vocab])
 
-                if update_coocs:
-                    self.coocs[word].update(sequence)
+    def _update_word_occs(self, hit_rows: np.ndarray, update_coocs: bool = True):
+        """Adds the vocab words found to word_occs (and to the coocs rows), in the order they were found"""
 
-                if update_refs:
-                    # Update refs if at least 2 vocab words are found
-                    # if sum(vals := [w in sequence for w in self.vocab]) >= 2:
+        found_rows, first, counts = np.unique(hit_rows, return_index=True, return_counts=True)
+        for i in np.argsort(first, kind='stable'):
+            row = int(found_rows[i])
+            self.word_occs[self.vocab[row]] += int(counts[i])
+            if update_coocs:
+                self._cooc_rows.setdefault(row)
 
-                    for cooc in sequence:
-                        if cooc in self.vocab:
-                            self.refs[tuple(sorted([word, cooc]))].update([doc_id])
+    def _add_coocs(self, rows: np.ndarray, context_ids: np.ndarray, counts: Optional[np.ndarray] = None):
+        """Buffers (vocab row, context id) pairs, added to the matrix once the buffer is full. Each counts once if
+        counts is None."""
+
+        if counts is None:
+            counts = np.ones(len(rows), dtype=np.int64)
+        self._buffer.append((rows, context_ids, counts))
+        self._buffer_size += len(rows)
+        if self._buffer_size >= FLUSH_SIZE:
+            self._flush()
+
+    def _update_refs(self, doc_id: str, hit_rows: np.ndarray, cooc_rows: np.ndarray):
+        if not len(hit_rows):
+            return
+        swap = self._vocab_ranks[hit_rows] > self._vocab_ranks[cooc_rows]
+        first, second = np.where(swap, cooc_rows, hit_rows), np.where(swap, hit_rows, cooc_rows)
+        pair_codes, counts = np.unique(first * len(self.vocab) + second, return_counts=True)
+        self.refs.add(doc_id, pair_codes, counts)
+
+    def _flush(self):
+        """Adds the buffered pairs to the sparse matrix"""
+
+        shape = (len(self.vocab), len(self.context_words))
+        if self._matrix.shape != shape:
+            self._matrix.resize(shape)
+        if self._buffer:
+            rows, cols, counts = (np.concatenate(arrays) for arrays in zip(*self._buffer))
+            self._matrix = self._matrix + sparse.csr_matrix((counts, (rows, cols)), shape=shape)
+        self._buffer = []
+        self._buffer_size = 0
+
+    @property
+    def cooc_matrix(self) -> sparse.csr_matrix:
+        """Sparse matrix of the cooccurrence counts, vocab rows by context_words columns"""
+
+        self._flush()
+        return self._matrix
+
+    @property
+    def coocs(self) -> dict:
+        matrix = self.cooc_matrix
+        coocs = {}
+        for row in self._cooc_rows:
+            beg, end = matrix.indptr[row], matrix.indptr[row + 1]
+            coocs[self.vocab[row]] = Counter({self.context_words[col]: count for col, count
+                                              in zip(matrix.indices[beg:end].tolist(), matrix.data[beg:end].tolist())})
+        return coocs
+
+    def merge(self, *others: 'CoocsCounter') -> 'CoocsCounter':
+        """Adds the coocs, word occurrences and refs of other counters to this one, e.g. counters updated on different
+        docs in parallel. Counters must share the same vocab and window. Returns self.
+
+        Results are the same as updating a single counter with all the docs, other counters being processed after
+        this one.
+        """
+
+        for other in others:
+            assert list(other.vocab) == list(self.vocab) and other.window == self.window, \
+                'Error, merged counters must have the same vocab and window'
+            assert type(other.refs) is type(self.refs), 'Error, merged counters must all sample refs or none'
+            matrix = other.cooc_matrix.tocoo()
+            context_ids = self.encode(other.context_words)
+            for row in other._cooc_rows:
+                self._cooc_rows.setdefault(row)
+            self._add_coocs(matrix.row.astype(np.int64), context_ids[matrix.col], matrix.data)
+            self.word_occs.update(other.word_occs)
+            self.refs.merge(other.refs)
+        return self
 
     def update_coocs_only(self, doc_id: str, word_list: Iterable[str]):
         """Calls update with coocs only (id, word_list, True, False). Might be cleaner in some cases."""
@@ -108,14 +680,50 @@ class CoocsCounter:
         """Returns a DataFrame with cooccurrence results
 
         Columns are vocab words (as specified on init) that were found at least once in update texts.
-        Index are all words with at least one cooccurrence with a vocab word.
+        Index are all words with at least one cooccurrence with a vocab word, in the order they were first seen. Missing
+        cooccurrences are NaN. The df is dense, prefer as_matrix() on large corpus.
         """
 
+        result = self.as_matrix()
+        cols = range(len(result.context_words))
         if filter_fct is not None:
-            filtered_cooc_terms = list(filter(filter_fct, {word for counter in self.coocs.values() for word in counter.keys()}))
-            return pd.DataFrame(self.coocs, index=filtered_cooc_terms)
-        else:
-            return pd.DataFrame(self.coocs)
+            cols = [col for col in cols if filter_fct(result.context_words[col])]
+        values = result.matrix[:, cols].T.toarray().astype(float)
+        values[values == 0] = np.nan
+        return pd.DataFrame(values, index=[result.context_words[col] for col in cols], columns=result.vocab_words)
+
+    def as_matrix(self) -> CoocsMatrix:
+        """Returns the cooccurrence results as a sparse CoocsMatrix
+
+        Same rows and columns as as_df() (transposed), without building the dense DataFrame.
+        """
+
+        rows = list(self._cooc_rows)
+        counts = self.cooc_matrix[rows]
+        cols = np.flatnonzero(counts.getnnz(axis=0))
+        return CoocsMatrix(counts[:, cols], [self.vocab[row] for row in rows],
+                           [self.context_words[col] for col in cols.tolist()],
+                           [self.word_occs[self.vocab[row]] for row in rows])
+
+    def __getstate__(self):
+        self._flush()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'coocs' in state:
+            # Pickled before the cooc matrix, coocs were a defaultdict of Counters
+            coocs = state.pop('coocs')
+            CoocsCounter.__init__(self, state['vocab'], state['window'])
+            for word, counter in coocs.items():
+                row = self._vocab_ids[word]
+                self._cooc_rows.setdefault(row)
+                self._add_coocs(np.full(len(counter), row), self.encode(counter),
+                                np.fromiter(counter.values(), dtype=np.int64, count=len(counter)))
+            self._flush()
+        if not isinstance(state.get('refs'), (CoocsRefs, CoocsRefsSample)):
+            # Pickled before CoocsRefs, refs were a defaultdict of Counters
+            state['refs'] = CoocsRefs.from_dict(state['vocab'], state.get('refs', {}))
+        self.__dict__.update(state)
 
     def to_pickle(self, path):
         """Pickles the LexCounter object at the specified location."""
@@ -125,3 +733,34 @@ class CoocsCounter:
     @classmethod
     def read_pickle(cls, path):
         return pickle.load(open(path, 'rb'))
+
+
+def _ref_sort_key(ref_id: str) -> tuple[str, int]:
+    """(doc id, paragraph number) of an id, paragraph number being -1 for ids without one (see CoocsRefs.encode_id)"""
+
+    doc_id, _, para = ref_id.rpartition('_')
+    if not doc_id or not para.isdigit() or str(int(para)) != para:
+        return ref_id, -1
+    return doc_id, int(para)
+
+
+def shuffle_ref_ids(refs: Mapping, random_state: int, pair_filter_fct: Optional[Callable] = None) -> dict:
+    """Returns {pair: list of ids} with the ids of each pair of refs shuffled, seeded with random_state
+
+    Pairs and ids are sorted before the seeded shuffle, so the result only depends on the refs content and not on the
+    order docs were counted or counters merged in (number of workers, clusters merged into a total...). Sampled refs
+    (CoocsRefsSample) are already in a seeded random order and are not shuffled. Only pairs for which
+    pair_filter_fct(pair) is True are kept if passed.
+    """
+
+    rnd = random.Random(random_state)
+    shuffled_ids = {}
+    for pair in sorted(refs):
+        if pair_filter_fct is not None and not pair_filter_fct(pair):
+            continue
+        ids = list(refs[pair])
+        if not isinstance(refs, CoocsRefsSample):
+            ids.sort(key=_ref_sort_key)
+            rnd.shuffle(ids)
+        shuffled_ids[pair] = ids
+    return shuffled_ids
@@ -1,7 +1,8 @@
-
 from typing import Callable, Iterable, Optional
 
-from mempyapi.coocs import CoocsCounter
+import numpy as np
+
+from mempyapi.coocs import CoocsCounter, window_positions
 
 
 class CoocsCounterTags(CoocsCounter):
@@ -14,16 +15,31 @@ class CoocsCounterTags(CoocsCounter):
         self.filter_fct = cooc_tag_filter_fct
         super().__init__(vocab, window)
 
+    def merge(self, *others: 'CoocsCounterTags') -> 'CoocsCounterTags':
+        """Same as CoocsCounter.merge, counters must also count the same tag attribute"""
+
+        assert all(other.tag_attr == self.tag_attr for other in others), \
+            'Error, merged counters must have the same tag attribute'
+        return super().merge(*others)
+
     def update(self, doc_id: str, tag_list,
                update_coocs: Optional[bool] = True,
                update_refs: Optional[bool] = True):
 
-        for i, tag in enumerate(tag_list):
-            if getattr(tag, self.tag_attr) in self.vocab and not self.filter_fct(tag):
-                self.word_occs.update([tag.lemma])
-                beg = max(i - self.window, 0)
-                end = i + self.window + 1
-                sequence = tag_list[beg:end]
-
-                if update_coocs:
-                    self.coocs[getattr(tag, self.tag_attr)].update([getattr(t, self.tag_attr) for t in sequence if (t.lemma != tag.lemma) and (self.filter_fct(t))])
\ No newline at end of file
+        ids = self.encode(getattr(tag, self.tag_attr) for tag in tag_list)
+        accepted = np.fromiter((bool(self.filter_fct(tag)) for tag in tag_list), dtype=bool, count=len(ids))
+        rows = self._vocab_rows[ids]
+        hits = np.flatnonzero((rows >= 0) & ~accepted)
+        if not len(hits):
+            return
+        self.word_occs.update([tag_list[i].lemma for i in hits.tolist()])
+
+        if update_coocs:
+            for row in rows[hits].tolist():
+                self._cooc_rows.setdefault(row)
+            lemma_ids = {}
+            lemmas = np.fromiter((lemma_ids.setdefault(tag.lemma, len(lemma_ids)) for tag in tag_list),
+                                 dtype=np.int64, count=len(ids))
+            hit_idx, positions = window_positions(hits, len(ids), self.window)
+            keep = accepted[positions] & (lemmas[positions] != lemmas[hits][hit_idx])
+            self._add_coocs(rows[hits][hit_idx][keep], ids[positions][keep])